@@ -0,0 +1,144 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+
+class AdaptiveBatchController:
+    """
+    Tunes the max_rows and max_age of a BatchScheduler so packets are committed within a latency SLO, while
+    writing as many rows per round trip as possible. Every adjust uses the insert time per row measured on the
+    flushes, the rate at which rows are added to the scheduler and the depth of the queue:
+    - rows wait in the buffer at most max_age and then take max_rows * time per row to be written, so max_age is the
+      largest age whose batch (rate * max_age rows) still commits within the SLO, and max_rows is that batch
+    - while messages are piling up in the queue (or the database can't keep up with the rate), the SLO is already
+      lost for them and max_rows grows to the largest batch that commits within the SLO, to drain the backlog
+    max_rows changes by at most max_step times per adjust. The last decisions are kept in decisions
+    """
+
+    def __init__(self, scheduler, slo=2, min_rows=16, max_rows=5000, min_age=0.1, max_age=10, smoothing=0.3,
+                 max_step=2, history=100, clock=time.monotonic, logger=None):
+        """
+        Initializes the instance. The current limits of the scheduler are kept until the first adjust
+        :param scheduler: BatchScheduler whose limits are tuned
+        :param slo: target seconds from the moment a row is buffered until its batch is committed
+        :param min_rows: lower bound of max_rows
+        :param max_rows: upper bound of max_rows
+        :param min_age: lower bound of max_age, in seconds
+        :param max_age: upper bound of max_age, in seconds
+        :param smoothing: weight of the newest measure in the moving averages of the rate and time per row
+        :param max_step: maximum factor by which max_rows grows or shrinks per adjust
+        :param history: number of decisions kept
+        :param clock: function returning the current time in seconds
+        :param logger: logger instance (logging library) to use
+        """
+        self.scheduler = scheduler
+        self.slo = slo
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.min_age = min_age
+        self.max_age = max_age
+        self.smoothing = smoothing
+        self.max_step = max_step
+        self.clock = clock
+        self.logger = logger
+        # seconds to insert a row, None until a batch is flushed
+        self.row_seconds = None
+        # rows added to the scheduler per second
+        self.rate = None
+        self.last_adjust = clock()
+        self.last_added = scheduler.added
+        self.decisions = deque(maxlen=history)
+        # flushes may be recorded from the spool thread
+        self.lock = threading.Lock()
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def average(self, previous, value):
+        return value if previous is None else previous + self.smoothing * (value - previous)
+
+    def record_flush(self, rows, seconds):
+        """
+        Updates the time per row with a committed batch
+        :param rows: number of rows in the batch
+        :param seconds: time taken to write and commit it
+        :return: nothing
+        """
+        if rows <= 0:
+            return
+        with self.lock:
+            self.row_seconds = self.average(self.row_seconds, seconds / rows)
+
+    def adjust(self, queue_depth=None):
+        """
+        Computes the new limits and applies them to the scheduler
+        :param queue_depth: number of messages waiting in the queue. None if unknown
+        :return: dict with the decision: the measures it was based on, the new max_rows and max_age, the expected
+        latency of a row and the reason
+        """
+        now = self.clock()
+        added = self.scheduler.added
+        elapsed = now - self.last_adjust
+        if elapsed > 0:
+            self.rate = self.average(self.rate, (added - self.last_added) / elapsed)
+        self.last_adjust = now
+        self.last_added = added
+        rate = self.rate or 0
+        with self.lock:
+            row_seconds = self.row_seconds or 0
+
+        # the batch buffered during max_age is written within the SLO: age + rate * age * row_seconds = slo
+        load = rate * row_seconds
+        age = min(max(self.slo / (1 + load), self.min_age), self.max_age)
+        # largest batch that commits within the SLO once it's full
+        largest = self.slo / row_seconds if row_seconds > 0 else self.max_rows
+        current = self.scheduler.max_rows
+        if load >= 1:
+            reason = 'saturated'
+            rows = largest
+        elif queue_depth is not None and queue_depth > current:
+            reason = 'backlog'
+            rows = largest
+        elif self.row_seconds is None:
+            reason = 'no flushes measured'
+            rows = rate * age
+        else:
+            reason = 'slo'
+            rows = rate * age
+        rows = min(max(rows, current / self.max_step, self.min_rows), current * self.max_step, self.max_rows)
+        rows = max(int(rows), 1)
+        if reason in ('slo', 'no flushes measured'):
+            # the bounds may have made the batch larger than the one buffered during age
+            age = max(min(age, self.slo - rows * row_seconds), self.min_age)
+
+        self.scheduler.resize(rows, age)
+        decision = {
+            'time': time.time(),
+            'rate': rate,
+            'row_seconds': row_seconds,
+            'queue_depth': queue_depth,
+            'max_rows': rows,
+            'max_age': age,
+            'expected_latency': min(age, rows / rate if rate > 0 else math.inf) + rows * row_seconds,
+            'reason': reason,
+        }
+        self.decisions.append(decision)
+        level = logging.INFO if rows != current else logging.DEBUG
+        self.log(level, f'Batches of {rows} rows (was {current}) or {age:.2f} s ({reason}): {rate:.1f} rows/s, '
+                        f'{row_seconds * 1e6:.1f} us/row, queue depth {queue_depth}')
+        return decision
+
+    def get_decisions(self):
+        """
+        :return: list with the last decisions, oldest first
+        """
+        return list(self.decisions)
@@ -0,0 +1,101 @@
+import gzip
+import io
+import json
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ArchiveEncoder:
+
+    EXTENSIONS = {'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+    def __init__(self, codec='gzip', level=6, chunk_size=256 * 1024):
+        """
+        Initializes the instance. Messages are written one json per line, so they can be consumed by spark easily.
+        They are serialized into a reusable buffer (with orjson, if installed) and handed to the compressor in chunks
+        :param codec: 'gzip' or 'zstd' (requires the zstandard package)
+        :param level: compression level
+        :param chunk_size: number of serialized bytes buffered before calling the compressor
+        """
+        if codec not in self.EXTENSIONS:
+            raise ValueError(f'Unknown archive codec {codec}. Valid options are: {", ".join(self.EXTENSIONS)}')
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError('The zstd codec requires the zstandard package')
+        self.codec = codec
+        self.level = level
+        self.chunk_size = chunk_size
+        self.extension = self.EXTENSIONS[codec]
+        # encoders are shared by the uploader threads: each one gets its own buffer
+        self.local = threading.local()
+
+    def get_buffer(self):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            buffer = self.local.buffer = bytearray()
+        return buffer
+
+    def open_compressor(self, fileobj):
+        """
+        :param fileobj: binary file where the compressed data is written. It's not closed with the compressor
+        :return: file-like compressor
+        """
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).stream_writer(fileobj, closefd=False)
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=self.level)
+
+    def encode_to(self, messages, fileobj):
+        """
+        Writes the compressed messages to a file
+        :param messages: list of json serializable messages
+        :param fileobj: binary file
+        :return: number of uncompressed bytes
+        """
+        buffer = self.get_buffer()
+        buffer.clear()
+        size = 0
+        with self.open_compressor(fileobj) as compressor:
+            for msg in messages:
+                buffer += dumps(msg)
+                buffer += b'\n'
+                if len(buffer) >= self.chunk_size:
+                    size += len(buffer)
+                    compressor.write(buffer)
+                    buffer.clear()
+            if len(buffer) > 0:
+                size += len(buffer)
+                compressor.write(buffer)
+                buffer.clear()
+        return size
+
+    def encode(self, messages):
+        """
+        :param messages: list of json serializable messages
+        :return: bytes with the compressed messages
+        """
+        f = io.BytesIO()
+        self.encode_to(messages, f)
+        return f.getvalue()
+
+
+def dumps(msg):
+    """
+    Serializes a message to json
+    :param msg: json serializable object
+    :return: bytes
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(msg)
+        except TypeError:
+            # e.g. non string keys or integers bigger than 64 bits
+            pass
+    return json.dumps(msg).encode('utf-8')
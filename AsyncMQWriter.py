@@ -0,0 +1,429 @@
+"""
+Asyncio runtime for the packet writer. It consumes collectors_queue with aio-pika, writes the packet batches
+through an asyncpg pool and archives the raw collector messages in a background thread, so a slow database
+write or S3 upload never stops message intake. Configuration is the same as MQWriter, plus:
+- ASYNC_DB_POOL_SIZE: maximum number of database connections (and concurrent batch writes)
+- ASYNC_MAX_PENDING_WRITES: batches that may wait for a connection before intake is paused
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aio_pika
+import asyncpg
+
+import MQWriter
+from BatchAcknowledger import is_transient_error
+from BatchScheduler import BatchScheduler
+from Metrics import (BATCH_MAX_AGE, BATCH_MAX_ROWS, BATCH_SIZE, BATCHES_COMMITTED, BATCHES_ROLLED_BACK, FLUSH_SECONDS,
+                     MESSAGES_CONSUMED, PACKETS_DEDUPLICATED, PACKETS_INSERTED, PACKETS_REJECTED, WRITE_QUEUE_DEPTH,
+                     start_metrics_server)
+from PacketDecoder import PACKET_COLUMNS, as_bigint, decode_message, decode_packet
+from Sharding import QUEUE_NAME, owned_shards, shard_queue_name
+from auditing.db import DB_HOST, DB_NAME, DB_PASSWORD, DB_PORT, DB_USERNAME
+from auditing.db.Models import Packet, PacketDeadLetter
+
+# Errors caused by the content of some rows, as PacketBulkWriter.ROW_ERRORS. Values that can't be encoded for the
+# binary COPY raise TypeError, ValueError or OverflowError before reaching the database
+ROW_ERRORS = (asyncpg.exceptions.DataError, asyncpg.exceptions.IntegrityConstraintViolationError, TypeError,
+              ValueError, OverflowError)
+# Errors that make dead letters be dropped (e.g. the dead letter table doesn't exist) instead of failing the batch
+DEAD_LETTER_ERRORS = ROW_ERRORS + (asyncpg.exceptions.SyntaxOrAccessError,)
+
+
+class LoopTimers:
+    """
+    Adapts an asyncio loop to the call_later/remove_timeout interface of pika connections used by BatchScheduler
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def call_later(self, delay, callback):
+        return self.loop.call_later(delay, callback)
+
+    def remove_timeout(self, handle):
+        handle.cancel()
+
+
+class AsyncPacketWriter:
+
+    def __init__(self, pool, max_rows=64, max_age=10, max_bytes=None, ack_mode='immediate', max_pending_writes=8,
+                 deduplicator=None, adaptive=False, isolate_failures=True,
+                 dead_letter_table=PacketDeadLetter.__tablename__, logger=None):
+        """
+        Initializes the instance. Must be created from inside the running loop
+        :param pool: asyncpg pool used to write the batches
+        :param max_rows: maximum number of packets in a batch
+        :param max_age: maximum number of seconds a packet may wait in the buffer
+        :param max_bytes: maximum approximate size of a batch in bytes. None to disable the limit
+        :param ack_mode: 'immediate' to acknowledge deliveries when they are buffered,
+        'batch' to acknowledge them once their batch was committed
+        :param max_pending_writes: number of batch writes in flight before message intake waits
+        :param deduplicator: PacketDeduplicator applied to every batch. None to write every copy
+        :param adaptive: tune the batch limits with an AdaptiveBatchController (see MQWriter.get_batch_controller)
+        :param isolate_failures: when a batch fails because of its content, write the good rows and reject the
+        failing ones instead of failing the whole batch
+        :param dead_letter_table: table where rejected rows are saved with their error. None to only log them
+        :param logger: logger instance (logging library) to use
+        """
+        self.pool = pool
+        self.isolate_failures = isolate_failures
+        self.dead_letter_table = dead_letter_table
+        # (payload, error) tuples waiting to be written to the dead letter table with the next batch
+        self.rejected = []
+        self.ack_mode = ack_mode
+        self.max_pending_writes = max_pending_writes
+        self.deduplicator = deduplicator
+        self.logger = logger
+        self.loop = asyncio.get_running_loop()
+        self.scheduler = BatchScheduler(self.start_write, max_rows=max_rows, max_age=max_age, max_bytes=max_bytes,
+                                        logger=logger)
+        self.scheduler.attach(LoopTimers(self.loop))
+        WRITE_QUEUE_DEPTH.set_function(lambda: len(self.scheduler))
+        BATCH_MAX_ROWS.set_function(lambda: self.scheduler.max_rows)
+        BATCH_MAX_AGE.set_function(lambda: self.scheduler.max_age)
+        self.controller = MQWriter.get_batch_controller(self.scheduler) if adaptive else None
+        self.writes = set()
+        # consecutive batches that failed because of a transient error
+        self.transient_failures = 0
+        # the collector message managers are not thread safe: a single thread archives all the messages
+        self.archiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archiver')
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    async def on_message(self, message):
+        """
+        Handles a delivery from collectors_queue, with the same mapping and archiving as MQWriter.callback
+        :param message: aio_pika.IncomingMessage
+        """
+        deferred = False
+        MESSAGES_CONSUMED.inc()
+        try:
+            data = decode_message(message.body)
+            packet = data.get('packet')
+            messages = data.get('messages')
+            row = None
+
+            if packet:
+                try:
+                    row = decode_packet(packet)
+                except Exception as e:
+                    # saved to the dead letter table with the next batch, and its messages are still archived
+                    self.log(logging.ERROR, f'There was an error decoding packet {packet}: {e}')
+                    PACKETS_REJECTED.inc()
+                    self.reject(packet, e)
+                if row is not None:
+                    deferred = self.ack_mode == 'batch'
+                    self.scheduler.add((row, message if deferred else None), size=len(message.body))
+
+            if messages and len(messages) > 0:
+                self.loop.run_in_executor(self.archiver, MQWriter.save_messages, messages,
+                                          messages[0].get('data_collector_id'), None,
+                                          row[MQWriter.DATE_INDEX] if row is not None else None)
+        except Exception as e:
+            self.log(logging.ERROR, f'There was an error writing messages:\n{e}')
+
+        if not deferred:
+            try:
+                await message.ack()
+            except Exception as e:
+                self.log(logging.ERROR, f'There was an error ACK-ing the packet: {message.body}. Exception: {e}')
+
+        # backpressure: don't take more messages while too many batches are waiting to be written
+        if len(self.writes) >= self.max_pending_writes:
+            await asyncio.wait(self.writes, return_when=asyncio.FIRST_COMPLETED)
+
+    def start_write(self, entries):
+        task = self.loop.create_task(self.write(entries))
+        self.writes.add(task)
+        task.add_done_callback(self.writes.discard)
+
+    async def write(self, entries):
+        """
+        Writes a batch with COPY and settles the deliveries of its packets
+        :param entries: list of (row, message) tuples. message is None if it was already acknowledged
+        """
+        deliveries = [message for _, message in entries if message is not None]
+        rows = [row for row, _ in entries]
+        columns = PACKET_COLUMNS
+        if self.deduplicator is not None:
+            rows = self.deduplicator.process(rows)
+            # several batches may be written at once: each one commits its own packets
+            deduplicated = self.deduplicator.pending
+            PACKETS_DEDUPLICATED.inc(len(entries) - len(rows))
+            columns = self.deduplicator.columns
+        BATCH_SIZE.observe(len(rows))
+        # packets may be rejected while the batch is written
+        pending, self.rejected = self.rejected, []
+        start = time.perf_counter()
+        try:
+            async with self.pool.acquire() as connection:
+                rejected = await self.write_rows(connection, rows, columns, pending)
+        except Exception as e:
+            self.rejected[0:0] = pending
+            self.log(logging.ERROR, f'There was an error writing {len(rows)} packets: {e}')
+            BATCHES_ROLLED_BACK.inc()
+            transient = is_transient_error(e)
+            if transient:
+                # the write keeps its slot while waiting, so intake slows down until the database is back
+                self.transient_failures += 1
+                await asyncio.sleep(min(2 ** (self.transient_failures - 1), 30))
+            for message in deliveries:
+                await message.nack(requeue=transient or not message.redelivered)
+            return
+        self.transient_failures = 0
+        if self.deduplicator is not None:
+            self.deduplicator.commit(deduplicated)
+        elapsed = time.perf_counter() - start
+        FLUSH_SECONDS.observe(elapsed)
+        if self.controller is not None:
+            self.controller.record_flush(len(rows), elapsed)
+        PACKETS_INSERTED.inc(len(rows) - len(rejected))
+        PACKETS_REJECTED.inc(len(rejected))
+        BATCHES_COMMITTED.inc()
+        for message in deliveries:
+            await message.ack()
+
+    async def write_rows(self, connection, rows, columns, pending):
+        """
+        Writes a batch of rows and the pending dead letters in a single transaction. If the batch fails because of
+        the content of some rows and isolate_failures is set, the batch is bisected: the good rows are committed and
+        the failing ones are rejected, as in PacketBulkWriter.write
+        :param connection: asyncpg connection
+        :param rows: list of tuples with the columns
+        :param columns: names of the columns of the rows
+        :param pending: list of (payload, error) tuples to write to the dead letter table
+        :return: list of (row, error) tuples with the rejected rows. An exception is raised if the batch failed
+        """
+        try:
+            async with connection.transaction():
+                await self.copy_rows(connection, rows, columns)
+                await self.write_dead_letters(connection, pending)
+            return []
+        except ROW_ERRORS as e:
+            if not self.isolate_failures:
+                raise
+            self.log(logging.WARNING, f'Batch of {len(rows)} packets failed ({e}), isolating the failing rows')
+        async with connection.transaction():
+            rejected = await self.write_isolating(connection, rows, columns)
+            for row, error in rejected:
+                self.log(logging.ERROR, f'Rejected packet {row}: {error}')
+            await self.write_dead_letters(connection, pending + [(dict(zip(columns, row)), error)
+                                                                 for row, error in rejected])
+        return rejected
+
+    async def write_isolating(self, connection, rows, columns):
+        """
+        Writes the rows inside a savepoint. If they fail, the savepoint is rolled back and each half is retried
+        :return: list of (row, error) tuples with the rows that could not be written
+        """
+        if len(rows) == 0:
+            return []
+        try:
+            # a transaction inside a transaction is a savepoint
+            async with connection.transaction():
+                await self.copy_rows(connection, rows, columns)
+        except ROW_ERRORS as e:
+            if len(rows) == 1:
+                return [(rows[0], str(e).strip())]
+            middle = len(rows) // 2
+            return (await self.write_isolating(connection, rows[:middle], columns) +
+                    await self.write_isolating(connection, rows[middle:], columns))
+        return []
+
+    async def copy_rows(self, connection, rows, columns):
+        if len(rows) > 0:
+            await connection.copy_records_to_table(Packet.__tablename__, records=rows, columns=columns)
+
+    def reject(self, payload, error):
+        """
+        Registers a packet that can't be written (e.g. it could not be decoded). It's saved to the dead letter table
+        with the next batch
+        :param payload: dict with the packet
+        :param error: exception or error message
+        :return: nothing
+        """
+        self.rejected.append((payload, str(error)))
+
+    async def write_dead_letters(self, connection, rejected):
+        """
+        Inserts rejected packets in the dead letter table, inside a savepoint so they never fail the batch. If they
+        fail, each one is retried alone and the ones that still fail are logged and dropped
+        :param connection: asyncpg connection, inside a transaction
+        :param rejected: list of (payload, error) tuples
+        :return: nothing
+        """
+        if self.dead_letter_table is None or len(rejected) == 0:
+            return
+        try:
+            async with connection.transaction():
+                await connection.executemany(
+                    f'INSERT INTO {self.dead_letter_table} (data_collector_id, error, payload) VALUES ($1, $2, $3)',
+                    [(as_bigint(payload.get('data_collector_id')) if isinstance(payload, dict) else None,
+                      error[0:PacketDeadLetter.error.type.length], json.dumps(payload, default=str))
+                     for payload, error in rejected])
+        except DEAD_LETTER_ERRORS as e:
+            if len(rejected) == 1:
+                self.log(logging.ERROR, f'Dropped dead letter {rejected[0]}: {str(e).strip()}')
+                return
+            for dead_letter in rejected:
+                await self.write_dead_letters(connection, [dead_letter])
+
+    async def drain(self):
+        """
+        Writes the buffered packets and waits for the pending writes and archives
+        """
+        try:
+            self.scheduler.flush()
+        except Exception as e:
+            self.log(logging.ERROR, f'There was an error writing the buffered packets: {e}')
+        if self.writes:
+            await asyncio.wait(self.writes)
+        if self.rejected:
+            # packets rejected after the last batch
+            pending, self.rejected = self.rejected, []
+            try:
+                async with self.pool.acquire() as connection:
+                    async with connection.transaction():
+                        await self.write_dead_letters(connection, pending)
+            except Exception as e:
+                self.log(logging.ERROR, f'There was an error writing {len(pending)} rejected packets: {e}')
+        if MQWriter.CollectorMessageManager:
+            await self.loop.run_in_executor(self.archiver, MQWriter.CollectorMessageManager.flush_all)
+        self.archiver.shutdown()
+
+
+async def declare_queues(channel):
+    """
+    Declares the exchange and the queues to consume (collectors_queue, or the shards of this instance when
+    SHARD_COUNT > 1) with their bindings, the same as MQWriter.declare_queues
+    :param channel: aio_pika channel
+    :return: list of aio_pika queues
+    """
+    exchange = await channel.declare_exchange(os.environ["ENVIRONMENT"], aio_pika.ExchangeType.DIRECT)
+    if MQWriter.SHARD_COUNT <= 1:
+        queue = await channel.declare_queue(QUEUE_NAME, durable=True)
+        await queue.bind(exchange, routing_key=QUEUE_NAME)
+        return [queue]
+
+    shards = owned_shards(MQWriter.SHARD_COUNT, MQWriter.SHARD_INDEXES)
+    queues = []
+    if MQWriter.SHARD_MODE == 'consistent-hash':
+        shard_exchange = await channel.declare_exchange(f'{exchange.name}.{QUEUE_NAME}', 'x-consistent-hash',
+                                                        durable=True,
+                                                        arguments={'hash-header': MQWriter.SHARD_HASH_HEADER})
+        await shard_exchange.bind(exchange, routing_key=QUEUE_NAME)
+        for shard in shards:
+            queues.append(await channel.declare_queue(shard_queue_name(shard), durable=True))
+            await queues[-1].bind(shard_exchange, routing_key='1')
+    elif MQWriter.SHARD_MODE == 'routing-key':
+        for shard in shards:
+            queues.append(await channel.declare_queue(shard_queue_name(shard), durable=True))
+            await queues[-1].bind(exchange, routing_key=shard_queue_name(shard))
+    else:
+        raise ValueError(f'Unknown shard mode {MQWriter.SHARD_MODE}. Valid options are: routing-key, consistent-hash')
+
+    if 0 in shards:
+        legacy = await channel.declare_queue(QUEUE_NAME, durable=True)
+        if MQWriter.SHARD_MODE == 'consistent-hash':
+            await legacy.unbind(exchange, routing_key=QUEUE_NAME)
+        queues.append(legacy)
+    return queues
+
+
+async def adjust_batches(writer, channel, queues, interval):
+    """
+    Adjusts the batch limits of the writer every interval seconds, with the depth of the queues from passive declares
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            declared = [await channel.declare_queue(queue.name, passive=True) for queue in queues]
+            depth = sum(queue.declaration_result.message_count for queue in declared)
+        except Exception as e:
+            logging.warning(f'Could not get the depth of the queues: {e}')
+            depth = None
+        try:
+            writer.controller.adjust(depth)
+        except Exception as e:
+            logging.error(f'There was an error adjusting the batch limits: {e}')
+
+
+def check_settings():
+    """
+    Raises ValueError if a setting of MQWriter that this runtime doesn't implement is enabled, instead of silently
+    ignoring it
+    """
+    unsupported = {
+        'COLLECTOR_MSGS_TABLE': MQWriter.COLLECTOR_MSGS_TABLE,
+        'REFERENCE_CACHE': MQWriter.reference_cache is not None,
+        'PACKET_ROLLUPS': MQWriter.rollups is not None,
+        'PACKET_PARTITION_INTERVAL': MQWriter.partitioner is not None,
+        'SPOOL_DIR': MQWriter.SPOOL_DIR,
+    }
+    for setting, enabled in unsupported.items():
+        if enabled:
+            raise ValueError(f'{setting} is not supported by the asyncio runtime')
+
+
+async def run():
+    check_settings()
+    if MQWriter.METRICS_PORT:
+        start_metrics_server(MQWriter.METRICS_PORT)
+    MQWriter.init_collector_message_manager()
+    pool = await asyncpg.create_pool(host=DB_HOST, port=int(DB_PORT), user=DB_USERNAME, password=DB_PASSWORD,
+                                     database=DB_NAME, min_size=1,
+                                     max_size=int(os.environ.get('ASYNC_DB_POOL_SIZE', 4)))
+    connection = await aio_pika.connect_robust(host=os.environ["RABBITMQ_HOST"],
+                                               port=int(os.environ["RABBITMQ_PORT"]),
+                                               login=os.environ["RABBITMQ_DEFAULT_USER"],
+                                               password=os.environ["RABBITMQ_DEFAULT_PASS"])
+    try:
+        channel = await connection.channel()
+        await channel.set_qos(prefetch_count=MQWriter.PREFETCH_COUNT)
+        queues = await declare_queues(channel)
+
+        writer = AsyncPacketWriter(pool, max_rows=MQWriter.BATCH_LENGHT, max_age=MQWriter.WRITE_TIMEOUT,
+                                   max_bytes=MQWriter.BATCH_MAX_BYTES, ack_mode=MQWriter.ACK_MODE,
+                                   max_pending_writes=int(os.environ.get('ASYNC_MAX_PENDING_WRITES', 8)),
+                                   deduplicator=MQWriter.deduplicator,
+                                   adaptive=MQWriter.batch_controller is not None,
+                                   isolate_failures=MQWriter.packet_writer.isolate_failures,
+                                   dead_letter_table=MQWriter.packet_writer.dead_letter_table,
+                                   logger=logging.getLogger())
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+
+        if writer.controller is not None:
+            adjuster = loop.create_task(adjust_batches(writer, channel, queues, MQWriter.BATCH_ADAPTIVE_INTERVAL))
+        consumer_tags = [await queue.consume(writer.on_message) for queue in queues]
+        logging.info(f"consuming messages on queues {', '.join(queue.name for queue in queues)} (asyncio)")
+        await stop.wait()
+        if writer.controller is not None:
+            adjuster.cancel()
+
+        for queue, consumer_tag in zip(queues, consumer_tags):
+            await queue.cancel(consumer_tag)
+        await writer.drain()
+    finally:
+        await connection.close()
+        await pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
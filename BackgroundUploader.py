@@ -0,0 +1,106 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BackgroundUploader:
+
+    def __init__(self, workers=4, queue_depth=16, max_retries=3, backoff=0.5, logger=None):
+        """
+        Initializes the instance. Tasks are run by a pool of threads; when workers + queue_depth tasks are pending,
+        submit blocks until one of them finishes, throttling the caller
+        :param workers: number of upload threads. With 0, tasks are run synchronously by submit
+        :param queue_depth: number of tasks that can wait for a free thread
+        :param max_retries: number of times a failed task is retried
+        :param backoff: seconds to wait before the first retry. The delay doubles on every retry
+        :param logger: logger instance (logging library) to use
+        """
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='uploader') if workers > 0 else None
+        self.slots = threading.BoundedSemaphore(workers + queue_depth) if workers > 0 else None
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.failed = 0
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def submit(self, fn, *args):
+        """
+        Schedules fn(*args), blocking while the queue is full
+        :param fn: function doing the upload. It's retried if it raises
+        :return: nothing
+        """
+        if self.executor is None:
+            self.run(fn, *args)
+            return
+        self.slots.acquire()
+        with self.idle:
+            self.pending += 1
+        try:
+            self.executor.submit(self.run_pending, fn, *args)
+        except Exception:
+            self.done()
+            raise
+
+    def run_pending(self, fn, *args):
+        try:
+            self.run(fn, *args)
+        finally:
+            self.done()
+
+    def done(self):
+        with self.idle:
+            self.pending -= 1
+            self.idle.notify_all()
+        self.slots.release()
+
+    def run(self, fn, *args):
+        for attempt in range(self.max_retries + 1):
+            try:
+                fn(*args)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    with self.idle:
+                        self.failed += 1
+                    self.log(logging.ERROR, f'Upload failed after {attempt + 1} attempts: {e}')
+                    return
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                self.log(logging.WARNING, f'Upload failed ({e}), retrying in {delay:.2f} s')
+                time.sleep(delay)
+
+    def in_flight(self):
+        """
+        :return: number of tasks queued or running
+        """
+        return self.pending
+
+    def wait(self):
+        """
+        Waits until every submitted task finished
+        :return: nothing
+        """
+        with self.idle:
+            self.idle.wait_for(lambda: self.pending == 0)
+
+    def shutdown(self):
+        """
+        Waits for the submitted tasks and stops the threads
+        :return: nothing
+        """
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
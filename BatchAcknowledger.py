@@ -0,0 +1,117 @@
+import logging
+import time
+
+# errors (of psycopg2, sqlalchemy or asyncpg) raised when the database can't be reached, not because of the batch
+TRANSIENT_ERROR_NAMES = {'OperationalError', 'InterfaceError', 'PostgresConnectionError', 'CannotConnectNowError'}
+
+
+def is_transient_error(error):
+    """
+    :param error: exception that made a batch fail
+    :return: True if the batch may succeed later unchanged (the database or the disk are not available)
+    """
+    if isinstance(error, OSError):
+        return True
+    return any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__)
+
+
+class BatchAcknowledger:
+
+    def __init__(self, channel=None, requeue=True, backoff=1, max_backoff=30, sleep=None, logger=None):
+        """
+        Initializes the instance. Deliveries are tracked while their packets are buffered and are acknowledged
+        in bulk (multiple=True) once the batch containing them was committed.
+        Deliveries are expected to be consumed in order from a single channel
+        :param channel: pika channel the deliveries come from
+        :param requeue: whether deliveries of batches that failed because of their content are requeued. Batches
+        made only of redelivered messages are not requeued, so a poison batch can't loop forever. Batches that
+        failed because of a transient error (e.g. the database is down) are always requeued
+        :param backoff: seconds waited after the first transient failure before taking more deliveries. The delay
+        doubles on every consecutive transient failure
+        :param max_backoff: maximum seconds waited after a transient failure
+        :param sleep: function used to wait. Defaults to the sleep of the channel connection, which keeps serving
+        heartbeats, or time.sleep
+        :param logger: logger instance (logging library) to use
+        """
+        self.channel = channel
+        self.requeue = requeue
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.logger = logger
+        # consecutive batches that failed because of a transient error
+        self.transient_failures = 0
+        # highest delivery tag not yet acknowledged
+        self.last_tag = None
+        self.all_redelivered = True
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def attach(self, channel, prefetch_count=None):
+        """
+        Sets the channel used to acknowledge, and its prefetch count
+        :param channel: pika channel
+        :param prefetch_count: maximum number of unacknowledged deliveries. Must be greater than the batch size,
+        or batches will only be flushed by age
+        :return: nothing
+        """
+        self.channel = channel
+        if prefetch_count:
+            channel.basic_qos(prefetch_count=prefetch_count)
+
+    def track(self, method):
+        """
+        Registers a delivery whose acknowledgement is deferred until the next batch is settled
+        :param method: pika method frame of the delivery
+        :return: nothing
+        """
+        self.last_tag = method.delivery_tag
+        self.all_redelivered = self.all_redelivered and method.redelivered
+
+    def has_pending(self):
+        return self.last_tag is not None
+
+    def settle(self, success, error=None):
+        """
+        Acknowledges (or rejects, if the batch failed) every tracked delivery. After a transient failure, waits
+        before returning so the requeued deliveries are not retried right away
+        :param success: True if the batch was committed
+        :param error: exception that made the batch fail
+        :return: nothing
+        """
+        transient = not success and is_transient_error(error)
+        self.transient_failures = self.transient_failures + 1 if transient else 0
+        if self.last_tag is None:
+            return
+        tag = self.last_tag
+        requeue = transient or (self.requeue and not self.all_redelivered)
+        self.last_tag = None
+        self.all_redelivered = True
+        try:
+            if success:
+                self.channel.basic_ack(delivery_tag=tag, multiple=True)
+            else:
+                self.log(logging.WARNING, f'Rejecting deliveries up to {tag} (requeue={requeue})')
+                self.channel.basic_nack(delivery_tag=tag, multiple=True, requeue=requeue)
+        except Exception as e:
+            self.log(logging.ERROR, f'There was an error settling deliveries up to {tag}: {e}')
+        if transient:
+            delay = min(self.backoff * 2 ** (self.transient_failures - 1), self.max_backoff)
+            self.log(logging.WARNING, f'The batch failed with a transient error ({error}), waiting {delay} s')
+            self.wait(delay)
+
+    def wait(self, seconds):
+        if self.sleep is not None:
+            self.sleep(seconds)
+        elif hasattr(getattr(self.channel, 'connection', None), 'sleep'):
+            self.channel.connection.sleep(seconds)
+        else:
+            time.sleep(seconds)
@@ -0,0 +1,151 @@
+import logging
+import time
+
+
+class BatchScheduler:
+
+    def __init__(self, flush_callback, max_rows=64, max_age=10, max_bytes=None, logger=None, clock=time.monotonic):
+        """
+        Initializes the instance. Rows are buffered until the batch reaches max_rows or max_bytes,
+        or until the oldest buffered row is max_age seconds old, whichever comes first
+        :param flush_callback: function called with the list of buffered rows when the batch must be written
+        :param max_rows: maximum number of rows in a batch
+        :param max_age: maximum number of seconds a row may wait in the buffer
+        :param max_bytes: maximum approximate size of a batch in bytes. None to disable the limit
+        :param logger: logger instance (logging library) to use
+        :param clock: function returning the current time in seconds
+        """
+        self.flush_callback = flush_callback
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.clock = clock
+        self.connection = None
+        self.rows = []
+        self.bytes = 0
+        # time when the oldest buffered row was added
+        self.oldest = None
+        self.timer = None
+        self.flushing = False
+        # rows added since the scheduler was created
+        self.added = 0
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def attach(self, connection):
+        """
+        Uses the connection ioloop (call_later/remove_timeout) to flush batches when they get too old.
+        Timers run from inside process_data_events, so they never interrupt a callback or a database write
+        :param connection: pika connection (BlockingConnection or any connection with call_later)
+        :return: nothing
+        """
+        self.cancel_timer()
+        self.connection = connection
+        if self.oldest is not None:
+            self.schedule(self.max_age - (self.clock() - self.oldest))
+
+    def add(self, row, size=0):
+        """
+        Adds a row to the batch, flushing it if any of the limits is reached
+        :param row: row to buffer
+        :param size: approximate size of the row in bytes
+        :return: nothing
+        """
+        if self.oldest is None:
+            self.oldest = self.clock()
+            self.schedule(self.max_age)
+        self.rows.append(row)
+        self.bytes += size
+        self.added += 1
+        if self.is_full() or self.is_expired():
+            self.flush()
+
+    def resize(self, max_rows, max_age):
+        """
+        Changes the limits of the batches. The buffered rows are flushed at once if they reach the new limits
+        :param max_rows: maximum number of rows in a batch
+        :param max_age: maximum number of seconds a row may wait in the buffer
+        :return: nothing
+        """
+        self.max_rows = max_rows
+        self.max_age = max_age
+        if self.oldest is None:
+            return
+        if self.is_full() or self.is_expired():
+            self.flush()
+        else:
+            self.cancel_timer()
+            self.schedule(self.max_age - (self.clock() - self.oldest))
+
+    def is_full(self):
+        return len(self.rows) >= self.max_rows or (self.max_bytes is not None and self.bytes >= self.max_bytes)
+
+    def is_expired(self):
+        return self.oldest is not None and self.clock() - self.oldest >= self.max_age
+
+    def poll(self):
+        """
+        Flushes the batch if the oldest row reached max_age. Useful when no connection is attached
+        :return: nothing
+        """
+        if self.is_expired():
+            self.flush()
+
+    def flush(self):
+        """
+        Hands the buffered rows to the flush callback. The buffer is emptied before calling it, so rows added
+        while the callback is running go to the next batch. Exceptions raised by the callback are propagated
+        :return: nothing
+        """
+        if self.flushing:
+            return
+        self.cancel_timer()
+        rows = self.rows
+        self.rows = []
+        self.bytes = 0
+        self.oldest = None
+        if len(rows) == 0:
+            return
+        self.flushing = True
+        try:
+            self.flush_callback(rows)
+        finally:
+            self.flushing = False
+            # rows may have arrived while flushing
+            if self.oldest is not None:
+                self.schedule(self.max_age - (self.clock() - self.oldest))
+
+    def schedule(self, delay):
+        if self.connection is None or self.timer is not None:
+            return
+        self.timer = self.connection.call_later(max(delay, 0), self.on_timer)
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            if self.connection is not None:
+                self.connection.remove_timeout(self.timer)
+            self.timer = None
+
+    def on_timer(self):
+        self.timer = None
+        if self.oldest is None:
+            return
+        if not self.is_expired():
+            self.schedule(self.max_age - (self.clock() - self.oldest))
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            self.log(logging.ERROR, f'There was an error flushing the batch on timeout: {e}')
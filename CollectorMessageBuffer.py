@@ -0,0 +1,130 @@
+import time
+from collections import defaultdict
+
+
+class CollectorMessageBuffer:
+
+    def __init__(self, memory_budget=None, max_age=None, eviction_policy='largest', clock=time.monotonic):
+        """
+        Initializes the instance. Keeps the messages of every collector together with their approximate size
+        :param memory_budget: approximate number of bytes that may be buffered for all the collectors. None for no limit
+        :param max_age: seconds the oldest message of a collector may stay in the buffer. None for no limit
+        :param eviction_policy: 'largest' or 'oldest'. Which collectors are flushed first when the budget is exceeded
+        :param clock: function returning the current time in seconds
+        """
+        if eviction_policy not in ('largest', 'oldest'):
+            raise ValueError(f'Unknown eviction policy {eviction_policy}')
+        self.memory_budget = memory_budget
+        self.max_age = max_age
+        self.eviction_policy = eviction_policy
+        self.clock = clock
+        # dictionary with key=dc_id, value=list of messages
+        self.messages = defaultdict(list)
+        self.sizes = defaultdict(int)
+        # time when the oldest buffered message of each collector was added. Insertion order is age order
+        self.oldest = {}
+        self.total_bytes = 0
+        self.total_messages = 0
+
+    def add(self, data_collector_id, messages):
+        """
+        Appends messages to the buffer of a collector
+        :param data_collector_id: id of the collector
+        :param messages: list of messages
+        :return: nothing
+        """
+        if len(messages) == 0:
+            return
+        size = sum(approximate_size(msg) for msg in messages)
+        self.messages[data_collector_id].extend(messages)
+        self.sizes[data_collector_id] += size
+        self.total_bytes += size
+        self.total_messages += len(messages)
+        if data_collector_id not in self.oldest:
+            self.oldest[data_collector_id] = self.clock()
+
+    def clear(self, data_collector_id):
+        """
+        Empties the buffer of a collector
+        :param data_collector_id: id of the collector
+        :return: nothing
+        """
+        messages = self.messages[data_collector_id]
+        self.total_messages -= min(len(messages), self.total_messages)
+        self.total_bytes -= min(self.sizes.pop(data_collector_id, 0), self.total_bytes)
+        self.oldest.pop(data_collector_id, None)
+        messages.clear()
+
+    def remove(self, data_collector_id):
+        """
+        Empties the buffer of a collector and forgets it
+        :param data_collector_id: id of the collector (or any other key of the buffer)
+        :return: nothing
+        """
+        self.clear(data_collector_id)
+        self.messages.pop(data_collector_id, None)
+
+    def expired(self):
+        """
+        :return: list with the collectors whose oldest message is older than max_age
+        """
+        if self.max_age is None:
+            return []
+        limit = self.clock() - self.max_age
+        expired = []
+        for data_collector_id, added in self.oldest.items():
+            if added > limit:
+                break
+            expired.append(data_collector_id)
+        return expired
+
+    def over_budget(self, low_watermark=0.8):
+        """
+        When the memory budget is exceeded, selects collectors to flush, following the eviction policy,
+        until the usage goes under low_watermark * memory_budget
+        :param low_watermark: fraction of the budget to go back to, so evictions don't happen on every message
+        :return: list of collectors to flush
+        """
+        if self.memory_budget is None or self.total_bytes <= self.memory_budget:
+            return []
+        if self.eviction_policy == 'largest':
+            candidates = sorted(self.sizes, key=self.sizes.get, reverse=True)
+        else:
+            candidates = list(self.oldest)
+        selected = []
+        remaining = self.total_bytes
+        for data_collector_id in candidates:
+            if remaining <= self.memory_budget * low_watermark:
+                break
+            selected.append(data_collector_id)
+            remaining -= self.sizes[data_collector_id]
+        return selected
+
+    def get_usage(self):
+        """
+        :return: dict with the current usage of the buffer
+        """
+        now = self.clock()
+        return {
+            'collectors': len(self.oldest),
+            'messages': self.total_messages,
+            'bytes': self.total_bytes,
+            'memory_budget': self.memory_budget,
+            'oldest_age': now - next(iter(self.oldest.values())) if self.oldest else 0,
+            'largest_collector_bytes': max(self.sizes.values()) if self.sizes else 0,
+        }
+
+
+def approximate_size(obj):
+    """
+    Estimates the size of the json representation of an object, without serializing it
+    :param obj: json serializable object
+    :return: approximate number of bytes
+    """
+    if isinstance(obj, str):
+        return len(obj) + 2
+    if isinstance(obj, dict):
+        return 2 + sum(len(str(key)) + 4 + approximate_size(value) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return 2 + sum(approximate_size(value) + 1 for value in obj)
+    return 8
@@ -1,24 +1,29 @@
 import datetime
-import gzip
-import io
-import json
 import logging
+import os
+import time
 from collections import defaultdict
 
+from ArchiveEncoder import ArchiveEncoder
+from Metrics import ARCHIVE_ENCODE_SECONDS
+from Profiler import PROFILER
+
 
 class LogCollectorMessagesManager:
 
-    def __init__(self, maximum_msgs_per_collector=500, logger=None):
+    def __init__(self, maximum_msgs_per_collector=500, encoder=None, logger=None):
         """
         Initializes the instance
         :param aws_access_key: public aws api access key
         :param aws_secret_key: pricate aws api access key
         :param bucket_name: name of the base bucket to use
         :param maximum_msgs_per_collector: maximum number of messages to keep in memory before flushing to log
+        :param encoder: ArchiveEncoder or ParquetArchiveEncoder used to encode the messages. Defaults to gzip json
         :param logger: logger instance (logging library) to use
         """
         self.logger = logger
         self.MAX_MSGS_PER_COLLECTOR = maximum_msgs_per_collector
+        self.encoder = encoder or ArchiveEncoder()
         # dictionary with key=dc_id, value=list of messages
         self.messages = defaultdict(list)
 
@@ -33,12 +38,13 @@ class LogCollectorMessagesManager:
             self.logger.log(level, message)
 
 
-    def save_collector_messages(self, data_collector_id, messages):
+    def save_collector_messages(self, data_collector_id, messages, dt=None):
         """
         Add messages to the internal dictionary. If the resultant number of messages is greater than MAX_MSGS_PER_COLLECTOR,
         the existing ones are sent to log first and the new ones will be saved to the dictionary only
         :param data_collector_id: id of the collector from which the messages came from
         :param messages: list of messages
+        :param dt: datetime of the messages. Not used: files are named after the flush time
         :return: nothing. Messages are saved to internal dictionary, potentially triggering a sending to log
         """
         self.log(logging.DEBUG, f'Adding {len(messages)} messages to collector {data_collector_id}')
@@ -68,12 +74,12 @@ class LogCollectorMessagesManager:
         self.log(logging.DEBUG, f'sending {len(messages)} messages for collector {data_collector_id} to log')
 
         filename = self.get_filename(data_collector_id, dt)
-        # zips the data to a memory file, then copy the file to log bucket
-        with gzip.GzipFile(filename=filename, mode='wb') as gz:
-            for msg in messages:
-                # write one json per line so it can be consumed by spark easily
-                json_str = json.dumps(msg)
-                gz.write(bytes(json_str + '\n', encoding='utf-8'))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # compresses the data to the file
+        start = time.perf_counter()
+        with open(filename, 'wb') as f, PROFILER.stage('archive_encode'):
+            self.encoder.encode_to(messages, f)
+        ARCHIVE_ENCODE_SECONDS.observe(time.perf_counter() - start)
         self.messages[data_collector_id].clear()
 
     def flush_all(self):
@@ -85,6 +91,14 @@ class LogCollectorMessagesManager:
         for id in self.messages:
             self.save_messages(id, dt=datetime.datetime.now())
 
+    def get_buffered_counts(self):
+        """
+        Number of buffered messages per collector. Safe to call from other threads
+        :return: dict with key=dc_id, value=number of messages
+        """
+        return {data_collector_id: len(messages) for data_collector_id, messages in list(self.messages.items())
+                if len(messages) > 0}
+
     def get_filename(self, data_collector_id, dt):
         """
         Constructs the filename to use for a messages packet to send to log
@@ -92,4 +106,4 @@ class LogCollectorMessagesManager:
         :param dt: datetime to use for the packet
         :return: string with the complete name of the file (prefix+filename+ext)
         """
-        return f'year={dt.year:04}/month={dt.year:04}{dt.month:02}/day={dt.year:04}{dt.month:02}{dt.day:02}/collector={data_collector_id}/messages_collector_{data_collector_id}_{dt.strftime("%Y-%m-%d %H:%M:%S")}.json.gz'
+        return f'year={dt.year:04}/month={dt.year:04}{dt.month:02}/day={dt.year:04}{dt.month:02}{dt.day:02}/collector={data_collector_id}/messages_collector_{data_collector_id}_{dt.strftime("%Y-%m-%d %H:%M:%S")}{self.encoder.extension}'
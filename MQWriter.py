@@ -1,11 +1,30 @@
 import atexit
 
-import pika, os, logging, json, signal
-import dateutil.parser as dp
+import pika, os, logging, signal, time
+from datetime import datetime, timezone
 
+from AdaptiveBatchController import AdaptiveBatchController
+from ArchiveEncoder import ArchiveEncoder
+from BatchAcknowledger import BatchAcknowledger
+from BatchScheduler import BatchScheduler
+from Metrics import (BATCH_MAX_AGE, BATCH_MAX_ROWS, BATCH_SIZE, BATCHES_COMMITTED, BATCHES_ROLLED_BACK,
+                     COLLECTOR_BUFFERED_MESSAGES, FLUSH_SECONDS, MESSAGES_CONSUMED, PACKETS_DEDUPLICATED,
+                     PACKETS_INSERTED, PACKETS_REJECTED, WRITE_QUEUE_DEPTH, start_metrics_server)
+from PacketBulkWriter import MESSAGES_COLUMN, get_packet_writer
+from PacketDecoder import COLUMN_INDEX, PACKET_COLUMNS, decode_message, decode_packet, restore_row
+from PacketDeduplicator import PacketDeduplicator
+from PacketPartitions import PacketPartitioner
+from PacketRollups import PacketRollups
+from PacketSpool import PacketSpool
+from Profiler import PROFILER
+from ReferenceCache import ReferenceCache
+from ParquetArchiveEncoder import ParquetArchiveEncoder
 from S3CollectorMessagesManager import S3CollectorMessagesManager
-from auditing.db import engine, session
-from auditing.db.Models import Packet
+from Sharding import QUEUE_NAME, owned_shards, parse_shard_indexes, shard_queue_name
+from WorkerPool import WorkerCounters, WorkerPool
+from auditing.db import check_connection, engine
+from auditing.db.Models import DeviceRollup, GatewayRollup, Packet
+from auditing.db.migrate import find_missing
 
 if os.environ["ENVIRONMENT"] == "DEV":
     logging.getLogger().setLevel(logging.DEBUG)
@@ -17,101 +36,253 @@ else:
     logging.getLogger().setLevel(logging.INFO)
 
 CollectorMessageManager = None
+# messages consumed and packets written by this process
+counters = WorkerCounters()
+DATE_INDEX = COLUMN_INDEX['date']
 
 
-def save_messages(messages, data_collector_id, packet_id):
+def save_messages(messages, data_collector_id, packet_id, dt=None):
     global CollectorMessageManager
     if CollectorMessageManager:
         # Save the message/s
+        timestamp = (dt or datetime.now(timezone.utc)).isoformat()
         for message in messages:
             # In case a packet was instantiated, relate it with the message
             # if not, packet_id will be null. That's ok but we still want the property in the json
             message['packet_id'] = packet_id
-        CollectorMessageManager.save_collector_messages(data_collector_id, messages)
+            # date of the packet, or when the message was received
+            if 'timestamp' not in message:
+                message['timestamp'] = timestamp
+        CollectorMessageManager.save_collector_messages(data_collector_id, messages, dt)
 
-BATCH_LENGHT = 64
-DATA_MAX_LEN = 300
-WRITE_TIMEOUT = 10
-write_queue = []
+# Batches are written when they reach BATCH_LENGHT rows (or BATCH_MAX_BYTES, if set)
+# or when the oldest packet in the batch is WRITE_TIMEOUT seconds old
+BATCH_LENGHT = int(os.environ.get('BATCH_MAX_ROWS', 64))
+BATCH_MAX_BYTES = int(os.environ['BATCH_MAX_BYTES']) if os.environ.get('BATCH_MAX_BYTES') else None
+WRITE_TIMEOUT = float(os.environ.get('BATCH_MAX_AGE', 10))
+# With PACKET_PARTITION_INTERVAL ('day' or 'week') the packet table must be partitioned (see auditing.db.migrate).
+# Rows are written directly to their partition, partitions are created PACKET_PARTITION_PREMAKE intervals ahead
+# and the ones older than PACKET_PARTITION_RETENTION intervals (if set) are dropped
+PACKET_PARTITION_INTERVAL = os.environ.get('PACKET_PARTITION_INTERVAL') or None
+partitioner = PacketPartitioner(engine, PACKET_PARTITION_INTERVAL,
+                                premake=int(os.environ.get('PACKET_PARTITION_PREMAKE', 3)),
+                                retention=int(os.environ['PACKET_PARTITION_RETENTION']) if os.environ.get('PACKET_PARTITION_RETENTION') else None,
+                                logger=logging.getLogger()) if PACKET_PARTITION_INTERVAL else None
+# When COLLECTOR_MSGS_TABLE is set (e.g. collector_message), the raw messages of every packet are inserted in that
+# table, linked to the id of the packet, in the same transaction as the packet
+COLLECTOR_MSGS_TABLE = os.environ.get('COLLECTOR_MSGS_TABLE') or None
+WRITER_COLUMNS = PACKET_COLUMNS + ((MESSAGES_COLUMN,) if COLLECTOR_MSGS_TABLE else ())
+# DEDUP_MODE 'drop' writes a single copy of the packets received several times (heard by several gateways or
+# redelivered) within DEDUP_WINDOW seconds. 'collapse' also saves the gateway, rssi and lsnr of the copies of the
+# batch in the receptions column
+DEDUP_MODE = os.environ.get('DEDUP_MODE') or None
+deduplicator = PacketDeduplicator(DEDUP_MODE, window=float(os.environ.get('DEDUP_WINDOW', 5)),
+                                  max_entries=int(os.environ.get('DEDUP_MAX_ENTRIES', 100000)),
+                                  columns=WRITER_COLUMNS) if DEDUP_MODE else None
+# With REFERENCE_CACHE=true the data collector of every packet is checked against a cache of the data_collector
+# table before writing: packets of unknown collectors are rejected and the organization_id is taken from the collector.
+# Collectors are reloaded after REFERENCE_CACHE_TTL seconds
+reference_cache = ReferenceCache(engine, ttl=float(os.environ.get('REFERENCE_CACHE_TTL', 300)),
+                                 max_entries=int(os.environ.get('REFERENCE_CACHE_MAX_ENTRIES', 100000)),
+                                 columns=WRITER_COLUMNS, logger=logging.getLogger()) \
+    if os.environ.get('REFERENCE_CACHE', 'false').lower() == 'true' else None
+# PACKET_ROLLUPS=true upserts the per device and per gateway aggregates of every batch into device_rollup and
+# gateway_rollup. Frame counter gaps between batches are found for the last PACKET_ROLLUPS_MAX_DEVICES devices
+rollups = PacketRollups(columns=deduplicator.columns if deduplicator else WRITER_COLUMNS,
+                        max_devices=int(os.environ.get('PACKET_ROLLUPS_MAX_DEVICES', 100000))) \
+    if os.environ.get('PACKET_ROLLUPS', 'false').lower() == 'true' else None
+# Strategy used to insert the packets: 'copy', 'values' or 'executemany'
+# Rows that make a batch fail are isolated and saved, with their error, to PACKET_DEAD_LETTER_TABLE (if not empty)
+packet_writer = get_packet_writer(engine, os.environ.get('PACKET_WRITE_STRATEGY', 'copy'),
+                                  isolate_failures=os.environ.get('PACKET_ISOLATE_FAILURES', 'true').lower() == 'true',
+                                  dead_letter_table=os.environ.get('PACKET_DEAD_LETTER_TABLE', 'packet_dead_letter') or None,
+                                  columns=deduplicator.columns if deduplicator else WRITER_COLUMNS,
+                                  partitioner=partitioner, message_table=COLLECTOR_MSGS_TABLE, rollups=rollups,
+                                  logger=logging.getLogger())
+# 'immediate' acknowledges every delivery as soon as its packet is buffered.
+# 'batch' acknowledges the deliveries in bulk once the batch containing their packets was committed
+ACK_MODE = os.environ.get('ACK_MODE', 'immediate')
+PREFETCH_COUNT = int(os.environ.get('PREFETCH_COUNT', 4 * BATCH_LENGHT))
+acknowledger = BatchAcknowledger(requeue=os.environ.get('ACK_REQUEUE_FAILED', 'true').lower() == 'true',
+                                 logger=logging.getLogger())
 
 
-def timeout_writer(signum, frame):
-    global write_queue
-    if len(write_queue) != 0:
-        engine.execute(Packet.__table__.insert(), write_queue)
-        write_queue = []
-        session.commit()
+# When SPOOL_DIR is set, batches are appended to a local spool and acknowledged right away; a background thread
+# replays the spool into the database, so database outages don't block the consumer. It must be a persistent volume
+SPOOL_DIR = os.environ.get('SPOOL_DIR')
+spool = None
+
+
+def insert_packets(rows):
+    BATCH_SIZE.observe(len(rows))
+    start = time.perf_counter()
+    try:
+        with PROFILER.stage('write_batch'):
+            rejected = packet_writer.write(rows)
+    except Exception:
+        BATCHES_ROLLED_BACK.inc()
+        raise
+    counters.packets.value += len(rows) - len(rejected)
+    elapsed = time.perf_counter() - start
+    FLUSH_SECONDS.observe(elapsed)
+    if batch_controller is not None:
+        batch_controller.record_flush(len(rows), elapsed)
+    PACKETS_INSERTED.inc(len(rows) - len(rejected))
+    PACKETS_REJECTED.inc(len(rejected))
+    BATCHES_COMMITTED.inc()
+
+
+def write_packets(rows):
+    if reference_cache is not None:
+        with PROFILER.stage('check_references'):
+            rows, rejected = reference_cache.check(rows)
+        for row, error in rejected:
+            logging.error(f'Rejected packet {row}: {error}')
+            packet_writer.reject(packet_writer.as_dict(row), error)
+        PACKETS_REJECTED.inc(len(rejected))
+    if deduplicator is not None:
+        received = len(rows)
+        with PROFILER.stage('deduplicate'):
+            rows = deduplicator.process(rows)
+        PACKETS_DEDUPLICATED.inc(received - len(rows))
+    try:
+        if spool is not None:
+            with PROFILER.stage('spool_append'):
+                spool.append(rows)
+        else:
+            insert_packets(rows)
+    except Exception as e:
+        acknowledger.settle(success=False, error=e)
+        raise
+    if deduplicator is not None:
+        # the packets of a failed batch may be redelivered: they are only remembered once written
+        deduplicator.commit()
+    acknowledger.settle(success=True)
+
+
+def orphaned_spool_dirs(worker_id=None):
+    """
+    Spool directories left by a previous run with a different number of worker processes, replayed by the first
+    worker (or by the single process): the worker-<id> subdirectories of the workers that no longer exist, and with
+    several workers, SPOOL_DIR itself
+    :param worker_id: id of the worker process, None when running a single process
+    :return: list of directories
+    """
+    if worker_id not in (None, 0):
+        return []
+    orphaned = [] if worker_id is None else [SPOOL_DIR]
+    for name in sorted(os.listdir(SPOOL_DIR)) if os.path.isdir(SPOOL_DIR) else ():
+        number = name[len('worker-'):]
+        if name.startswith('worker-') and number.isdigit() and (worker_id is None or int(number) >= processes):
+            orphaned.append(os.path.join(SPOOL_DIR, name))
+    return orphaned
+
+
+def init_spool(worker_id=None):
+    global spool
+    if not SPOOL_DIR:
+        return
+    directory = os.path.join(SPOOL_DIR, f'worker-{worker_id}') if worker_id is not None else SPOOL_DIR
+    spool = PacketSpool(directory, insert_packets, decode_row=restore_row, adopt=orphaned_spool_dirs(worker_id),
+                        segment_bytes=int(os.environ.get('SPOOL_SEGMENT_BYTES', 64 * 1024 * 1024)),
+                        segment_age=float(os.environ.get('SPOOL_SEGMENT_AGE', 5)),
+                        drain_batch=int(os.environ.get('SPOOL_DRAIN_BATCH', 5000)),
+                        fsync=os.environ.get('SPOOL_FSYNC', 'true').lower() == 'true',
+                        logger=logging.getLogger())
+    spool.start()
+
+
+scheduler = BatchScheduler(write_packets, max_rows=BATCH_LENGHT, max_age=WRITE_TIMEOUT, max_bytes=BATCH_MAX_BYTES,
+                           logger=logging.getLogger())
+WRITE_QUEUE_DEPTH.set_function(lambda: len(scheduler))
+BATCH_MAX_ROWS.set_function(lambda: scheduler.max_rows)
+BATCH_MAX_AGE.set_function(lambda: scheduler.max_age)
+# With BATCH_ADAPTIVE=true, BATCH_MAX_ROWS and BATCH_MAX_AGE are only the initial limits: every BATCH_ADAPTIVE_INTERVAL
+# seconds they are tuned from the insert time per row, the packet rate and the queue depth, so packets are committed
+# within BATCH_LATENCY_SLO seconds with the largest batches possible. See AdaptiveBatchController
+BATCH_ADAPTIVE_INTERVAL = float(os.environ.get('BATCH_ADAPTIVE_INTERVAL', 5))
+
+
+def get_batch_controller(batch_scheduler):
+    """
+    :return: AdaptiveBatchController tuning the scheduler, or None if BATCH_ADAPTIVE is not enabled
+    """
+    if os.environ.get('BATCH_ADAPTIVE', 'false').lower() != 'true':
+        return None
+    max_rows = int(os.environ.get('BATCH_ADAPTIVE_MAX_ROWS', 5000))
+    if ACK_MODE == 'batch':
+        # no more than PREFETCH_COUNT packets are delivered until their batch is committed
+        max_rows = min(max_rows, PREFETCH_COUNT)
+    return AdaptiveBatchController(batch_scheduler, slo=float(os.environ.get('BATCH_LATENCY_SLO', 2)),
+                                   min_rows=int(os.environ.get('BATCH_ADAPTIVE_MIN_ROWS', 16)), max_rows=max_rows,
+                                   min_age=float(os.environ.get('BATCH_ADAPTIVE_MIN_AGE', 0.1)),
+                                   max_age=float(os.environ.get('BATCH_ADAPTIVE_MAX_AGE', WRITE_TIMEOUT)),
+                                   logger=logging.getLogger())
+
+
+batch_controller = get_batch_controller(scheduler)
+# Port of the HTTP metrics endpoint. Disabled if not set. Worker processes listen on METRICS_PORT + worker id
+METRICS_PORT = int(os.environ['METRICS_PORT']) if os.environ.get('METRICS_PORT') else None
+# PROFILE=true profiles the writer from the start. SIGUSR1 toggles profiling at runtime (the results are dumped to
+# PROFILE_DIR when it's disabled) and SIGUSR2 dumps the results so far. See Profiler
+PROFILER.configure(sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01)),
+                   interval=float(os.environ.get('PROFILE_INTERVAL', 0.01)),
+                   output_dir=os.environ.get('PROFILE_DIR', '/tmp'), logger=logging.getLogger())
 
 
 def callback(ch, method, properties, body):
-    global write_queue
+    deferred = False
+    counters.messages.value += 1
+    MESSAGES_CONSUMED.inc()
+    # only the stages of some messages are timed, and none while profiling is disabled
+    trace = PROFILER.trace() if PROFILER.enabled else None
     try:
-        message = body.decode("utf-8")
         # Parse the JSON into a dict
-        data = json.loads(message)
-        
+        data = decode_message(body)
+        if trace:
+            trace.lap('decode_message')
+
         # This packet is a JSON object
         packet = data.get('packet')
         messages = data.get('messages')
+        row = None
 
         if packet:
-            packet = dict(
-                date=dp.parse(packet.get('date', None)),
-                topic=packet.get('topic', None),
-                data_collector_id=packet.get('data_collector_id', None),
-                organization_id=packet.get('organization_id', None),
-                gateway=packet.get('gateway', None),
-                tmst=packet.get('tmst', None),
-                chan=packet.get('chan', None),
-                rfch=packet.get('rfch', None),
-                freq=packet.get('freq', None),
-                stat=packet.get('stat', None),
-                modu=packet.get('modu', None),
-                datr=packet.get('datr', None),
-                codr=packet.get('codr', None),
-                lsnr=packet.get('lsnr', None),
-                rssi=packet.get('rssi', None),
-                size=packet.get('size', None),
-                data=packet['data'][0:DATA_MAX_LEN] if 'data' in packet else None,
-                m_type=packet.get('m_type', None),
-                major=packet.get('major', None),
-                mic=packet.get('mic', None),
-                join_eui=packet.get('join_eui', None),
-                dev_eui=packet.get('dev_eui', None),
-                dev_nonce=packet.get('dev_nonce', None),
-                dev_addr=packet.get('dev_addr', None),
-                adr=packet.get('adr', None),
-                ack=packet.get('ack', None),
-                adr_ack_req=packet.get('adr_ack_req', None),
-                f_pending=packet.get('f_pending', None),
-                class_b=packet.get('class_b', None),
-                f_count=packet.get('f_count', None),
-                f_opts=packet.get('f_opts', None),
-                f_port=packet.get('f_port', None),
-                error=packet['error'][0:DATA_MAX_LEN] if 'error' in packet else None,
-                latitude=packet.get('latitude', None),
-                longitude=packet.get('longitude', None),
-                altitude=packet.get('altitude', None),
-                app_name=packet.get('app_name', None),
-                dev_name=packet.get('dev_name', None),
-                gw_name=packet.get('gw_name', None)
-                )
-            write_queue.append(packet)
-            signal.signal(signal.SIGALRM, timeout_writer)
-            signal.alarm(WRITE_TIMEOUT)
-            
-        if len(write_queue) >= BATCH_LENGHT:
-            signal.alarm(0)
-            engine.execute(Packet.__table__.insert(), write_queue)
-            write_queue = []
-            session.commit()
-        
+            try:
+                row = decode_packet(packet)
+                if trace:
+                    trace.lap('decode_packet')
+            except Exception as e:
+                logging.error(f'There was an error decoding packet {packet}: {e}')
+                PACKETS_REJECTED.inc()
+                packet_writer.reject(packet, e)
+                row = None
+            if row is not None:
+                if COLLECTOR_MSGS_TABLE:
+                    row += ([(message.get('data_collector_id'), message.get('topic'), message.get('message'))
+                             for message in messages or ()],)
+                if ACK_MODE == 'batch':
+                    acknowledger.track(method)
+                    deferred = True
+                scheduler.add(row, size=len(body))
+                if trace:
+                    # includes writing the batch when it's full
+                    trace.lap('buffer_packet')
+
         if messages and len(messages) > 0:
-            save_messages(messages, messages[0].get('data_collector_id'), None)
+            save_messages(messages, messages[0].get('data_collector_id'), None,
+                          row[DATE_INDEX] if row is not None else None)
+            if trace:
+                trace.lap('save_messages')
     except Exception as e:
         logging.error(f"There was an error writing messages:\n{e}")
-        write_queue = []
-        session.rollback()
+
+    if ACK_MODE == 'batch' and not deferred and len(scheduler) > 0:
+        # Deliveries without packet are acknowledged together with the batch being buffered
+        acknowledger.track(method)
+        deferred = True
+    if deferred:
+        return
 
     try:
         ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -126,14 +297,31 @@ def exit_handler():
         CollectorMessageManager.flush_all()
 
 
+# Approximate bytes of raw messages buffered for all the collectors, and seconds a collector's messages may wait
+COLLECTOR_MSGS_MEMORY_BUDGET = int(os.environ['COLLECTOR_MSGS_MEMORY_BUDGET']) if os.environ.get('COLLECTOR_MSGS_MEMORY_BUDGET') else None
+COLLECTOR_MSGS_MAX_AGE = float(os.environ['COLLECTOR_MSGS_MAX_AGE']) if os.environ.get('COLLECTOR_MSGS_MAX_AGE') else None
+# 'hour' or 'day' groups the raw messages by the time window of their packet instead of by flush time
+COLLECTOR_MSGS_WINDOW = os.environ.get('COLLECTOR_MSGS_WINDOW') or None
+# messages of a collector buffered before they are archived. Larger values make fewer and larger archives
+COLLECTOR_MSGS_PER_ARCHIVE = int(os.environ.get('COLLECTOR_MSGS_PER_ARCHIVE', 500))
+# 'json' (one json per line, compressed) or 'parquet' (requires pyarrow)
+COLLECTOR_MSGS_FORMAT = os.environ.get('COLLECTOR_MSGS_FORMAT', 'json')
 
 
+def get_archive_encoder():
+    if COLLECTOR_MSGS_FORMAT == 'parquet':
+        return ParquetArchiveEncoder(codec=os.environ.get('ARCHIVE_CODEC', 'zstd'),
+                                     level=int(os.environ['ARCHIVE_COMPRESSION_LEVEL']) if os.environ.get('ARCHIVE_COMPRESSION_LEVEL') else None,
+                                     schema=os.environ.get('PARQUET_SCHEMA', 'declared'),
+                                     row_group_size=int(os.environ.get('PARQUET_ROW_GROUP_SIZE', 100000)))
+    if COLLECTOR_MSGS_FORMAT != 'json':
+        raise ValueError(f'Unknown archive format {COLLECTOR_MSGS_FORMAT}. Valid options are: json, parquet')
+    return ArchiveEncoder(codec=os.environ.get('ARCHIVE_CODEC', 'gzip'),
+                          level=int(os.environ.get('ARCHIVE_COMPRESSION_LEVEL', 6)))
 
 
-
-try:
-    print("Starting PacketWriter")
-    atexit.register(exit_handler)
+def init_collector_message_manager(worker_id=None):
+    global CollectorMessageManager
     print("Initializing s3 manager")
     if(
         'AWS_ACCESS_KEY_ID' in os.environ and len(os.environ['AWS_ACCESS_KEY_ID'])>0 and
@@ -142,30 +330,250 @@ try:
         CollectorMessageManager = S3CollectorMessagesManager(aws_access_key=os.environ["AWS_ACCESS_KEY_ID"],
                                             aws_secret_key=os.environ["AWS_SECRET_ACCESS_KEY"],
                                             bucket_name=os.environ["AWS_COLLECTOR_MSGS_BUCKET"],
+                                            maximum_msgs_per_collector=COLLECTOR_MSGS_PER_ARCHIVE,
+                                            filename_suffix=f'_{worker_id}' if worker_id is not None else '',
+                                            upload_workers=int(os.environ.get('S3_UPLOAD_WORKERS', 4)),
+                                            upload_queue_depth=int(os.environ.get('S3_UPLOAD_QUEUE_DEPTH', 16)),
+                                            encoder=get_archive_encoder(),
+                                            memory_budget=COLLECTOR_MSGS_MEMORY_BUDGET,
+                                            max_age=COLLECTOR_MSGS_MAX_AGE,
+                                            eviction_policy=os.environ.get('COLLECTOR_MSGS_EVICTION_POLICY', 'largest'),
+                                            window=COLLECTOR_MSGS_WINDOW,
+                                            window_grace=float(os.environ.get('COLLECTOR_MSGS_WINDOW_GRACE', 300)),
                                             logger=logging.getLogger())
     # else:
     #     CollectorMessageManager = LogCollectorMessagesManager(logger=logging.getLogger())
+    if CollectorMessageManager:
+        COLLECTOR_BUFFERED_MESSAGES.set_function(CollectorMessageManager.get_buffered_counts)
 
 
-    print("Initializing rabbit connection")
-    rabbit_credentials = pika.PlainCredentials(os.environ["RABBITMQ_DEFAULT_USER"], os.environ["RABBITMQ_DEFAULT_PASS"])
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=os.environ["RABBITMQ_HOST"],
-                                  port=int(os.environ["RABBITMQ_PORT"]),
-                                  credentials=rabbit_credentials)
-    )
-    channel = connection.channel()
-    channel.queue_declare(queue='collectors_queue', durable=True)
-    channel.exchange_declare(exchange=os.environ["ENVIRONMENT"], exchange_type='direct')
-    channel.queue_bind(exchange=os.environ["ENVIRONMENT"], queue='collectors_queue')
-    channel.basic_consume(queue='collectors_queue', on_message_callback=callback)
-    logging.info("consuming messages on queue collectors_queue")
-    channel.start_consuming()
-except Exception as e:
-    logging.error(f'There was an error initializing PacketWriter: {e}')
-finally:
-    logging.info('Flushing messages to s3')
-    if CollectorMessageManager:
-        CollectorMessageManager.flush_all()
+def schedule_collector_messages_expiration(connection, interval=30):
+    # collectors that stopped sending messages are only flushed by age from this timer
+    def flush_expired():
+        try:
+            CollectorMessageManager.flush_expired()
+        except Exception as e:
+            logging.error(f'There was an error flushing expired collector messages: {e}')
+        connection.call_later(interval, flush_expired)
+    connection.call_later(interval, flush_expired)
+
+
+# With SHARD_COUNT > 1 packets are spread by collector over the queues collectors_queue.0 ... collectors_queue.<N-1>,
+# either by the publishers' routing key (see Sharding.shard_for) or by a consistent hash exchange on the
+# SHARD_HASH_HEADER header. This instance consumes the shards in SHARD_INDEX (e.g. '0-3', all by default), split
+# between its worker processes. Each shard has a single consumer, so the packets of a collector stay in order
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', 1))
+SHARD_MODE = os.environ.get('SHARD_MODE', 'routing-key')
+SHARD_INDEXES = parse_shard_indexes(os.environ.get('SHARD_INDEX'))
+SHARD_HASH_HEADER = os.environ.get('SHARD_HASH_HEADER', 'data_collector_id')
+# number of worker processes of this instance
+processes = 1
+
+
+def declare_queues(channel, worker_id=None):
+    """
+    Declares the exchange and the queues consumed by this worker, with their bindings
+    :param channel: pika channel
+    :param worker_id: id of the worker process, None when running a single process
+    :return: list with the names of the queues to consume
+    """
+    exchange = os.environ["ENVIRONMENT"]
+    channel.exchange_declare(exchange=exchange, exchange_type='direct')
+    if SHARD_COUNT <= 1:
+        channel.queue_declare(queue=QUEUE_NAME, durable=True)
+        channel.queue_bind(exchange=exchange, queue=QUEUE_NAME)
+        return [QUEUE_NAME]
+
+    shards = owned_shards(SHARD_COUNT, SHARD_INDEXES, worker_id, processes)
+    queues = []
+    if SHARD_MODE == 'consistent-hash':
+        # messages published to the environment exchange are hashed to the shard queues (one point per queue)
+        shard_exchange = f'{exchange}.{QUEUE_NAME}'
+        channel.exchange_declare(exchange=shard_exchange, exchange_type='x-consistent-hash', durable=True,
+                                 arguments={'hash-header': SHARD_HASH_HEADER})
+        channel.exchange_bind(destination=shard_exchange, source=exchange, routing_key=QUEUE_NAME)
+        for shard in shards:
+            queues.append(shard_queue_name(shard))
+            channel.queue_declare(queue=queues[-1], durable=True)
+            channel.queue_bind(exchange=shard_exchange, queue=queues[-1], routing_key='1')
+    elif SHARD_MODE == 'routing-key':
+        for shard in shards:
+            queues.append(shard_queue_name(shard))
+            channel.queue_declare(queue=queues[-1], durable=True)
+            channel.queue_bind(exchange=exchange, queue=queues[-1], routing_key=queues[-1])
+    else:
+        raise ValueError(f'Unknown shard mode {SHARD_MODE}. Valid options are: routing-key, consistent-hash')
+
+    if 0 in shards:
+        # the owner of shard 0 also drains the unsharded queue, which publishers that don't shard still use
+        channel.queue_declare(queue=QUEUE_NAME, durable=True)
+        if SHARD_MODE == 'consistent-hash':
+            channel.queue_unbind(exchange=exchange, queue=QUEUE_NAME, routing_key=QUEUE_NAME)
+        queues.append(QUEUE_NAME)
+    return queues
+
+
+def get_queue_depth(channel, queues):
+    """
+    :return: number of messages waiting in the queues, from passive declares. None if they could not be declared
+    """
+    try:
+        return sum(channel.queue_declare(queue=queue, passive=True).method.message_count for queue in queues)
+    except Exception as e:
+        logging.warning(f'Could not get the depth of the queues: {e}')
+        return None
+
+
+def schedule_batch_adjustment(connection, channel, queues, interval):
+    def adjust():
+        try:
+            batch_controller.adjust(get_queue_depth(channel, queues))
+        except Exception as e:
+            logging.error(f'There was an error adjusting the batch limits: {e}')
+        connection.call_later(interval, adjust)
+    connection.call_later(interval, adjust)
+
+
+def check_schema():
+    """
+    The writer doesn't run DDL: features whose tables were not created by auditing.db.migrate are disabled, instead
+    of failing every batch
+    """
+    if packet_writer.dead_letter_table and find_missing(engine, tables=[packet_writer.dead_letter_table]):
+        logging.error(f'Table {packet_writer.dead_letter_table} does not exist (run python -m auditing.db.migrate). '
+                      f'Rejected packets will only be logged')
+        packet_writer.dead_letter_table = None
+    if packet_writer.rollups is not None:
+        missing = find_missing(engine, tables=[DeviceRollup.__tablename__, GatewayRollup.__tablename__])
+        if missing:
+            logging.error(f'Tables {", ".join(missing)} do not exist (run python -m auditing.db.migrate). '
+                          f'Rollups are disabled')
+            packet_writer.rollups = None
+    if deduplicator is not None and deduplicator.collapse:
+        missing = find_missing(engine, columns=[(Packet.__tablename__, 'receptions')])
+        if missing:
+            logging.error(f'Column {missing[0]} does not exist: packets can\'t be written until '
+                          f'python -m auditing.db.migrate is run')
+
+
+def maintain_partitions():
+    try:
+        partitioner.maintain()
+    except Exception as e:
+        logging.error(f'There was an error maintaining the packet partitions: {e}')
+
+
+def schedule_partition_maintenance(connection, interval=3600):
+    def run_maintenance():
+        maintain_partitions()
+        connection.call_later(interval, run_maintenance)
+    connection.call_later(interval, run_maintenance)
+
+
+def consume(worker_id=None):
+    """
+    Consumes collectors_queue (or the shards owned by the worker) until the connection is closed or SIGTERM is received.
+    Buffered packets and collector messages are flushed before returning
+    :param worker_id: id of the worker process, None when running a single process
+    """
+    connection = None
+    try:
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT + (worker_id or 0))
+        init_collector_message_manager(worker_id)
+        init_spool(worker_id)
+        try:
+            check_connection(engine, logger=logging.getLogger())
+            check_schema()
+        except Exception as e:
+            # the spool (if enabled) keeps the packets until the database is back
+            logging.error(f'The database is not reachable: {e}')
+        if partitioner is not None:
+            maintain_partitions()
+        if reference_cache is not None:
+            try:
+                reference_cache.warm()
+            except Exception as e:
+                logging.error(f'Could not load the data collectors: {e}')
+
+        print("Initializing rabbit connection")
+        rabbit_credentials = pika.PlainCredentials(os.environ["RABBITMQ_DEFAULT_USER"], os.environ["RABBITMQ_DEFAULT_PASS"])
+        connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=os.environ["RABBITMQ_HOST"],
+                                      port=int(os.environ["RABBITMQ_PORT"]),
+                                      credentials=rabbit_credentials)
+        )
+        scheduler.attach(connection)
+        if CollectorMessageManager and (CollectorMessageManager.buffer.max_age is not None or COLLECTOR_MSGS_WINDOW):
+            schedule_collector_messages_expiration(connection)
+        if partitioner is not None:
+            schedule_partition_maintenance(connection)
+        channel = connection.channel()
+        if ACK_MODE == 'batch':
+            acknowledger.attach(channel, prefetch_count=PREFETCH_COUNT)
+        queues = declare_queues(channel, worker_id)
+        for queue in queues:
+            channel.basic_consume(queue=queue, on_message_callback=callback)
+        if batch_controller is not None:
+            schedule_batch_adjustment(connection, channel, queues, BATCH_ADAPTIVE_INTERVAL)
+
+        # stop_consuming is called from the connection loop, not from inside the signal handler
+        signal.signal(signal.SIGTERM, lambda signum, frame: connection.add_callback_threadsafe(channel.stop_consuming))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: connection.add_callback_threadsafe(PROFILER.toggle))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: connection.add_callback_threadsafe(PROFILER.dump))
+        if os.environ.get('PROFILE', 'false').lower() == 'true':
+            PROFILER.enable()
+        logging.info(f"consuming messages on queues {', '.join(queues)}")
+        channel.start_consuming()
+    except Exception as e:
+        logging.error(f'There was an error initializing PacketWriter: {e}')
+    finally:
+        logging.info('Writing buffered packets')
+        try:
+            scheduler.flush()
+            # packets rejected after the last batch
+            packet_writer.write([])
+        except Exception as e:
+            logging.error(f'There was an error writing the buffered packets: {e}')
+        if spool is not None:
+            # the segments that were not replayed yet are written on the next start
+            spool.stop(timeout=WRITE_TIMEOUT)
+        logging.info('Flushing messages to s3')
+        if CollectorMessageManager:
+            CollectorMessageManager.flush_all()
+        else:
+            logging.info('No collector message manager available. Messages will not be saved')
+        if connection is not None and connection.is_open:
+            connection.close()
+        if PROFILER.enabled:
+            # disables the profiler and dumps the results
+            PROFILER.toggle()
+
+
+def run_worker(worker_id, worker_counters):
+    global counters
+    counters = worker_counters
+    # connections inherited from the supervisor can't be shared with it
+    engine.dispose()
+    consume(worker_id)
+
+
+def main():
+    print("Starting PacketWriter")
+    # Number of consumer processes. 'auto' starts one per CPU
+    global processes
+    processes = os.environ.get('WRITER_PROCESSES', '1')
+    processes = (os.cpu_count() or 1) if processes == 'auto' else int(processes)
+    if SHARD_COUNT > 1:
+        # every worker must own at least one shard
+        processes = min(processes, len(owned_shards(SHARD_COUNT, SHARD_INDEXES)))
+    if processes == 1:
+        atexit.register(exit_handler)
+        consume()
     else:
-        logging.info('No collector message manager available. Messages will not be saved')
+        WorkerPool(run_worker, processes=processes, report_interval=int(os.environ.get('WRITER_REPORT_INTERVAL', 60)),
+                   logger=logging.getLogger()).run()
+
+
+if __name__ == '__main__':
+    main()
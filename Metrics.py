@@ -0,0 +1,202 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """
+        :return: list of (name, labels, value) tuples. labels is a tuple of (label, value) tuples
+        """
+        raise NotImplementedError
+
+    def expose(self):
+        """
+        :return: the metric in the prometheus text exposition format
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            if labels:
+                label_list = ','.join(f'{label}="{str(label_value)}"' for label, label_value in labels)
+                lines.append(f'{name}{{{label_list}}} {value}')
+            else:
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation):
+        super().__init__(name, documentation)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, (), self.value)]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, label=None):
+        """
+        :param label: name of the label, for gauges whose function returns a dict of label value -> value
+        """
+        super().__init__(name, documentation)
+        self.label = label
+        self.function = None
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """
+        The gauge value is computed when the metrics are collected
+        :param function: function returning the value (or a dict of label value -> value for labelled gauges)
+        """
+        self.function = function
+
+    def samples(self):
+        value = self.function() if self.function else self.value
+        if self.label is None:
+            return [(self.name, (), value)]
+        return [(self.name, ((self.label, label_value),), v) for label_value, v in value.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            samples.append((f'{self.name}_bucket', (('le', bound),), cumulative))
+        samples.append((f'{self.name}_sum', (), total))
+        samples.append((f'{self.name}_count', (), count))
+        return samples
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation):
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name, documentation, label=None):
+        return self.register(Gauge(name, documentation, label))
+
+    def histogram(self, name, documentation, buckets):
+        return self.register(Histogram(name, documentation, buckets))
+
+    def expose(self):
+        """
+        :return: all the metrics in the prometheus text exposition format
+        """
+        exposed = []
+        for metric in self.metrics:
+            try:
+                exposed.append(metric.expose())
+            except Exception as e:
+                logging.getLogger().error(f'There was an error collecting metric {metric.name}: {e}')
+        return '\n'.join(exposed) + '\n'
+
+
+REGISTRY = Registry()
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+MESSAGES_CONSUMED = REGISTRY.counter('packet_writer_messages_consumed_total', 'Messages consumed from the queue')
+PACKETS_INSERTED = REGISTRY.counter('packet_writer_packets_inserted_total', 'Packets inserted in the database')
+PACKETS_REJECTED = REGISTRY.counter('packet_writer_packets_rejected_total',
+                                    'Packets that could not be decoded or inserted, sent to the dead letter table')
+PACKETS_DEDUPLICATED = REGISTRY.counter('packet_writer_packets_deduplicated_total',
+                                        'Copies of packets (heard by several gateways or redelivered) not written')
+REFERENCE_CACHE_HITS = REGISTRY.counter('packet_writer_reference_cache_hits_total',
+                                        'Data collectors of a batch found in the reference cache')
+REFERENCE_CACHE_MISSES = REGISTRY.counter('packet_writer_reference_cache_misses_total',
+                                          'Data collectors of a batch loaded from the database')
+BATCHES_COMMITTED = REGISTRY.counter('packet_writer_batches_committed_total', 'Packet batches committed')
+BATCHES_ROLLED_BACK = REGISTRY.counter('packet_writer_batches_rolled_back_total', 'Packet batches that failed')
+ARCHIVES_UPLOADED = REGISTRY.counter('packet_writer_archives_uploaded_total', 'Collector message archives uploaded')
+BATCH_SIZE = REGISTRY.histogram('packet_writer_batch_size', 'Packets per batch',
+                                (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096))
+FLUSH_SECONDS = REGISTRY.histogram('packet_writer_flush_seconds', 'Time to write and commit a batch',
+                                   LATENCY_BUCKETS)
+ARCHIVE_ENCODE_SECONDS = REGISTRY.histogram('packet_writer_archive_encode_seconds',
+                                            'Time to serialize and compress a collector message archive',
+                                            LATENCY_BUCKETS)
+UPLOAD_SECONDS = REGISTRY.histogram('packet_writer_archive_upload_seconds', 'Time to upload an archive',
+                                    LATENCY_BUCKETS)
+WRITE_QUEUE_DEPTH = REGISTRY.gauge('packet_writer_write_queue_depth', 'Packets buffered waiting to be written')
+BATCH_MAX_ROWS = REGISTRY.gauge('packet_writer_batch_max_rows', 'Packets per batch before it is written')
+BATCH_MAX_AGE = REGISTRY.gauge('packet_writer_batch_max_age_seconds',
+                               'Seconds a packet may wait in the buffer before its batch is written')
+COLLECTOR_BUFFERED_MESSAGES = REGISTRY.gauge('packet_writer_collector_buffered_messages',
+                                             'Raw messages buffered per collector', label='collector')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """
+    Serves the metrics on http://host:port/metrics from a daemon thread
+    :param port: port to listen on
+    :param host: address to bind
+    :return: the HTTP server
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
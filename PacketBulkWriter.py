@@ -0,0 +1,413 @@
+import datetime
+import io
+import json
+import logging
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from PacketDecoder import PACKET_COLUMNS, as_bigint
+from auditing.db.Models import CollectorMessage, Packet, PacketDeadLetter
+
+# Errors caused by the content of some rows. Other errors (e.g. connection problems) fail the whole batch
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+# Errors that make dead letters be dropped (e.g. the dead letter table doesn't exist) instead of failing the batch
+DEAD_LETTER_ERRORS = ROW_ERRORS + (psycopg2.ProgrammingError,)
+# Escapes for the PostgreSQL COPY text format
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+# Pseudo column of the rows with the raw messages of the packet, as a list of (data_collector_id, topic, message).
+# They are written to the message table, linked to the id of the packet, instead of to the packet table
+MESSAGES_COLUMN = 'messages'
+MESSAGE_COLUMNS = ('data_collector_id', 'packet_id', 'topic', 'message')
+
+
+class CopyNotAvailable(Exception):
+    """
+    Raised when COPY can't be used on the connection
+    """
+
+
+class PacketBulkWriter:
+    """
+    Base class for the strategies used to write batches of packets to the database.
+    Rows are tuples with the values of the writer columns, as returned by PacketDecoder.decode_packet
+    """
+    name = None
+    # rows per statement of the multi-row inserts
+    page_size = 1000
+
+    def __init__(self, engine, table_name=Packet.__tablename__, columns=PACKET_COLUMNS, isolate_failures=True,
+                 dead_letter_table=PacketDeadLetter.__tablename__, partitioner=None,
+                 message_table=CollectorMessage.__tablename__, rollups=None, logger=None):
+        """
+        Initializes the instance
+        :param engine: sqlalchemy engine used to get raw DBAPI connections
+        :param table_name: name of the table where the rows are inserted
+        :param columns: sequence with the name of the columns to write, in order
+        :param isolate_failures: when a batch fails because of its content, write the good rows and reject the
+        failing ones instead of failing the whole batch
+        :param dead_letter_table: table where rejected rows are saved with their error. None to only log them
+        :param partitioner: PacketPartitioner used to write each row directly to its partition. None to write to
+        table_name
+        :param message_table: table where the raw messages are inserted when the columns include MESSAGES_COLUMN.
+        The packets are then inserted returning their ids, and their messages in the same transaction
+        :param rollups: PacketRollups upserted with the written rows in the same transaction. None to skip them
+        :param logger: logger instance (logging library) to use
+        """
+        self.engine = engine
+        self.table_name = table_name
+        self.columns = tuple(columns)
+        self.message_index = self.columns.index(MESSAGES_COLUMN) if MESSAGES_COLUMN in self.columns else None
+        # columns of the packet table
+        self.packet_columns = tuple(column for column in self.columns if column != MESSAGES_COLUMN)
+        self.message_table = message_table
+        self.rollups = rollups
+        self.isolate_failures = isolate_failures
+        self.dead_letter_table = dead_letter_table
+        self.partitioner = partitioner
+        self.logger = logger
+        # (payload, error) tuples waiting to be written to the dead letter table
+        self.rejected = []
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Checks out a connection from the engine pool and yields a cursor inside a transaction.
+        The transaction is committed when the block finishes and rolled back if it raises
+        :return: DBAPI cursor
+        """
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def write(self, rows):
+        """
+        Writes a batch of rows in a single transaction. If the batch fails because of the content of some rows and
+        isolate_failures is set, the batch is bisected: the good rows are committed and the failing ones are rejected
+        :param rows: list of tuples with the packet columns
+        :return: list of (row, error) tuples with the rejected rows. An exception is raised if the batch failed
+        """
+        if len(rows) == 0 and len(self.rejected) == 0:
+            return []
+        # packets may be rejected from another thread while the batch is written
+        pending, self.rejected = self.rejected, []
+        rejected = []
+        try:
+            try:
+                with self.transaction() as cursor:
+                    self.write_routed(cursor, rows)
+                    self.write_rollups(cursor, rows)
+                    self.write_dead_letters(cursor, pending)
+            except ROW_ERRORS as e:
+                if not self.isolate_failures:
+                    raise
+                self.log(logging.WARNING, f'Batch of {len(rows)} packets failed ({e}), isolating the failing rows')
+                with self.transaction() as cursor:
+                    rejected = self.write_isolating(cursor, rows)
+                    for row, error in rejected:
+                        self.log(logging.ERROR, f'Rejected packet {row}: {error}')
+                    rejected_rows = {id(row) for row, _ in rejected}
+                    self.write_rollups(cursor, [row for row in rows if id(row) not in rejected_rows])
+                    self.write_dead_letters(cursor, pending + [(self.as_dict(row), error) for row, error in rejected])
+        except Exception:
+            self.rejected[0:0] = pending
+            raise
+        if self.rollups is not None and len(rows) > 0:
+            self.rollups.commit()
+        return rejected
+
+    def write_rollups(self, cursor, rows):
+        # called even without rows, so the aggregates of a failed attempt are not committed
+        if self.rollups is not None:
+            self.rollups.write(cursor, rows)
+
+    def write_isolating(self, cursor, rows):
+        """
+        Writes the rows inside a savepoint. If they fail, the savepoint is rolled back and each half is retried
+        :param cursor: DBAPI cursor
+        :param rows: list of tuples with the packet columns
+        :return: list of (row, error) tuples with the rows that could not be written
+        """
+        if len(rows) == 0:
+            return []
+        cursor.execute('SAVEPOINT isolate_rows')
+        try:
+            self.write_routed(cursor, rows)
+        except ROW_ERRORS as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT isolate_rows')
+            cursor.execute('RELEASE SAVEPOINT isolate_rows')
+            if len(rows) == 1:
+                return [(rows[0], str(e).strip())]
+            middle = len(rows) // 2
+            return self.write_isolating(cursor, rows[:middle]) + self.write_isolating(cursor, rows[middle:])
+        cursor.execute('RELEASE SAVEPOINT isolate_rows')
+        return []
+
+    def reject(self, payload, error):
+        """
+        Registers a packet that can't be written (e.g. it could not be decoded). It's saved to the dead letter table
+        with the next batch
+        :param payload: dict with the packet
+        :param error: exception or error message
+        :return: nothing
+        """
+        self.rejected.append((payload, str(error)))
+
+    def write_dead_letters(self, cursor, rejected):
+        """
+        Inserts rejected packets in the dead letter table, inside a savepoint so they never fail the batch. If they
+        fail, each one is retried alone and the ones that still fail are logged and dropped
+        :param cursor: DBAPI cursor
+        :param rejected: list of (payload, error) tuples
+        :return: nothing
+        """
+        if self.dead_letter_table is None or len(rejected) == 0:
+            return
+        try:
+            self.insert_dead_letters(cursor, rejected)
+        except DEAD_LETTER_ERRORS as e:
+            if len(rejected) == 1:
+                self.log(logging.ERROR, f'Dropped dead letter {rejected[0]}: {str(e).strip()}')
+                return
+            for dead_letter in rejected:
+                self.write_dead_letters(cursor, [dead_letter])
+
+    def insert_dead_letters(self, cursor, rejected):
+        cursor.execute('SAVEPOINT dead_letters')
+        try:
+            execute_values(cursor,
+                           f'INSERT INTO {self.dead_letter_table} (data_collector_id, error, payload) VALUES %s',
+                           [(as_bigint(payload.get('data_collector_id')) if isinstance(payload, dict) else None,
+                             error[0:PacketDeadLetter.error.type.length], json.dumps(payload, default=str))
+                            for payload, error in rejected])
+        except DEAD_LETTER_ERRORS:
+            cursor.execute('ROLLBACK TO SAVEPOINT dead_letters')
+            cursor.execute('RELEASE SAVEPOINT dead_letters')
+            raise
+        cursor.execute('RELEASE SAVEPOINT dead_letters')
+
+    def as_dict(self, row):
+        return dict(zip(self.columns, row))
+
+    def write_routed(self, cursor, rows):
+        """
+        Writes the rows without committing. With a partitioner, each partition of the batch is written to its child
+        table with a single statement
+        :param cursor: DBAPI cursor
+        :param rows: list of tuples with the packet columns
+        :return: nothing
+        """
+        if self.partitioner is None:
+            self.write_linked(cursor, rows)
+            return
+        for table_name, group in self.partitioner.group(rows):
+            self.write_linked(cursor, group, table_name)
+
+    def write_linked(self, cursor, rows, table_name=None):
+        """
+        Writes the rows and, if they include MESSAGES_COLUMN, inserts them returning their ids and writes their
+        messages with the packet ids
+        :param cursor: DBAPI cursor
+        :param rows: list of tuples with the writer columns
+        :param table_name: table to write to. Defaults to the writer table
+        :return: nothing
+        """
+        if self.message_index is None:
+            self.write_rows(cursor, rows, table_name)
+            return
+        index = self.message_index
+        ids = self.write_rows_returning(cursor, [row[:index] + row[index + 1:] for row in rows], table_name)
+        message_length = CollectorMessage.message.type.length
+        topic_length = CollectorMessage.topic.type.length
+        messages = []
+        for row, packet_id in zip(rows, ids):
+            for data_collector_id, topic, message in row[index] or ():
+                if message is not None and not isinstance(message, str):
+                    message = json.dumps(message)
+                messages.append((data_collector_id, packet_id, topic[0:topic_length] if topic else topic,
+                                 message[0:message_length] if message else message))
+        if len(messages) > 0:
+            self.write_messages(cursor, messages)
+
+    def write_rows_returning(self, cursor, rows, table_name=None):
+        """
+        Inserts the rows with multi-row INSERT ... RETURNING id statements, without committing
+        :param cursor: DBAPI cursor
+        :param rows: list of tuples with the packet table columns
+        :param table_name: table to write to. Defaults to the writer table
+        :return: list with the id of every row, in order
+        """
+        returned = execute_values(cursor, f'INSERT INTO {table_name or self.table_name} ({self.column_list()}) '
+                                          f'VALUES %s RETURNING id', rows, page_size=self.page_size, fetch=True)
+        return [packet_id for packet_id, in returned]
+
+    def write_messages(self, cursor, messages):
+        """
+        Inserts raw messages in the message table, without committing
+        :param cursor: DBAPI cursor
+        :param messages: list of tuples with the values of MESSAGE_COLUMNS
+        :return: nothing
+        """
+        execute_values(cursor, f'INSERT INTO {self.message_table} ({", ".join(MESSAGE_COLUMNS)}) VALUES %s',
+                       messages, page_size=self.page_size)
+
+    def write_rows(self, cursor, rows, table_name=None):
+        """
+        Writes the rows using the given cursor, without committing
+        :param cursor: DBAPI cursor
+        :param rows: list of tuples with the packet columns
+        :param table_name: table to write to. Defaults to the writer table
+        :return: nothing
+        """
+        raise NotImplementedError
+
+    def column_list(self):
+        return ', '.join(self.packet_columns)
+
+
+class ExecutemanyPacketWriter(PacketBulkWriter):
+    """
+    Sends one INSERT statement per row (the same as engine.execute(table.insert(), rows))
+    """
+    name = 'executemany'
+
+    def write_rows(self, cursor, rows, table_name=None):
+        placeholders = ', '.join(['%s'] * len(self.packet_columns))
+        cursor.executemany(f'INSERT INTO {table_name or self.table_name} ({self.column_list()}) VALUES ({placeholders})',
+                           rows)
+
+    def write_rows_returning(self, cursor, rows, table_name=None):
+        placeholders = ', '.join(['%s'] * len(self.packet_columns))
+        ids = []
+        for row in rows:
+            cursor.execute(f'INSERT INTO {table_name or self.table_name} ({self.column_list()}) '
+                           f'VALUES ({placeholders}) RETURNING id', row)
+            ids.append(cursor.fetchone()[0])
+        return ids
+
+
+class ValuesPacketWriter(PacketBulkWriter):
+    """
+    Sends multi-row INSERT statements, page_size rows per statement
+    """
+    name = 'values'
+
+    def __init__(self, engine, page_size=1000, **kwargs):
+        super().__init__(engine, **kwargs)
+        self.page_size = page_size
+
+    def write_rows(self, cursor, rows, table_name=None):
+        execute_values(cursor, f'INSERT INTO {table_name or self.table_name} ({self.column_list()}) VALUES %s',
+                       rows, page_size=self.page_size)
+
+
+class CopyPacketWriter(ValuesPacketWriter):
+    """
+    Streams the rows with COPY ... FROM STDIN using the text format.
+    If the connection does not support COPY (e.g. behind some poolers), it falls back to multi-row inserts.
+    COPY can't return the ids of the rows: when messages are linked, packets are inserted with multi-row inserts
+    and only the messages are copied
+    """
+    name = 'copy'
+
+    def __init__(self, engine, page_size=1000, **kwargs):
+        super().__init__(engine, page_size=page_size, **kwargs)
+        self.copy_supported = True
+
+    def write(self, rows):
+        if self.copy_supported:
+            try:
+                return super().write(rows)
+            except CopyNotAvailable as e:
+                self.log(logging.WARNING, f'COPY is not available, falling back to multi-row inserts: {e}')
+                self.copy_supported = False
+        return super().write(rows)
+
+    def write_rows(self, cursor, rows, table_name=None):
+        if self.copy_supported:
+            self.copy_rows(cursor, rows, table_name)
+        else:
+            super().write_rows(cursor, rows, table_name)
+
+    def write_messages(self, cursor, messages):
+        if self.copy_supported:
+            self.copy_rows(cursor, messages, self.message_table, MESSAGE_COLUMNS)
+        else:
+            super().write_messages(cursor, messages)
+
+    def copy_rows(self, cursor, rows, table_name=None, columns=None):
+        """
+        Sends the rows through COPY using the given cursor, without committing
+        :param cursor: psycopg2 cursor
+        :param rows: list of tuples with the packet columns
+        :param table_name: table to write to. Defaults to the writer table
+        :param columns: columns of the rows. Defaults to the packet table columns
+        :return: nothing. CopyNotAvailable is raised if the connection does not support COPY
+        """
+        copy_expert = getattr(cursor, 'copy_expert', None)
+        if copy_expert is None:
+            raise CopyNotAvailable(f'{type(cursor).__name__} has no copy_expert')
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join([copy_value(value) for value in row]))
+            buffer.write('\n')
+        buffer.seek(0)
+        column_list = ', '.join(columns) if columns is not None else self.column_list()
+        try:
+            copy_expert(f'COPY {table_name or self.table_name} ({column_list}) FROM STDIN', buffer)
+        except psycopg2.NotSupportedError as e:
+            raise CopyNotAvailable(str(e).strip()) from e
+
+
+def copy_value(value):
+    """
+    Formats a value for the COPY text format
+    :param value: python value of a column
+    :return: string representation of the value
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+WRITERS = {writer.name: writer for writer in (ExecutemanyPacketWriter, ValuesPacketWriter, CopyPacketWriter)}
+
+
+def get_packet_writer(engine, strategy='copy', **kwargs):
+    """
+    Builds the packet writer for the given strategy
+    :param engine: sqlalchemy engine
+    :param strategy: one of 'executemany', 'values' or 'copy'
+    :param kwargs: extra arguments for the writer
+    :return: PacketBulkWriter instance
+    """
+    if strategy not in WRITERS:
+        raise ValueError(f'Unknown packet write strategy {strategy}. Valid options are: {", ".join(WRITERS)}')
+    return WRITERS[strategy](engine, **kwargs)
@@ -0,0 +1,110 @@
+import datetime
+import json
+
+from auditing.db.Models import Packet
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
+DATA_MAX_LEN = 300
+TRUNCATED_COLUMNS = ('data', 'error')
+# Legacy columns of the packet table that are not sent by the collectors
+UNMAPPED_COLUMNS = ('seqn', 'opts', 'port')
+# Columns filled by later stages of the writer (e.g. PacketDeduplicator), appended after PACKET_COLUMNS
+DERIVED_COLUMNS = ('receptions',)
+# Columns of the rows produced by decode_packet, in order. The id is generated by the database
+PACKET_COLUMNS = tuple(column.name for column in Packet.__table__.columns
+                       if not column.primary_key and column.name not in UNMAPPED_COLUMNS + DERIVED_COLUMNS)
+COLUMN_INDEX = {column: index for index, column in enumerate(PACKET_COLUMNS)}
+
+
+def decode_message(body):
+    """
+    Parses a message from the queue
+    :param body: bytes with the JSON message
+    :return: dict with the message
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body.decode('utf-8'))
+
+
+def parse_date(value):
+    """
+    Parses the date of a packet. ISO 8601 dates (the ones sent by the collectors) are parsed with a fast parser,
+    anything else falls back to dateutil
+    :param value: string with the date
+    :return: datetime
+    """
+    if value is None:
+        raise ValueError('The packet has no date')
+    try:
+        if ciso8601 is not None:
+            return ciso8601.parse_datetime(value)
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        import dateutil.parser
+        return dateutil.parser.parse(value)
+
+
+def as_bigint(value):
+    """
+    :return: value as an int, or None if it isn't an integer (e.g. the data_collector_id of a malformed packet)
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value if -2 ** 63 <= value < 2 ** 63 else None
+
+
+def truncate(value):
+    return value[0:DATA_MAX_LEN] if value is not None else None
+
+
+def compile_decoder():
+    """
+    Generates a function that maps a packet to a tuple with one expression per column,
+    avoiding loops and intermediate dicts
+    :return: function(packet) -> tuple
+    """
+    expressions = []
+    for column in PACKET_COLUMNS:
+        if column == 'date':
+            expressions.append(f'parse_date(get({column!r}))')
+        elif column in TRUNCATED_COLUMNS:
+            expressions.append(f'truncate(get({column!r}))')
+        else:
+            expressions.append(f'get({column!r})')
+    source = ('def decode_packet(packet):\n'
+              '    get = packet.get\n'
+              f'    return ({", ".join(expressions)},)\n')
+    namespace = {'parse_date': parse_date, 'truncate': truncate}
+    exec(compile(source, '<packet decoder>', 'exec'), namespace)
+    return namespace['decode_packet']
+
+
+# Maps a packet sent by a data collector (dict parsed from the JSON message) to a row of the packet table:
+# a tuple with the values of PACKET_COLUMNS
+decode_packet = compile_decoder()
+
+
+def restore_row(values):
+    """
+    Restores a row saved as JSON (e.g. by PacketSpool), where the date was serialized as an ISO 8601 string
+    :param values: list with the values of PACKET_COLUMNS
+    :return: tuple with the values of PACKET_COLUMNS
+    """
+    date_index = COLUMN_INDEX['date']
+    if isinstance(values[date_index], str):
+        values[date_index] = parse_date(values[date_index])
+    return tuple(values)
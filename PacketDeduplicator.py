@@ -0,0 +1,108 @@
+import json
+import time
+from collections import OrderedDict
+
+from PacketDecoder import COLUMN_INDEX, PACKET_COLUMNS
+
+MODES = ('drop', 'collapse')
+RECEPTIONS_COLUMN = 'receptions'
+
+
+class PacketDeduplicator:
+    """
+    Removes the copies of a packet: the same uplink heard by several gateways, or redelivered by a collector.
+    Packets are identified by (dev_addr or dev_eui, f_count, mic, data). Only the first copy is written; copies in
+    the same batch or received up to window seconds after the first one are dropped. The packets of a batch are
+    remembered once commit is called, so the redeliveries of a batch that failed are not taken as copies
+    """
+
+    def __init__(self, mode='drop', window=5, max_entries=100000, columns=PACKET_COLUMNS, clock=time.monotonic):
+        """
+        Initializes the instance
+        :param mode: 'drop' to discard the copies, 'collapse' to also save the [gateway, rssi, lsnr] of every copy
+        in the same batch as a json list in an extra receptions column (None when there is a single copy)
+        :param window: seconds during which copies of a packet are recognized
+        :param max_entries: maximum number of packets remembered. The oldest ones are forgotten first
+        :param columns: columns of the rows, in order
+        :param clock: function returning the current time in seconds
+        """
+        if mode not in MODES:
+            raise ValueError(f'Unknown deduplication mode {mode}. Valid options are: {", ".join(MODES)}')
+        self.collapse = mode == 'collapse'
+        self.window = window
+        self.max_entries = max_entries
+        self.clock = clock
+        index = {column: i for i, column in enumerate(columns)} if columns is not PACKET_COLUMNS else COLUMN_INDEX
+        self.key_indexes = tuple(index[column] for column in ('dev_addr', 'dev_eui', 'f_count', 'mic', 'data'))
+        self.reception_indexes = tuple(index[column] for column in ('gateway', 'rssi', 'lsnr'))
+        # columns of the rows returned by process
+        self.columns = tuple(columns) + ((RECEPTIONS_COLUMN,) if self.collapse else ())
+        # packet key -> time it was first seen, oldest first
+        self.seen = OrderedDict()
+        # packet key -> time it was first seen, for the last batch processed until it's committed
+        self.pending = {}
+        self.duplicates = 0
+
+    def key(self, row):
+        """
+        :param row: tuple with the packet columns
+        :return: identity of the packet, or None if it can't be identified (e.g. it has no mic)
+        """
+        dev_addr, dev_eui, f_count, mic, data = [row[i] for i in self.key_indexes]
+        if mic is None:
+            return None
+        return dev_addr or dev_eui, f_count, mic, data
+
+    def expire(self, now):
+        oldest = now - self.window
+        while self.seen and next(iter(self.seen.values())) < oldest:
+            self.seen.popitem(last=False)
+        while len(self.seen) > self.max_entries:
+            self.seen.popitem(last=False)
+
+    def process(self, rows):
+        """
+        Removes the copies from a batch
+        :param rows: list of tuples with the packet columns
+        :return: list with the rows to write. In collapse mode each row has the receptions column appended
+        """
+        now = self.clock()
+        self.expire(now)
+        kept = []
+        # key -> receptions of the packet in this batch
+        batch = {}
+        self.pending = {}
+        for row in rows:
+            key = self.key(row)
+            if key is None:
+                kept.append((row, None))
+                continue
+            receptions = batch.get(key)
+            if receptions is not None:
+                receptions.append([row[i] for i in self.reception_indexes])
+                self.duplicates += 1
+                continue
+            if key in self.seen:
+                self.duplicates += 1
+                continue
+            self.pending[key] = now
+            receptions = batch[key] = [[row[i] for i in self.reception_indexes]]
+            kept.append((row, receptions))
+        if not self.collapse:
+            return [row for row, _ in kept]
+        return [row + (json.dumps(receptions) if receptions is not None and len(receptions) > 1 else None,)
+                for row, receptions in kept]
+
+    def commit(self, pending=None):
+        """
+        Remembers the packets of a batch once it was written
+        :param pending: dict with the keys of the batch, taken from pending right after process. Defaults to the
+        last batch processed
+        :return: nothing
+        """
+        pending = self.pending if pending is None else pending
+        self.seen.update(pending)
+        if pending is self.pending:
+            self.pending = {}
+        if len(self.seen) > self.max_entries:
+            self.expire(self.clock())
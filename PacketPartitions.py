@@ -0,0 +1,150 @@
+import datetime
+import logging
+
+from PacketDecoder import COLUMN_INDEX
+from auditing.db.Models import Packet
+
+INTERVALS = {'day': datetime.timedelta(days=1), 'week': datetime.timedelta(weeks=1)}
+# Serializes the maintenance of the partitions between writer processes
+MAINTENANCE_LOCK_ID = 0x706b7470
+
+
+class PacketPartitioner:
+    """
+    Manages the range partitions (on date) of the packet table and routes the rows of a batch to them.
+    The table must already be partitioned (see auditing.db.migrate). Partitions are named <table>_pYYYYMMDD
+    after the (UTC) day they start; weekly partitions start on monday
+    """
+
+    def __init__(self, engine, interval='day', premake=3, retention=None, table_name=Packet.__tablename__,
+                 date_index=COLUMN_INDEX['date'], logger=None):
+        """
+        Initializes the instance
+        :param engine: sqlalchemy engine
+        :param interval: 'day' or 'week'
+        :param premake: number of partitions created ahead of the current one
+        :param retention: number of past partitions to keep. Older ones are detached and dropped. None to keep all
+        :param table_name: name of the partitioned table
+        :param date_index: position of the date in the rows
+        :param logger: logger instance (logging library) to use
+        """
+        if interval not in INTERVALS:
+            raise ValueError(f'Unknown partition interval {interval}. Valid options are: {", ".join(INTERVALS)}')
+        self.engine = engine
+        self.interval = interval
+        self.step = INTERVALS[interval]
+        self.premake = premake
+        self.retention = retention
+        self.table_name = table_name
+        self.date_index = date_index
+        self.logger = logger
+        # start of the partitions known to exist -> partition name
+        self.partitions = {}
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def partition_start(self, date):
+        """
+        :param date: datetime. Naive datetimes are taken as UTC
+        :return: datetime (UTC) where the partition containing the date starts
+        """
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        else:
+            date = date.astimezone(datetime.timezone.utc)
+        start = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self.interval == 'week':
+            start -= datetime.timedelta(days=start.weekday())
+        return start
+
+    def partition_name(self, start):
+        return f'{self.table_name}_p{start:%Y%m%d}'
+
+    def group(self, rows):
+        """
+        Splits a batch by partition, so each group is written to a single child table
+        :param rows: list of tuples with the packet columns
+        :return: list of (table name, rows) tuples. Rows without a known partition are sent to the parent table
+        """
+        groups = {}
+        start = end = table_name = None
+        for row in rows:
+            date = row[self.date_index]
+            if date.tzinfo is None:
+                # the same rule as partition_start: naive dates are UTC
+                date = date.replace(tzinfo=datetime.timezone.utc)
+            # batches are mostly in order: reuse the partition of the previous row
+            if start is None or not start <= date < end:
+                start = self.partition_start(date)
+                end = start + self.step
+                table_name = self.partitions.get(start, self.table_name)
+            group = groups.get(table_name)
+            if group is None:
+                group = groups[table_name] = []
+            group.append(row)
+        return list(groups.items())
+
+    def maintain(self, now=None):
+        """
+        Creates the partitions from the current one up to premake ahead, and drops the ones older than retention.
+        Runs in a single transaction, holding an advisory lock so concurrent writers don't collide
+        :param now: current datetime (UTC)
+        :return: nothing
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        current = self.partition_start(now)
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', (MAINTENANCE_LOCK_ID,))
+            for i in range(self.premake + 1):
+                start = current + i * self.step
+                name = self.partition_name(start)
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {self.table_name} "
+                               f"FOR VALUES FROM ('{start.isoformat()}') TO ('{(start + self.step).isoformat()}')")
+            existing = self.list_partitions(cursor)
+            if self.retention is not None:
+                oldest = current - self.retention * self.step
+                for start, name in sorted(existing.items()):
+                    if start < oldest:
+                        self.log(logging.INFO, f'Dropping partition {name}')
+                        cursor.execute(f'ALTER TABLE {self.table_name} DETACH PARTITION {name}')
+                        cursor.execute(f'DROP TABLE {name}')
+                        del existing[start]
+            cursor.close()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        self.partitions = existing
+
+    def list_partitions(self, cursor):
+        """
+        :param cursor: DBAPI cursor
+        :return: dict with the start of the partitions managed by this class -> partition name
+        """
+        cursor.execute('SELECT child.relname FROM pg_inherits '
+                       'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+                       'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+                       'WHERE parent.relname = %s', (self.table_name,))
+        prefix = f'{self.table_name}_p'
+        partitions = {}
+        for name, in cursor.fetchall():
+            try:
+                start = datetime.datetime.strptime(name[len(prefix):], '%Y%m%d').replace(tzinfo=datetime.timezone.utc)
+            except ValueError:
+                # e.g. the table partitioned when migrating
+                continue
+            if name.startswith(prefix):
+                partitions[start] = name
+        return partitions
@@ -0,0 +1,162 @@
+import datetime
+import json
+from collections import OrderedDict
+
+from psycopg2.extras import execute_values
+
+from PacketDecoder import COLUMN_INDEX, PACKET_COLUMNS
+from auditing.db.Models import DeviceRollup, GatewayRollup
+
+DEVICE_KEY = ('data_collector_id', 'device_type', 'device')
+GATEWAY_KEY = ('data_collector_id', 'gateway')
+# position of the values of the rollup tables in the aggregates, after the key
+DEVICE_VALUES = ('organization_id', 'first_seen', 'last_seen', 'packets', 'last_f_count', 'f_count_gaps',
+                 'rssi_count', 'rssi_sum', 'rssi_min', 'rssi_max', 'lsnr_count', 'lsnr_sum', 'lsnr_min', 'lsnr_max')
+GATEWAY_VALUES = ('organization_id', 'first_seen', 'last_seen', 'packets',
+                  'rssi_count', 'rssi_sum', 'rssi_min', 'rssi_max', 'lsnr_count', 'lsnr_sum', 'lsnr_min', 'lsnr_max')
+
+
+def merge_expression(table, column):
+    """
+    :return: SQL expression combining the aggregate of a column in the table with the one being upserted
+    """
+    if column == 'organization_id':
+        return f'COALESCE(EXCLUDED.{column}, {table}.{column})'
+    if column == 'last_f_count':
+        # the frame counter of the latest packet, even if batches are written out of order
+        return f'CASE WHEN EXCLUDED.last_seen >= {table}.last_seen THEN EXCLUDED.{column} ELSE {table}.{column} END'
+    if column == 'first_seen' or column.endswith('_min'):
+        return f'LEAST({table}.{column}, EXCLUDED.{column})'
+    if column == 'last_seen' or column.endswith('_max'):
+        return f'GREATEST({table}.{column}, EXCLUDED.{column})'
+    return f'{table}.{column} + EXCLUDED.{column}'
+
+
+def upsert_statement(table, key, values):
+    return (f'INSERT INTO {table} ({", ".join(key + values)}) VALUES %s '
+            f'ON CONFLICT ({", ".join(key)}) DO UPDATE SET '
+            f'{", ".join(f"{column} = {merge_expression(table, column)}" for column in values)}')
+
+
+def new_signal_stats():
+    return [0, 0, None, None, 0, 0.0, None, None]
+
+
+def add_signal(stats, offset, rssi, lsnr):
+    """
+    Adds a reception to the rssi and lsnr count, sum, min and max, stored from offset
+    """
+    if rssi is not None:
+        stats[offset] += 1
+        stats[offset + 1] += rssi
+        stats[offset + 2] = rssi if stats[offset + 2] is None else min(stats[offset + 2], rssi)
+        stats[offset + 3] = rssi if stats[offset + 3] is None else max(stats[offset + 3], rssi)
+    if lsnr is not None:
+        stats[offset + 4] += 1
+        stats[offset + 5] += lsnr
+        stats[offset + 6] = lsnr if stats[offset + 6] is None else min(stats[offset + 6], lsnr)
+        stats[offset + 7] = lsnr if stats[offset + 7] is None else max(stats[offset + 7], lsnr)
+
+
+class PacketRollups:
+    """
+    Aggregates the packets of each batch per device and per gateway (last seen, packet count, frame counter gaps,
+    rssi and lsnr statistics) and upserts them into the device_rollup and gateway_rollup tables, in the transaction
+    of the batch, so dashboards don't need to group the packet table
+    """
+
+    def __init__(self, columns=PACKET_COLUMNS, max_devices=100000):
+        """
+        Initializes the instance
+        :param columns: columns of the rows, in order
+        :param max_devices: number of devices whose last frame counter is remembered to find the gaps between
+        batches. The least recently seen are forgotten first
+        """
+        index = {column: i for i, column in enumerate(columns)} if columns is not PACKET_COLUMNS else COLUMN_INDEX
+        self.indexes = tuple(index[column] for column in ('data_collector_id', 'organization_id', 'date', 'dev_addr',
+                                                          'dev_eui', 'f_count', 'gateway', 'rssi', 'lsnr'))
+        self.receptions_index = index.get('receptions')
+        self.max_devices = max_devices
+        # device key -> frame counter of its last written packet
+        self.last_f_counts = OrderedDict()
+        # frame counters of the batch being written, remembered once it's committed
+        self.pending = {}
+        self.device_statement = upsert_statement(DeviceRollup.__tablename__, DEVICE_KEY, DEVICE_VALUES)
+        self.gateway_statement = upsert_statement(GatewayRollup.__tablename__, GATEWAY_KEY, GATEWAY_VALUES)
+
+    def aggregate(self, rows):
+        """
+        :param rows: list of tuples with the packet columns. Naive dates are taken as UTC
+        :return: tuple with the device and the gateway aggregates (dicts with key=rollup key, value=list with the
+        rollup values), and a dict with the last frame counter of each device
+        """
+        devices = {}
+        gateways = {}
+        f_counts = {}
+        last_f_counts = self.last_f_counts
+        receptions_index = self.receptions_index
+        for row in rows:
+            collector, organization, date, dev_addr, dev_eui, f_count, gateway, rssi, lsnr = \
+                [row[i] for i in self.indexes]
+            if date.tzinfo is None:
+                # the same rule as PacketPartitioner: naive dates are UTC, so they compare with the aware ones
+                date = date.replace(tzinfo=datetime.timezone.utc)
+            if dev_addr or dev_eui:
+                key = (collector, 'dev_addr', dev_addr) if dev_addr else (collector, 'dev_eui', dev_eui)
+                stats = devices.get(key)
+                if stats is None:
+                    stats = devices[key] = [organization, date, date, 0, None, 0] + new_signal_stats()
+                stats[1] = min(stats[1], date)
+                if date >= stats[2]:
+                    stats[2] = date
+                    stats[4] = f_count if f_count is not None else stats[4]
+                stats[3] += 1
+                if f_count is not None:
+                    previous = f_counts.get(key, last_f_counts.get(key))
+                    # a lower counter is a reset (e.g. the device rejoined), not a gap
+                    if previous is not None and f_count > previous + 1:
+                        stats[5] += f_count - previous - 1
+                    f_counts[key] = f_count
+                add_signal(stats, 6, rssi, lsnr)
+            receptions = row[receptions_index] if receptions_index is not None else None
+            # with collapsed duplicates, every gateway that received the packet
+            for gateway, rssi, lsnr in json.loads(receptions) if receptions else [(gateway, rssi, lsnr)]:
+                if not gateway:
+                    continue
+                key = (collector, gateway)
+                stats = gateways.get(key)
+                if stats is None:
+                    stats = gateways[key] = [organization, date, date, 0] + new_signal_stats()
+                stats[1] = min(stats[1], date)
+                stats[2] = max(stats[2], date)
+                stats[3] += 1
+                add_signal(stats, 4, rssi, lsnr)
+        return devices, gateways, f_counts
+
+    def write(self, cursor, rows):
+        """
+        Upserts the aggregates of the rows, without committing. Call commit once the transaction is committed
+        :param cursor: DBAPI cursor
+        :param rows: list of tuples with the packet columns
+        :return: nothing
+        """
+        devices, gateways, self.pending = self.aggregate(rows)
+        # always in the same order, so concurrent writers don't deadlock
+        if devices:
+            execute_values(cursor, self.device_statement,
+                           [key + tuple(values) for key, values in sorted(devices.items())])
+        if gateways:
+            execute_values(cursor, self.gateway_statement,
+                           [key + tuple(values) for key, values in sorted(gateways.items())])
+
+    def commit(self):
+        """
+        Remembers the frame counters of the last batch written
+        :return: nothing
+        """
+        for key, f_count in self.pending.items():
+            self.last_f_counts[key] = f_count
+            self.last_f_counts.move_to_end(key)
+        self.pending = {}
+        while len(self.last_f_counts) > self.max_devices:
+            self.last_f_counts.popitem(last=False)
@@ -0,0 +1,251 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.spool'
+OFFSET_SUFFIX = '.offset'
+# records that can't be decoded are moved to this file of the spool directory, so they don't block the later ones
+QUARANTINE_NAME = 'quarantine.jsonl'
+
+
+class PacketSpool:
+
+    def __init__(self, directory, write_callback, decode_row=tuple, segment_bytes=64 * 1024 * 1024, segment_age=5,
+                 drain_batch=5000, fsync=True, retry_interval=5, adopt=(), logger=None, clock=time.monotonic):
+        """
+        Initializes the instance. Rows are appended to segment files in directory; a drain thread replays the closed
+        segments with write_callback in large batches and deletes them once written. Segments left by a previous run
+        are replayed too. Rows are written at least once: after a crash, the rows of the last batch of a segment
+        may be written again
+        :param directory: directory for the segment files. It must be on a persistent volume
+        :param write_callback: function that writes (and commits) a list of rows. It must raise if the write fails
+        :param decode_row: function that restores a row from the list of json values it was saved as
+        :param segment_bytes: size after which the current segment is closed
+        :param segment_age: seconds after which the current segment is closed, so it can be drained
+        :param drain_batch: maximum number of rows per write_callback call
+        :param fsync: sync every append to disk. Without it, rows may be lost if the host (not the process) crashes
+        :param retry_interval: seconds to wait before replaying a segment again when the write failed
+        :param adopt: other spool directories whose segments are replayed too, before the ones of directory (e.g.
+        the ones of workers that no longer exist). Nothing else may be writing to them
+        :param logger: logger instance (logging library) to use
+        :param clock: function returning the current time in seconds
+        """
+        self.directory = directory
+        self.write_callback = write_callback
+        self.decode_row = decode_row
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.drain_batch = drain_batch
+        self.fsync = fsync
+        self.retry_interval = retry_interval
+        self.adopted = list(adopt)
+        self.logger = logger
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+        os.makedirs(directory, exist_ok=True)
+        existing = self.segments()
+        adopted = self.adopted_segments()
+        if existing or adopted:
+            self.log(logging.INFO, f'Found {len(existing) + len(adopted)} spool segments to replay')
+        self.next_segment = segment_number(existing[-1]) + 1 if existing else 0
+        self.fd = None
+        self.current = None
+        self.current_size = 0
+        self.current_opened = None
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def segments(self):
+        """
+        :return: sorted list with the paths of all the segment files
+        """
+        return list_segments(self.directory)
+
+    def adopted_segments(self):
+        """
+        :return: list with the paths of the segment files of the adopted directories
+        """
+        return [path for directory in self.adopted if os.path.isdir(directory) for path in list_segments(directory)]
+
+    def closed_segments(self):
+        adopted = self.adopted_segments()
+        with self.lock:
+            return adopted + [path for path in self.segments() if path != self.current]
+
+    def append(self, rows):
+        """
+        Appends rows to the current segment with a single write
+        :param rows: list of tuples
+        :return: nothing. When it returns, the rows are on disk (in the OS cache, if fsync is disabled)
+        """
+        if len(rows) == 0:
+            return
+        data = ''.join(json.dumps(row, default=json_default) + '\n' for row in rows).encode('utf-8')
+        with self.lock:
+            if self.fd is None:
+                self.open_segment()
+            os.write(self.fd, data)
+            if self.fsync:
+                os.fsync(self.fd)
+            self.current_size += len(data)
+            if self.current_size >= self.segment_bytes:
+                self.close_segment()
+        if self.current is None:
+            self.wakeup.set()
+
+    def open_segment(self):
+        self.current = os.path.join(self.directory, f'{SEGMENT_PREFIX}{self.next_segment:012d}{SEGMENT_SUFFIX}')
+        self.next_segment += 1
+        self.fd = os.open(self.current, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.current_size = 0
+        self.current_opened = self.clock()
+
+    def close_segment(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.current = None
+
+    def rotate_if_old(self):
+        with self.lock:
+            if self.fd is not None and self.clock() - self.current_opened >= self.segment_age:
+                self.close_segment()
+
+    def replay(self, path):
+        """
+        Writes the rows of a segment, starting from the offset already committed, and deletes it
+        :param path: path of the segment
+        :return: nothing. An exception is raised if a write fails; the segment is kept to be retried
+        """
+        offset_path = path + OFFSET_SUFFIX
+        offset = 0
+        if os.path.exists(offset_path):
+            with open(offset_path) as f:
+                offset = int(f.read() or 0)
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            rows = []
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # incomplete record of a crashed append
+                    self.log(logging.WARNING, f'Discarding incomplete record at the end of {path}')
+                    break
+                try:
+                    rows.append(self.decode_row(json.loads(line)))
+                except Exception as e:
+                    self.quarantine(path, offset, line, e)
+                offset += len(line)
+                if len(rows) >= self.drain_batch:
+                    self.write_callback(rows)
+                    self.save_offset(offset_path, offset)
+                    rows = []
+            if rows:
+                self.write_callback(rows)
+        os.remove(path)
+        if os.path.exists(offset_path):
+            os.remove(offset_path)
+
+    def quarantine(self, path, offset, line, error):
+        """
+        Moves a record that can't be decoded to the quarantine file, so the rest of the segment is replayed
+        :param path: path of the segment
+        :param offset: position of the record in the segment
+        :param line: bytes with the record
+        :param error: exception raised decoding it
+        :return: nothing
+        """
+        quarantine_path = os.path.join(self.directory, QUARANTINE_NAME)
+        self.log(logging.ERROR, f'Moved the record at {offset} of {path} to {quarantine_path}, '
+                                f'it can\'t be decoded: {error}')
+        with open(quarantine_path, 'ab') as f:
+            f.write(line)
+
+    def save_offset(self, offset_path, offset):
+        temp_path = offset_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(str(offset))
+        os.replace(temp_path, offset_path)
+
+    def drain(self):
+        """
+        Replays every closed segment, oldest first
+        :return: True if all of them were written
+        """
+        for path in self.closed_segments():
+            if self.stopping.is_set():
+                return False
+            try:
+                self.replay(path)
+            except Exception as e:
+                self.log(logging.ERROR, f'There was an error replaying spool segment {path}: {e}')
+                return False
+        return True
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.rotate_if_old()
+            if self.drain():
+                self.wakeup.wait(timeout=min(self.segment_age, 1))
+                self.wakeup.clear()
+            else:
+                self.stopping.wait(timeout=self.retry_interval)
+
+    def start(self):
+        """
+        Starts the drain thread
+        :return: nothing
+        """
+        self.thread = threading.Thread(target=self.run, name='spool-drain', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Closes the current segment and stops the drain thread. Segments not drained yet stay on disk
+        :param timeout: seconds to wait for the thread
+        :return: nothing
+        """
+        with self.lock:
+            self.close_segment()
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def pending_segments(self):
+        return len(self.segments()) + len(self.adopted_segments())
+
+
+def list_segments(directory):
+    """
+    :return: sorted list with the paths of the segment files of a directory
+    """
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+    return [os.path.join(directory, name) for name in names]
+
+
+def segment_number(path):
+    name = os.path.basename(path)
+    return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
@@ -0,0 +1,120 @@
+import datetime
+import io
+
+from ArchiveEncoder import dumps
+from PacketDecoder import as_bigint, parse_date
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# columns of the declared schema, in order. Other properties of the messages are saved as json in extra
+SCHEMA_COLUMNS = ('data_collector_id', 'packet_id', 'topic', 'message', 'timestamp', 'extra')
+SCHEMAS = ('declared', 'inferred')
+
+
+class ParquetArchiveEncoder:
+
+    CODECS = ('gzip', 'zstd', 'snappy')
+    extension = '.parquet'
+
+    def __init__(self, codec='zstd', level=None, schema='declared', row_group_size=100000):
+        """
+        Initializes the instance. Messages are written as a parquet file (requires the pyarrow package), which
+        analytics engines can scan by column instead of parsing every line
+        :param codec: 'gzip', 'zstd' or 'snappy'. Compression of the columns
+        :param level: compression level. None for the default of the codec
+        :param schema: 'declared' to write the columns in SCHEMA_COLUMNS, with the message as a string and the
+        other properties as json in extra. 'inferred' to write a column per property, with the types of the values.
+        Messages whose types can't be inferred fall back to the declared schema
+        :param row_group_size: maximum number of messages per row group
+        """
+        if pyarrow is None:
+            raise ValueError('The parquet archive format requires the pyarrow package')
+        if codec not in self.CODECS:
+            raise ValueError(f'Unknown parquet codec {codec}. Valid options are: {", ".join(self.CODECS)}')
+        if schema not in SCHEMAS:
+            raise ValueError(f'Unknown parquet schema {schema}. Valid options are: {", ".join(SCHEMAS)}')
+        self.codec = codec
+        self.level = level
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.declared_schema = pyarrow.schema([
+            ('data_collector_id', pyarrow.int64()),
+            ('packet_id', pyarrow.int64()),
+            ('topic', pyarrow.string()),
+            ('message', pyarrow.string()),
+            ('timestamp', pyarrow.timestamp('us', tz='UTC')),
+            ('extra', pyarrow.string()),
+        ])
+
+    def to_table(self, messages):
+        """
+        :param messages: list of dicts
+        :return: pyarrow.Table with a row per message
+        """
+        if self.schema == 'inferred':
+            try:
+                return pyarrow.Table.from_pylist(messages)
+            except (pyarrow.ArrowException, TypeError, ValueError):
+                # e.g. a property with an integer in a message and a string in another
+                pass
+        columns = {column: [] for column in SCHEMA_COLUMNS}
+        for msg in messages:
+            message = msg.get('message')
+            # values that don't fit the declared types are written as null instead of failing the whole file
+            columns['data_collector_id'].append(as_bigint(msg.get('data_collector_id')))
+            columns['packet_id'].append(as_bigint(msg.get('packet_id')))
+            topic = msg.get('topic')
+            columns['topic'].append(topic if topic is None or isinstance(topic, str) else str(topic))
+            columns['message'].append(message if message is None or isinstance(message, str)
+                                      else dumps(message).decode('utf-8'))
+            columns['timestamp'].append(parse_timestamp(msg.get('timestamp')))
+            extra = {key: value for key, value in msg.items() if key not in SCHEMA_COLUMNS}
+            columns['extra'].append(dumps(extra).decode('utf-8') if extra else None)
+        return pyarrow.Table.from_pydict(columns, schema=self.declared_schema)
+
+    def encode_to(self, messages, fileobj):
+        """
+        Writes the messages to a file
+        :param messages: list of dicts
+        :param fileobj: binary file
+        :return: number of rows written
+        """
+        table = self.to_table(messages)
+        pyarrow.parquet.write_table(table, fileobj, row_group_size=self.row_group_size, compression=self.codec,
+                                    compression_level=self.level)
+        return table.num_rows
+
+    def encode(self, messages):
+        """
+        :param messages: list of dicts
+        :return: bytes with the parquet file
+        """
+        f = io.BytesIO()
+        self.encode_to(messages, f)
+        return f.getvalue()
+
+
+def parse_timestamp(value):
+    """
+    :param value: datetime, date string (parsed as the dates of the packets), epoch seconds or None. Naive datetimes
+    are taken as UTC
+    :return: aware datetime. None if the value is missing or can't be parsed, so the rest of the file is still written
+    """
+    if value is None:
+        return None
+    try:
+        if isinstance(value, str):
+            value = parse_date(value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = datetime.datetime.fromtimestamp(value, datetime.timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        return None
+    if not isinstance(value, datetime.datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
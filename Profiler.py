@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class NullStage:
+    """
+    Stage returned while profiling is disabled: it does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    """
+    Measures the wall and CPU time of a block
+    """
+    __slots__ = ('profiler', 'name', 'wall', 'cpu')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, time.perf_counter() - self.wall, time.thread_time() - self.cpu)
+        return False
+
+
+class Trace:
+    """
+    Measures the consecutive stages of a sampled message: each lap records the time since the previous one
+    """
+    __slots__ = ('profiler', 'wall', 'cpu')
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+
+    def lap(self, name):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        self.profiler.record(name, wall - self.wall, cpu - self.cpu)
+        self.wall = wall
+        self.cpu = cpu
+
+
+class Profiler:
+    """
+    Opt-in profiling of the writer. While enabled it records the wall and CPU time of the stages of the sampled
+    messages (and of every batch and archive), and a thread samples the stacks of the process every interval
+    seconds. The stacks are dumped in the collapsed format read by flamegraph.pl and speedscope.
+    While disabled, stage() returns a shared no-op context manager and trace() returns None, so the per-message
+    cost is an attribute check
+    """
+
+    def __init__(self, sample_rate=0.01, interval=0.01, output_dir='/tmp', logger=None):
+        """
+        Initializes the instance
+        :param sample_rate: fraction of the messages whose stages are timed
+        :param interval: seconds between stack samples. 0 to disable the stack sampling
+        :param output_dir: directory where dump writes the profiles
+        :param logger: logger instance (logging library) to use
+        """
+        self.configure(sample_rate, interval, output_dir, logger)
+        self.enabled = False
+        self.messages = 0
+        # stage name -> [count, wall seconds, cpu seconds, max wall seconds]
+        self.stages = {}
+        # collapsed stack -> number of samples
+        self.stacks = Counter()
+        self.started = None
+        self.sampler = None
+        self.lock = threading.Lock()
+
+    def configure(self, sample_rate=0.01, interval=0.01, output_dir='/tmp', logger=None):
+        """
+        Changes the settings of the profiler. See __init__
+        """
+        self.every = max(1, round(1 / sample_rate)) if sample_rate > 0 else None
+        self.interval = interval
+        self.output_dir = output_dir
+        self.logger = logger
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def enable(self):
+        """
+        Starts profiling, discarding the previous results
+        :return: nothing
+        """
+        if self.enabled:
+            return
+        with self.lock:
+            self.stages = {}
+            self.stacks = Counter()
+        self.started = time.time()
+        self.enabled = True
+        if self.interval > 0:
+            self.sampler = threading.Thread(target=self.sample_stacks, name='profiler', daemon=True)
+            self.sampler.start()
+        self.log(logging.INFO, 'Profiling enabled')
+
+    def disable(self):
+        """
+        Stops profiling. The results are kept until the next enable
+        :return: nothing
+        """
+        self.enabled = False
+        if self.sampler is not None and self.sampler is not threading.current_thread():
+            self.sampler.join()
+        self.sampler = None
+        self.log(logging.INFO, 'Profiling disabled')
+
+    def toggle(self):
+        """
+        Enables profiling, or disables it and dumps the results
+        :return: nothing
+        """
+        if self.enabled:
+            self.disable()
+            self.dump()
+        else:
+            self.enable()
+
+    def trace(self):
+        """
+        Starts timing the stages of a message, for one of every 1 / sample_rate messages
+        :return: Trace, or None if the message is not sampled or profiling is disabled
+        """
+        if not self.enabled or self.every is None:
+            return None
+        self.messages += 1
+        return Trace(self) if self.messages % self.every == 0 else None
+
+    def stage(self, name):
+        """
+        :param name: name of the stage
+        :return: context manager that records the time of the block
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def record(self, name, wall, cpu):
+        with self.lock:
+            stats = self.stages.get(name)
+            if stats is None:
+                stats = self.stages[name] = [0, 0.0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+            stats[3] = max(stats[3], wall)
+
+    def sample_stacks(self):
+        own = threading.get_ident()
+        while self.enabled:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples = [f'{names.get(thread_id, thread_id)};{collapse(frame)}'
+                       for thread_id, frame in sys._current_frames().items() if thread_id != own]
+            with self.lock:
+                self.stacks.update(samples)
+            time.sleep(self.interval)
+
+    def get_stage_stats(self):
+        """
+        :return: dict with key=stage name, value=dict with the count and the total, mean and max times in seconds
+        """
+        with self.lock:
+            stages = {name: list(stats) for name, stats in self.stages.items()}
+        return {name: {'count': count, 'wall': wall, 'cpu': cpu, 'mean_wall': wall / count, 'mean_cpu': cpu / count,
+                       'max_wall': max_wall}
+                for name, (count, wall, cpu, max_wall) in stages.items()}
+
+    def dump(self):
+        """
+        Writes the collapsed stacks and the stage timings to output_dir, and logs the stage timings
+        :return: tuple with the paths of the stacks and the stages files
+        """
+        base = os.path.join(self.output_dir, f'profile-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}')
+        with self.lock:
+            stacks = list(self.stacks.items())
+        with open(f'{base}.folded', 'w') as f:
+            for stack, count in stacks:
+                f.write(f'{stack} {count}\n')
+        stages = self.get_stage_stats()
+        with open(f'{base}.stages.json', 'w') as f:
+            json.dump({'started': self.started, 'stages': stages}, f, indent=2)
+        for name, stats in sorted(stages.items(), key=lambda item: -item[1]['wall']):
+            self.log(logging.INFO, f'{name:>20}: {stats["count"]:8} calls, mean {stats["mean_wall"] * 1000:8.3f} ms '
+                                   f'wall {stats["mean_cpu"] * 1000:8.3f} ms cpu, max {stats["max_wall"] * 1000:8.3f} ms')
+        self.log(logging.INFO, f'Profile written to {base}.folded and {base}.stages.json')
+        return f'{base}.folded', f'{base}.stages.json'
+
+
+def collapse(frame):
+    """
+    :param frame: innermost frame of a stack
+    :return: string with the functions of the stack, outermost first, separated by ;
+    """
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(functions))
+
+
+# Profiler of the process, configured by MQWriter
+PROFILER = Profiler()
@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select
+
+from Metrics import REFERENCE_CACHE_HITS, REFERENCE_CACHE_MISSES
+from PacketDecoder import COLUMN_INDEX, PACKET_COLUMNS, as_bigint
+from auditing.db.Models import DataCollector, Organization
+
+# value cached for the ids that are not in the data_collector table
+UNKNOWN = object()
+
+
+class ReferenceCache:
+    """
+    Cache of the data collectors and their organizations, used to check the foreign keys of the packets before
+    they reach the database. Entries expire after ttl seconds and are reloaded, in a single query per batch, the
+    next time they are needed. The least recently used entries are forgotten beyond max_entries
+    """
+
+    def __init__(self, engine, ttl=300, max_entries=100000, columns=PACKET_COLUMNS, clock=time.monotonic,
+                 logger=None):
+        """
+        Initializes the instance
+        :param engine: sqlalchemy engine used to load the collectors
+        :param ttl: seconds during which a collector (or its absence) is trusted
+        :param max_entries: maximum number of collectors cached
+        :param columns: columns of the rows, in order
+        :param clock: function returning the current time in seconds
+        :param logger: logger instance (logging library) to use
+        """
+        self.engine = engine
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.logger = logger
+        index = {column: i for i, column in enumerate(columns)} if columns is not PACKET_COLUMNS else COLUMN_INDEX
+        self.collector_index = index['data_collector_id']
+        self.organization_index = index['organization_id']
+        # collector id -> (organization id or UNKNOWN, expiration time), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def load(self, ids=None):
+        """
+        Queries the organization of the collectors. Organizations that don't exist are returned as None
+        :param ids: collector ids to load. None to load all of them
+        :return: dict with key=collector id, value=organization id
+        """
+        query = select(DataCollector.id, Organization.id).select_from(
+            DataCollector.__table__.outerjoin(Organization.__table__, DataCollector.organization_id == Organization.id))
+        if ids is not None:
+            query = query.where(DataCollector.id.in_(list(ids)))
+        with self.engine.connect() as connection:
+            return {collector_id: organization_id for collector_id, organization_id in connection.execute(query)}
+
+    def store(self, mapping, ids, now):
+        with self.lock:
+            for collector_id in ids:
+                self.entries[collector_id] = (mapping.get(collector_id, UNKNOWN), now + self.ttl)
+                self.entries.move_to_end(collector_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def warm(self):
+        """
+        Loads every collector
+        :return: number of collectors loaded
+        """
+        start = time.perf_counter()
+        mapping = self.load()
+        self.store(mapping, list(mapping)[-self.max_entries:], self.clock())
+        self.log(logging.INFO, f'Loaded {len(mapping)} data collectors in {time.perf_counter() - start:.3f} s')
+        return len(mapping)
+
+    def resolve(self, ids):
+        """
+        Gets the organization of the collectors, loading the ones missing or expired with a single query
+        :param ids: iterable with collector ids. They are converted to int, as the ids of the table
+        :return: dict with key=collector id (as int, None for the ids that aren't integers), value=organization id
+        (None if it has none) or UNKNOWN. Collectors that could not be loaded (e.g. the database is not reachable)
+        are left out
+        """
+        now = self.clock()
+        resolved = {}
+        stale = set()
+        ids = {as_bigint(collector_id) for collector_id in ids}
+        if None in ids:
+            ids.discard(None)
+            resolved[None] = UNKNOWN
+        with self.lock:
+            for collector_id in ids:
+                entry = self.entries.get(collector_id)
+                if entry is not None and entry[1] > now:
+                    resolved[collector_id] = entry[0]
+                    self.entries.move_to_end(collector_id)
+                    self.hits += 1
+                else:
+                    stale.add(collector_id)
+                    self.misses += 1
+        REFERENCE_CACHE_HITS.inc(len(resolved))
+        REFERENCE_CACHE_MISSES.inc(len(stale))
+        if stale:
+            try:
+                mapping = self.load(stale)
+            except Exception as e:
+                # the rows are checked by the database instead
+                self.log(logging.WARNING, f'Could not load data collectors {sorted(stale)}: {e}')
+                return resolved
+            self.store(mapping, stale, now)
+            for collector_id in stale:
+                resolved[collector_id] = mapping.get(collector_id, UNKNOWN)
+        return resolved
+
+    def check(self, rows):
+        """
+        Checks the collector of every row and fills its organization_id from the collector. Collector ids received
+        as strings (e.g. '12') are converted to int
+        :param rows: list of tuples with the packet columns
+        :return: tuple with the list of valid rows and a list of (row, error) tuples with the rejected ones
+        """
+        collector_index = self.collector_index
+        organization_index = self.organization_index
+        organizations = self.resolve(row[collector_index] for row in rows)
+        checked = []
+        rejected = []
+        for row in rows:
+            collector_id = as_bigint(row[collector_index])
+            if collector_id is not None and collector_id != row[collector_index]:
+                row = row[:collector_index] + (collector_id,) + row[collector_index + 1:]
+            if collector_id not in organizations:
+                checked.append(row)
+                continue
+            organization_id = organizations[collector_id]
+            if organization_id is UNKNOWN:
+                rejected.append((row, f'Unknown data collector {row[collector_index]}'))
+            elif organization_id is None:
+                if row[organization_index] is None:
+                    rejected.append((row, f'Data collector {collector_id} has no organization'))
+                else:
+                    checked.append(row)
+            elif organization_id != row[organization_index]:
+                checked.append(row[:organization_index] + (organization_id,) + row[organization_index + 1:])
+            else:
+                checked.append(row)
+        return checked, rejected
+
+    def get_stats(self):
+        """
+        :return: dict with the number of hits, misses, the hit rate and the number of collectors cached
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'entries': len(self.entries),
+        }
@@ -1,29 +1,73 @@
 import datetime
-import gzip
 import io
 import json
 import logging
-from collections import defaultdict
+import threading
+import time
+import uuid
 
-import boto3
+from ArchiveEncoder import ArchiveEncoder
+from Metrics import ARCHIVE_ENCODE_SECONDS, ARCHIVES_UPLOADED, UPLOAD_SECONDS
+from Profiler import PROFILER
+from BackgroundUploader import BackgroundUploader
+from CollectorMessageBuffer import CollectorMessageBuffer
+
+WINDOWS = {'hour': datetime.timedelta(hours=1), 'day': datetime.timedelta(days=1)}
 
 
 class S3CollectorMessagesManager:
 
-    def __init__(self, aws_access_key, aws_secret_key, bucket_name, maximum_msgs_per_collector=500, logger=None):
+    def __init__(self, aws_access_key, aws_secret_key, bucket_name, maximum_msgs_per_collector=500, filename_suffix='',
+                 upload_workers=0, upload_queue_depth=16, upload_retries=3, encoder=None, memory_budget=None,
+                 max_age=None, eviction_policy='largest', window=None, window_grace=300, logger=None):
         """
         Initializes the instance
         :param aws_access_key: public aws api access key
         :param aws_secret_key: pricate aws api access key
         :param bucket_name: name of the base bucket to use
         :param maximum_msgs_per_collector: maximum number of messages to keep in memory before flushing to s3
+        :param filename_suffix: suffix appended to the file names, so several writer processes don't overwrite each other
+        :param upload_workers: number of threads compressing and uploading the messages in background.
+        With 0, messages are uploaded synchronously
+        :param upload_queue_depth: number of uploads that can wait for a free thread before intake is blocked
+        :param upload_retries: number of times a failed upload is retried (with exponential backoff)
+        :param encoder: ArchiveEncoder or ParquetArchiveEncoder used to encode the messages. Defaults to gzip json
+        :param memory_budget: approximate number of bytes buffered for all the collectors before flushing some of them
+        :param max_age: seconds after which the messages of a collector are flushed, even if it has few of them
+        :param eviction_policy: 'largest' or 'oldest'. Which collectors are flushed first when over the memory budget
+        :param window: 'hour' or 'day' to group the messages of each collector by the time window of their packet,
+        uploading each window to its own objects when it closes, with a manifest per window. None to archive the
+        messages by flush time
+        :param window_grace: seconds after the end of a window during which late messages are still expected
         :param logger: logger instance (logging library) to use
         """
         self.logger = logger
         self.MAX_MSGS_PER_COLLECTOR = maximum_msgs_per_collector
+        self.filename_suffix = filename_suffix
+        self.encoder = encoder or ArchiveEncoder()
         self.bucket_messages = self.get_bucket(aws_access_key, aws_secret_key, bucket_name)
-        # dictionary with key=dc_id, value=list of messages
-        self.messages_per_collector = defaultdict(list)
+        self.uploader = BackgroundUploader(workers=upload_workers, queue_depth=upload_queue_depth,
+                                           max_retries=upload_retries, logger=logger)
+        self.buffer = CollectorMessageBuffer(memory_budget=memory_budget, max_age=max_age,
+                                             eviction_policy=eviction_policy)
+        # dictionary with key=dc_id (or (dc_id, window start) with windows), value=list of messages
+        self.messages_per_collector = self.buffer.messages
+        if window is not None and window not in WINDOWS:
+            raise ValueError(f'Unknown archive window {window}. Valid options are: {", ".join(WINDOWS)}')
+        self.window = window
+        self.window_grace = window_grace
+        # window start -> objects uploaded for it, listed in its manifest
+        self.window_objects = {}
+        # window start -> number of objects listed in its last manifest
+        self.manifested = {}
+        # (dc_id, window start) -> number of parts uploaded
+        self.window_parts = {}
+        # window start -> number of parts being uploaded
+        self.window_uploads = {}
+        # windows whose manifest is written once their parts are uploaded
+        self.manifest_requested = set()
+        self.window_lock = threading.Lock()
+        self.last_window_check = 0
 
     def log(self, level, message):
         """
@@ -44,6 +88,8 @@ class S3CollectorMessagesManager:
         :return: boto3.Bucket instance for the desired bucket
         """
         self.log(logging.DEBUG, 'get s3 bucket')
+        # imported here so processes without S3 configured don't pay for it
+        import boto3
         session = boto3.Session(
             aws_access_key_id=aws_access_key,
             aws_secret_access_key=aws_secret_key
@@ -51,52 +97,225 @@ class S3CollectorMessagesManager:
         s3 = session.resource('s3')
         return s3.Bucket(bucket_name)
 
-    def save_collector_messages(self, data_collector_id, messages):
+    def save_collector_messages(self, data_collector_id, messages, dt=None):
         """
         Add messages to the internal dictionary. If the resultant number of messages is greater than MAX_MSGS_PER_COLLECTOR,
         the existing ones are sent to s3 first and the new ones will be saved to the dictionary only
         :param data_collector_id: id of the collector from which the messages came from
         :param messages: list of messages
+        :param dt: datetime of the messages (e.g. of their packet), used to choose their window. Defaults to now
         :return: nothing. Messages are saved to internal dictionary, potentially triggering a sending to s3
         """
         self.log(logging.DEBUG, f'Adding {len(messages)} messages to collector {data_collector_id}')
-        actual_msgs = self.get_messages_for_collector(data_collector_id)
+        key = self.buffer_key(data_collector_id, dt)
+        actual_msgs = self.messages_per_collector[key]
         self.log(logging.DEBUG, f'Actual messages: {len(actual_msgs)}')
         if (len(actual_msgs) + len(messages) > self.MAX_MSGS_PER_COLLECTOR):
             self.log(logging.DEBUG, 'Sending actual message list to s3 first')
-            self.send_messages_to_s3(data_collector_id, dt=datetime.datetime.now())
+            self.send_buffer(key)
 
         self.log(logging.DEBUG, 'extending actual messages list')
-        actual_msgs.extend(messages)
+        self.buffer.add(key, messages)
         self.log(logging.DEBUG, f'data collector {data_collector_id} now has {len(actual_msgs)} messages in the buffer')
+        self.flush_expired()
+
+    def flush_expired(self):
+        """
+        Sends to s3 the collectors whose oldest message is older than max_age and, if the memory budget is exceeded,
+        the collectors chosen by the eviction policy
+        :return: nothing
+        """
+        for key in self.buffer.expired():
+            self.log(logging.DEBUG, f'Messages of collector {key} expired')
+            self.send_buffer(key)
+        for key in self.buffer.over_budget():
+            self.log(logging.DEBUG, f'Memory budget exceeded, evicting collector {key}')
+            self.send_buffer(key)
+        if self.window is not None and time.monotonic() - self.last_window_check >= 1:
+            self.last_window_check = time.monotonic()
+            self.close_windows()
+
+    def buffer_key(self, data_collector_id, dt=None):
+        """
+        :return: key of the buffer for the messages of a collector: its id, or (id, window start) with windows
+        """
+        if self.window is None:
+            return data_collector_id
+        return data_collector_id, self.window_start(dt or datetime.datetime.now(datetime.timezone.utc))
+
+    def window_start(self, dt):
+        """
+        :param dt: datetime. Naive datetimes are taken as UTC
+        :return: datetime (UTC) where the window containing dt starts
+        """
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        else:
+            dt = dt.astimezone(datetime.timezone.utc)
+        start = dt.replace(minute=0, second=0, microsecond=0)
+        return start.replace(hour=0) if self.window == 'day' else start
+
+    def send_buffer(self, key):
+        """
+        Sends the messages buffered under a key to s3
+        :param key: key of the buffer, see buffer_key
+        :return: nothing
+        """
+        if self.window is None:
+            self.send_messages_to_s3(key, dt=datetime.datetime.now())
+        else:
+            self.send_messages_to_s3(key[0], dt=key[1], window=key[1])
+
+    def close_windows(self, now=None):
+        """
+        Uploads the messages of the windows that closed (window_grace seconds after their end) and their manifests.
+        Messages arriving later for a closed window are uploaded as a new part with a new manifest. Manifests of
+        windows with parts still being uploaded are written by the last of them, so this never waits for the uploads
+        :param now: current datetime (UTC)
+        :return: nothing
+        """
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        limit = now - WINDOWS[self.window] - datetime.timedelta(seconds=self.window_grace)
+        keys = [key for key in list(self.messages_per_collector) if key[1] <= limit]
+        with self.window_lock:
+            closed = {start for start, objects in self.window_objects.items()
+                      if start <= limit and self.manifested.get(start) != len(objects)}
+        closed.update(key[1] for key in keys)
+        for key in keys:
+            self.send_buffer(key)
+            self.buffer.remove(key)
+        for start in sorted(closed):
+            self.request_manifest(start)
+        # windows closed for a day are forgotten
+        forget = limit - datetime.timedelta(days=1)
+        with self.window_lock:
+            for start in [start for start in self.window_objects if start < forget]:
+                del self.window_objects[start]
+                self.manifested.pop(start, None)
+        for key in [key for key in self.window_parts if key[1] < forget]:
+            del self.window_parts[key]
+
+    def request_manifest(self, start):
+        """
+        Writes the manifest of a window, or lets the last of its parts being uploaded write it, so the consumer never
+        waits for the uploads
+        :param start: datetime where the window starts
+        :return: nothing
+        """
+        with self.window_lock:
+            if self.window_uploads.get(start, 0) > 0:
+                self.manifest_requested.add(start)
+                return
+        self.write_manifest(start)
+
+    def write_manifest(self, start, run=None):
+        """
+        Uploads the manifest of a window: the objects with its messages, for every collector
+        :param start: datetime where the window starts
+        :param run: function called with the upload and its arguments. Defaults to submitting it to the uploader
+        :return: nothing
+        """
+        with self.window_lock:
+            objects = list(self.window_objects.get(start, []))
+            self.manifested[start] = len(objects)
+        if len(objects) == 0:
+            return
+        manifest = {
+            'window_start': start.isoformat(),
+            'window_end': (start + WINDOWS[self.window]).isoformat(),
+            'messages': sum(entry['messages'] for entry in objects),
+            'objects': objects,
+        }
+        filename = self.get_manifest_filename(start)
+        self.log(logging.DEBUG, f'Writing manifest {filename} with {len(objects)} objects')
+        (run or self.uploader.submit)(self.upload_manifest, json.dumps(manifest).encode('utf-8'), filename)
+
+    def upload_manifest(self, data, filename):
+        self.bucket_messages.meta.client.upload_fileobj(io.BytesIO(data), self.bucket_messages.name, filename)
+
+    def get_usage(self):
+        """
+        :return: dict with the number of collectors, messages and approximate bytes currently buffered
+        """
+        return self.buffer.get_usage()
 
-    def send_messages_to_s3(self, data_collector_id, dt):
+    def send_messages_to_s3(self, data_collector_id, dt, window=None):
         """
         Send messages for collector to s3
         Messages are compacted using gzip and saved with a prefix created from datetime in 'dt' parameter
         :param data_collector_id: id of the data collector to save
         :param dt: packet datetime. It may contain messages from different days
+        :param window: start of the window of the messages, when they are grouped by window
         :return: nothing. Messages for given data collector are cleared from the internal dictionary
         """
-        messages = self.get_messages_for_collector(data_collector_id)
+        key = data_collector_id if window is None else (data_collector_id, window)
+        messages = self.messages_per_collector[key]
         if len(messages) == 0:
             self.log(logging.INFO, f'There are no messages for collector {data_collector_id}')
             return
 
         self.log(logging.DEBUG, f'sending {len(messages)} messages for collector {data_collector_id} to s3')
-        filename = self.get_filename(data_collector_id, dt)
+        part = None
+        if window is not None:
+            # a window may be uploaded in several parts (too many messages, memory budget, late messages)
+            part = self.window_parts[key] = self.window_parts.get(key, 0) + 1
+        filename = self.get_filename(data_collector_id, dt, part)
+        # the upload may run in background: it gets its own copy of the list
+        if window is None:
+            self.uploader.submit(self.upload_messages, list(messages), filename)
+        else:
+            with self.window_lock:
+                self.window_uploads[window] = self.window_uploads.get(window, 0) + 1
+            self.uploader.submit(self.upload_window_part, list(messages), filename, window, data_collector_id)
+        self.buffer.clear(key)
 
-        # zips the data to a memory file, then copy the file to s3 bucket
+    def upload_window_part(self, messages, filename, window, data_collector_id):
+        """
+        Uploads a part of a window (see upload_messages) and, if the window was closed meanwhile and this was its
+        last part being uploaded, its manifest
+        """
+        try:
+            self.uploader.run(self.upload_messages, messages, filename, window, data_collector_id)
+        finally:
+            with self.window_lock:
+                self.window_uploads[window] -= 1
+                last = self.window_uploads[window] == 0
+                if last:
+                    del self.window_uploads[window]
+                requested = last and window in self.manifest_requested
+                if requested:
+                    self.manifest_requested.discard(window)
+            if requested:
+                # already in an uploader thread: submitting could wait for a slot held by this task
+                self.write_manifest(window, run=self.uploader.run)
+
+    def upload_messages(self, messages, filename, window=None, data_collector_id=None):
+        """
+        Compresses the messages and uploads them to s3. It may run in an uploader thread
+        :param messages: list of messages
+        :param filename: key of the object to create
+        :param window: start of the window of the messages, to list the object in its manifest
+        :param data_collector_id: id of the collector of the messages
+        :return: nothing
+        """
+        # compresses the data to a memory file, then copy the file to s3 bucket
+        start = time.perf_counter()
         f = io.BytesIO()
-        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
-            for msg in messages:
-                # write one json per line so it can be consumed by spark easily
-                json_str = json.dumps(msg)
-                gz.write(bytes(json_str + '\n', encoding='utf-8'))
+        with PROFILER.stage('archive_encode'):
+            self.encoder.encode_to(messages, f)
         f.seek(0)
-        self.bucket_messages.upload_fileobj(f, filename)
+        encoded = time.perf_counter()
+        ARCHIVE_ENCODE_SECONDS.observe(encoded - start)
+        # boto3 resources are not thread safe, but clients are
+        with PROFILER.stage('archive_upload'):
+            self.bucket_messages.meta.client.upload_fileobj(f, self.bucket_messages.name, filename)
         f.close()
-        self.clear_collector_messages(data_collector_id)
+        UPLOAD_SECONDS.observe(time.perf_counter() - encoded)
+        ARCHIVES_UPLOADED.inc()
+        if window is not None:
+            with self.window_lock:
+                self.window_objects.setdefault(window, []).append(
+                    {'key': filename, 'data_collector_id': data_collector_id, 'messages': len(messages)})
 
     def get_messages_for_collector(self, data_collector_id):
         """
@@ -113,7 +332,7 @@ class S3CollectorMessagesManager:
         :return: nothing. Message list for the collector is cleared in dictionary
         """
         self.log(logging.DEBUG, f'Clearing messages list for collector {data_collector_id}')
-        self.messages_per_collector[data_collector_id].clear()
+        self.buffer.clear(data_collector_id)
 
     def flush_all(self):
         """
@@ -121,14 +340,61 @@ class S3CollectorMessagesManager:
         :return: nothing. Data for all collectors is send to s3
         """
         self.log(logging.DEBUG, 'Sending all remaining messages to s3')
-        for id in self.messages_per_collector:
-            self.send_messages_to_s3(id, dt=datetime.datetime.now())
+        for id in list(self.messages_per_collector):
+            self.send_buffer(id)
+        self.log(logging.DEBUG, f'Waiting for {self.uploader.in_flight()} uploads')
+        self.uploader.wait()
+        if self.window is not None:
+            # manifests of the windows flushed now (or with parts uploaded since their last manifest) list the objects
+            # uploaded so far. They are rewritten when they close
+            with self.window_lock:
+                changed = [start for start, objects in self.window_objects.items()
+                           if self.manifested.get(start) != len(objects)]
+            for start in sorted(changed):
+                self.write_manifest(start)
+            self.uploader.wait()
 
-    def get_filename(self, data_collector_id, dt):
+    def get_buffered_counts(self):
+        """
+        Number of buffered messages per collector. Safe to call from other threads
+        :return: dict with key=dc_id, value=number of messages
+        """
+        counts = {}
+        for key, messages in list(self.messages_per_collector.items()):
+            if len(messages) > 0:
+                data_collector_id = key[0] if isinstance(key, tuple) else key
+                counts[data_collector_id] = counts.get(data_collector_id, 0) + len(messages)
+        return counts
+
+    def get_filename(self, data_collector_id, dt, part=None):
         """
         Constructs the filename to use for a messages packet to send to s3
         :param data_collector_id: id of the collector
         :param dt: datetime to use for the packet
+        :param part: number of the part of the window, when messages are grouped by window
         :return: string with the complete name of the file (prefix+filename+ext)
         """
-        return f'year={dt.year:04}/month={dt.year:04}{dt.month:02}/day={dt.year:04}{dt.month:02}{dt.day:02}/collector={data_collector_id}/messages_collector_{data_collector_id}_{dt.strftime("%Y-%m-%d %H:%M:%S")}.json.gz'
+        # the part number restarts with the process and differs between replicas: the flush time and a random id
+        # make the name unique, so parts never overwrite each other
+        part_suffix = f'_part{part:04}_{unique_id()}' if part is not None else ''
+        return f'{self.get_prefix(dt)}/collector={data_collector_id}/messages_collector_{data_collector_id}_{dt.strftime("%Y-%m-%d %H:%M:%S")}{part_suffix}{self.filename_suffix}{self.encoder.extension}'
+
+    def get_manifest_filename(self, start):
+        """
+        :param start: datetime where the window starts
+        :return: new name for a manifest of the window. It starts with _ so readers of the partitions skip it.
+        Every manifest gets its own object: the objects of a window are the union of the ones listed by its manifests
+        """
+        window = start.strftime("%Y-%m-%d %H:%M:%S")
+        return f'{self.get_prefix(start)}/_manifest_{window}_{unique_id()}{self.filename_suffix}.json'
+
+    def get_prefix(self, dt):
+        # the month partition is year and month (YYYYMM), the day partition YYYYMMDD
+        return f'year={dt.year:04}/month={dt.year:04}{dt.month:02}/day={dt.year:04}{dt.month:02}{dt.day:02}'
+
+
+def unique_id():
+    """
+    :return: string with the current time in milliseconds and a random id
+    """
+    return f'{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}'
@@ -0,0 +1,59 @@
+import zlib
+
+QUEUE_NAME = 'collectors_queue'
+MODES = ('routing-key', 'consistent-hash')
+
+
+def shard_for(key, shard_count):
+    """
+    Stable shard of a key (e.g. the data collector id), the same in every process and language: crc32 of the
+    key as a string, modulo the number of shards. Publishers use it to pick the routing key
+    :param key: data_collector_id or organization_id
+    :param shard_count: number of shards
+    :return: shard index, between 0 and shard_count - 1
+    """
+    return zlib.crc32(str(key).encode('utf-8')) % shard_count
+
+
+def shard_queue_name(shard, queue_name=QUEUE_NAME):
+    """
+    :param shard: shard index
+    :return: name of the queue of the shard. It's also its routing key
+    """
+    return f'{queue_name}.{shard}'
+
+
+def owned_shards(shard_count, shard_indexes=None, worker_id=None, processes=1):
+    """
+    Shards consumed by a worker. Each shard is consumed by a single worker, so the packets of a collector
+    are written in order
+    :param shard_count: total number of shards
+    :param shard_indexes: shards assigned to this instance (e.g. one pod per shard). None for all of them
+    :param worker_id: id of the worker process. None when running a single process
+    :param processes: number of worker processes of this instance
+    :return: list of shard indexes
+    """
+    shards = sorted(shard_indexes) if shard_indexes is not None else list(range(shard_count))
+    for shard in shards:
+        if not 0 <= shard < shard_count:
+            raise ValueError(f'Shard {shard} out of range: there are {shard_count} shards')
+    if worker_id is None:
+        return shards
+    return shards[worker_id::processes]
+
+
+def parse_shard_indexes(value):
+    """
+    :param value: comma separated shard indexes or ranges (e.g. '0,2,4-7'). Empty for None
+    :return: list of shard indexes, or None
+    """
+    if not value:
+        return None
+    shards = []
+    for part in value.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            shards.extend(range(int(first), int(last) + 1))
+        else:
+            shards.append(int(part))
+    return shards
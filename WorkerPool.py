@@ -0,0 +1,173 @@
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+# signals of the supervisor sent to every worker, besides SIGTERM and SIGINT
+FORWARDED_SIGNALS = (signal.SIGUSR1, signal.SIGUSR2)
+
+
+class WorkerCounters:
+
+    def __init__(self):
+        """
+        Counters updated by a single worker and read by the supervisor.
+        They are unsynchronized shared memory values: each one has a single writer
+        """
+        self.messages = multiprocessing.RawValue('Q', 0)
+        self.packets = multiprocessing.RawValue('Q', 0)
+
+
+class WorkerPool:
+
+    def __init__(self, target, processes=None, report_interval=60, restart_backoff=1, max_restart_backoff=60,
+                 stable_after=60, clock=time.monotonic, logger=None):
+        """
+        Initializes the instance
+        :param target: function run by each worker process, called with (worker_id, counters).
+        Workers must stop consuming and flush their buffers when they receive SIGTERM
+        :param processes: number of worker processes. Defaults to the number of CPUs
+        :param report_interval: seconds between throughput reports
+        :param restart_backoff: seconds before restarting a worker that died before stable_after. The delay doubles
+        with every consecutive early exit, so a worker that can't start (e.g. the broker is unreachable) doesn't make
+        the supervisor fork in a loop
+        :param max_restart_backoff: maximum seconds before restarting a worker
+        :param stable_after: seconds a worker must stay up to be restarted at once, resetting its backoff
+        :param clock: function returning the current time in seconds
+        :param logger: logger instance (logging library) to use
+        """
+        self.target = target
+        self.processes = processes or os.cpu_count() or 1
+        self.report_interval = report_interval
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.stable_after = stable_after
+        self.clock = clock
+        self.logger = logger
+        self.context = multiprocessing.get_context('fork')
+        self.counters = [WorkerCounters() for _ in range(self.processes)]
+        self.workers = [None] * self.processes
+        self.started_at = [None] * self.processes
+        # consecutive early exits of each worker, and when the dead ones are restarted
+        self.failures = [0] * self.processes
+        self.restart_at = [None] * self.processes
+        self.stopping = False
+
+    def log(self, level, message):
+        """
+        proxy to filter log messages if logger is not initialized
+        :param level: level of the message (logging.INFO, logging.DEBUG, etc)
+        :param message: string to log
+        :return: nothing. Message gets logged if the logger is defined
+        """
+        if self.logger:
+            self.logger.log(level, message)
+
+    def start_worker(self, worker_id):
+        process = self.context.Process(target=self.run_worker, args=(worker_id,),
+                                       name=f'PacketWriter-{worker_id}')
+        process.start()
+        self.workers[worker_id] = process
+        self.started_at[worker_id] = self.clock()
+        self.log(logging.INFO, f'Started worker {worker_id} (pid {process.pid})')
+
+    def schedule_restart(self, worker_id):
+        """
+        Decides when a worker that died is restarted: at once if it was up for stable_after seconds, after an
+        exponential backoff otherwise
+        :param worker_id: index of the worker
+        :return: seconds until the worker is restarted
+        """
+        now = self.clock()
+        if now - self.started_at[worker_id] >= self.stable_after:
+            self.failures[worker_id] = 0
+            delay = 0
+        else:
+            self.failures[worker_id] += 1
+            delay = min(self.restart_backoff * 2 ** (self.failures[worker_id] - 1), self.max_restart_backoff)
+        self.restart_at[worker_id] = now + delay
+        return delay
+
+    def run_worker(self, worker_id):
+        # workers get the default SIGTERM handling (the target may install its own) and leave SIGINT to the supervisor
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for signum in FORWARDED_SIGNALS:
+            signal.signal(signum, signal.SIG_IGN)
+        self.target(worker_id, self.counters[worker_id])
+
+    def stop(self, signum=None, frame=None):
+        """
+        Asks every worker to stop. Workers drain their packet batch and collector message buffers before exiting
+        :return: nothing
+        """
+        if self.stopping:
+            return
+        self.stopping = True
+        self.log(logging.INFO, 'Stopping workers')
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+
+    def forward(self, signum, frame=None):
+        """
+        Sends a signal (e.g. the profiler toggle) to every worker
+        :return: nothing
+        """
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    def totals(self):
+        """
+        :return: tuple with the total (messages consumed, packets written) by all the workers
+        """
+        return (sum(c.messages.value for c in self.counters),
+                sum(c.packets.value for c in self.counters))
+
+    def run(self):
+        """
+        Starts the workers and supervises them until all of them exit. Workers that die unexpectedly are restarted,
+        after a backoff if they died soon after starting (see schedule_restart).
+        SIGTERM and SIGINT are forwarded to the workers, as well as SIGUSR1 and SIGUSR2 (see Profiler)
+        :return: nothing
+        """
+        for worker_id in range(self.processes):
+            self.start_worker(worker_id)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for signum in FORWARDED_SIGNALS:
+            signal.signal(signum, self.forward)
+
+        last_report = time.monotonic()
+        last_totals = self.totals()
+        while (any(process.is_alive() for process in self.workers) or
+               (not self.stopping and any(at is not None for at in self.restart_at))):
+            for worker_id, process in enumerate(self.workers):
+                if self.restart_at[worker_id] is not None:
+                    if self.stopping:
+                        self.restart_at[worker_id] = None
+                    elif self.clock() >= self.restart_at[worker_id]:
+                        self.restart_at[worker_id] = None
+                        self.start_worker(worker_id)
+                    continue
+                process.join(timeout=1)
+                if not process.is_alive() and not self.stopping:
+                    delay = self.schedule_restart(worker_id)
+                    self.log(logging.ERROR, f'Worker {worker_id} exited with code {process.exitcode}, '
+                                            f'restarting it in {delay:.1f} s')
+            pending = [at for at in self.restart_at if at is not None]
+            if pending and not any(process.is_alive() for process in self.workers):
+                # every worker is waiting to be restarted: nothing to join
+                time.sleep(min(max(min(pending) - self.clock(), 0), 1))
+
+            now = time.monotonic()
+            if now - last_report >= self.report_interval:
+                totals = self.totals()
+                elapsed = now - last_report
+                self.log(logging.INFO, f'{self.processes} workers: {(totals[0] - last_totals[0]) / elapsed:.1f} msgs/s, '
+                                       f'{(totals[1] - last_totals[1]) / elapsed:.1f} packets/s '
+                                       f'({totals[0]} messages, {totals[1]} packets in total)')
+                last_report, last_totals = now, totals
+        self.log(logging.INFO, f'All workers stopped. {self.totals()[0]} messages, {self.totals()[1]} packets in total')
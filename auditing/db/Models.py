@@ -1,5 +1,5 @@
-from sqlalchemy import Column, DateTime, String, Integer, BigInteger, SmallInteger, Float, Boolean, ForeignKey, func, func, LargeBinary
-from auditing.db import session, Base, engine
+from sqlalchemy import Column, DateTime, String, Integer, BigInteger, SmallInteger, Float, Boolean, ForeignKey, func, func, LargeBinary, Text
+from auditing.db import session, Base
 from sqlalchemy.dialects import postgresql, sqlite
 
 BigIntegerType = BigInteger()
@@ -117,8 +117,61 @@ class Packet(Base):
     app_name = Column(String(100), nullable=True)
     dev_name = Column(String(100), nullable=True)
     gw_name= Column(String(128), nullable=True)
+    # json list with the [gateway, rssi, lsnr] of every copy of the packet, when duplicates are collapsed
+    receptions = Column(Text, nullable=True)
 
 
+class PacketDeadLetter(Base):
+    __tablename__ = 'packet_dead_letter'
+    id = Column(BigIntegerType, primary_key=True, autoincrement=True)
+    date = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    data_collector_id = Column(BigIntegerType, nullable=True)
+    error = Column(String(1024), nullable=True)
+    payload = Column(Text, nullable=True)
+
+
+class DeviceRollup(Base):
+    # aggregates of the packets of each device, upserted by the writer with every batch (see PacketRollups)
+    __tablename__ = 'device_rollup'
+    data_collector_id = Column(BigIntegerType, primary_key=True)
+    # 'dev_addr' for data frames, 'dev_eui' for join requests
+    device_type = Column(String(8), primary_key=True)
+    device = Column(String(16), primary_key=True)
+    organization_id = Column(BigIntegerType, nullable=True)
+    first_seen = Column(DateTime(timezone=True), nullable=False)
+    last_seen = Column(DateTime(timezone=True), nullable=False)
+    packets = Column(BigIntegerType, nullable=False)
+    last_f_count = Column(Integer, nullable=True)
+    # frames skipped by the frame counter (lost packets), excluding counter resets
+    f_count_gaps = Column(BigIntegerType, nullable=False)
+    rssi_count = Column(BigIntegerType, nullable=False)
+    rssi_sum = Column(BigIntegerType, nullable=False)
+    rssi_min = Column(Integer, nullable=True)
+    rssi_max = Column(Integer, nullable=True)
+    lsnr_count = Column(BigIntegerType, nullable=False)
+    lsnr_sum = Column(Float, nullable=False)
+    lsnr_min = Column(Float, nullable=True)
+    lsnr_max = Column(Float, nullable=True)
+
+
+class GatewayRollup(Base):
+    # aggregates of the packets received by each gateway, upserted by the writer with every batch
+    __tablename__ = 'gateway_rollup'
+    data_collector_id = Column(BigIntegerType, primary_key=True)
+    gateway = Column(String(16), primary_key=True)
+    organization_id = Column(BigIntegerType, nullable=True)
+    first_seen = Column(DateTime(timezone=True), nullable=False)
+    last_seen = Column(DateTime(timezone=True), nullable=False)
+    packets = Column(BigIntegerType, nullable=False)
+    rssi_count = Column(BigIntegerType, nullable=False)
+    rssi_sum = Column(BigIntegerType, nullable=False)
+    rssi_min = Column(Integer, nullable=True)
+    rssi_max = Column(Integer, nullable=True)
+    lsnr_count = Column(BigIntegerType, nullable=False)
+    lsnr_sum = Column(Float, nullable=False)
+    lsnr_min = Column(Float, nullable=True)
+    lsnr_max = Column(Float, nullable=True)
+
 
 class Organization(Base):
     __tablename__ = "organization"
@@ -149,6 +202,3 @@ def begin():
 
 def rollback():
     session.rollback()
-
- 
-Base.metadata.create_all(engine)
\ No newline at end of file
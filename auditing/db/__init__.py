@@ -1,24 +1,91 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+import logging
 import os
+import time
 
 if "ENVIRONMENT" not in os.environ:
     DB_HOST = "localhost"
     DB_NAME = "loraguard_db"
     DB_USERNAME = "postgres"
-    DB_PASSWORD = "postgres" 
+    DB_PASSWORD = "postgres"
     DB_PORT = 5432
     os.environ["ENVIRONMENT"] = "DEV"
 else:
-    DB_HOST = os.environ["DB_HOST"] 
-    DB_NAME = os.environ["DB_NAME"] 
-    DB_USERNAME = os.environ["DB_USERNAME"] 
-    DB_PASSWORD = os.environ["DB_PASSWORD"] 
-    DB_PORT = os.environ["DB_PORT"] 
+    DB_HOST = os.environ["DB_HOST"]
+    DB_NAME = os.environ["DB_NAME"]
+    DB_USERNAME = os.environ["DB_USERNAME"]
+    DB_PASSWORD = os.environ["DB_PASSWORD"]
+    DB_PORT = os.environ["DB_PORT"]
 
-engine = create_engine('postgresql+psycopg2://{user}:{pw}@{url}:{port}/{db}'.format(user=DB_USERNAME, pw=DB_PASSWORD, url=DB_HOST, port= DB_PORT, db=DB_NAME))
+# Connections kept open by each process, and extra connections allowed under load (e.g. while the spool drains)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+# Test connections before using them, so a database restart doesn't fail the next batch
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# Rows per statement when sqlalchemy sends several rows with executemany
+DB_EXECUTEMANY_PAGE_SIZE = int(os.environ.get('DB_EXECUTEMANY_PAGE_SIZE', 1000))
+# synchronous_commit for the writer connections (e.g. 'off' trades the last commits on a server crash for latency).
+# Empty to keep the server setting
+DB_SYNCHRONOUS_COMMIT = os.environ.get('DB_SYNCHRONOUS_COMMIT') or None
+SYNCHRONOUS_COMMIT_VALUES = ('on', 'off', 'local', 'remote_write', 'remote_apply')
+
+
+def build_engine(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=DB_POOL_PRE_PING,
+                 executemany_page_size=DB_EXECUTEMANY_PAGE_SIZE, synchronous_commit=DB_SYNCHRONOUS_COMMIT):
+    """
+    Builds the engine used by the writer. The pool is thread safe: concurrent flushers check out their own
+    connection, so pool_size + max_overflow must cover them
+    :param pool_size: connections kept open
+    :param max_overflow: connections that may be opened beyond pool_size
+    :param pool_pre_ping: test connections when they are checked out
+    :param executemany_page_size: rows per statement for executemany
+    :param synchronous_commit: value of synchronous_commit for every connection. None to keep the server setting
+    :return: sqlalchemy engine
+    """
+    if synchronous_commit is not None and synchronous_commit not in SYNCHRONOUS_COMMIT_VALUES:
+        raise ValueError(f'Invalid synchronous_commit {synchronous_commit}. '
+                         f'Valid options are: {", ".join(SYNCHRONOUS_COMMIT_VALUES)}')
+    new_engine = create_engine('postgresql+psycopg2://{user}:{pw}@{url}:{port}/{db}'.format(user=DB_USERNAME, pw=DB_PASSWORD, url=DB_HOST, port= DB_PORT, db=DB_NAME),
+                               pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=pool_pre_ping,
+                               executemany_mode='values_plus_batch',
+                               executemany_values_page_size=executemany_page_size,
+                               executemany_batch_page_size=executemany_page_size)
+    if synchronous_commit is not None:
+        @event.listens_for(new_engine, 'connect')
+        def set_synchronous_commit(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f'SET synchronous_commit TO {synchronous_commit}')
+            cursor.close()
+            dbapi_connection.commit()
+    return new_engine
+
+
+def check_connection(engine, samples=5, logger=None):
+    """
+    Startup self-check: runs a trivial query a few times and reports the round-trip latency
+    :param engine: sqlalchemy engine
+    :param samples: number of round trips to measure
+    :param logger: logger instance (logging library) to use
+    :return: median round-trip latency in seconds. An exception is raised if the database is not reachable
+    """
+    latencies = []
+    with engine.connect() as connection:
+        for _ in range(samples):
+            start = time.perf_counter()
+            connection.execute(text('SELECT 1'))
+            latencies.append(time.perf_counter() - start)
+    latency = sorted(latencies)[len(latencies) // 2]
+    if logger:
+        logger.log(logging.INFO, f'Database round-trip latency: {latency * 1000:.2f} ms '
+                                 f'(max {max(latencies) * 1000:.2f} ms)')
+    return latency
+
+
+engine = build_engine()
 Base = declarative_base()
 sessionBuilder = sessionmaker()
 sessionBuilder.configure(bind=engine)
-session = sessionBuilder()
\ No newline at end of file
+# each thread gets its own session (and connection)
+session = scoped_session(sessionBuilder)
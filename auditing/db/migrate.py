@@ -0,0 +1,178 @@
+"""
+Creates the tables used by the packet writer, if they don't exist. The writer itself never runs DDL, so this
+must be run once before starting a new deployment or version:
+python -m auditing.db.migrate [--partition day|week] [--backfill-rollups]
+"""
+import argparse
+import datetime
+import logging
+
+from sqlalchemy import inspect, text
+
+from auditing.db import Base, engine
+# registers the tables in Base.metadata
+from auditing.db import Models  # noqa: F401
+
+
+def migrate(bind=engine, logger=None):
+    """
+    Creates the missing tables and columns
+    :param bind: engine or connection to run the statements with
+    :param logger: logger instance (logging library) to use
+    :return: nothing
+    """
+    Base.metadata.create_all(bind)
+    add_missing_columns(bind, logger)
+    if logger:
+        logger.log(logging.INFO, f'Schema is up to date: {", ".join(sorted(Base.metadata.tables))}')
+
+
+def add_missing_columns(bind=engine, logger=None):
+    """
+    create_all doesn't change existing tables: adds the (nullable) columns added to the models since they were
+    created, e.g. packet.receptions
+    :param bind: engine to run the statements with
+    :param logger: logger instance (logging library) to use
+    :return: nothing
+    """
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if logger:
+                    logger.log(logging.INFO, f'Adding column {table.name}.{column.name}')
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {column.name} '
+                                        f'{column.type.compile(dialect=bind.dialect)}'))
+
+
+def find_missing(bind=engine, tables=(), columns=()):
+    """
+    Checks that objects created by migrate exist, without running any DDL
+    :param bind: engine to inspect
+    :param tables: names of the tables needed
+    :param columns: (table, column) tuples needed
+    :return: list with the tables (and table.column) that don't exist
+    """
+    inspector = inspect(bind)
+    missing = [table for table in tables if not inspector.has_table(table)]
+    for table, column in columns:
+        if not inspector.has_table(table):
+            missing.append(table)
+        elif column not in {existing['name'] for existing in inspector.get_columns(table)}:
+            missing.append(f'{table}.{column}')
+    return missing
+
+
+def partition_packet_table(interval='day', bind=engine, logger=None):
+    """
+    Converts the packet table into a table partitioned by range on date. The existing table is renamed to
+    packet_legacy and attached as the partition of every date before the next partition boundary, so no rows
+    are copied. The primary key becomes (id, date) and the foreign key from collector_message.packet_id is
+    dropped, as PostgreSQL can't reference a partitioned table by id alone. Writers must be stopped while it runs
+    :param interval: 'day' or 'week', the interval of the partitions that PacketPartitioner will create
+    :param bind: engine to run the statements with
+    :param logger: logger instance (logging library) to use
+    :return: nothing. Does nothing if the table is already partitioned
+    """
+    from PacketPartitions import INTERVALS, PacketPartitioner
+
+    table = Models.Packet.__tablename__
+    partitioner = PacketPartitioner(bind, interval=interval, table_name=table)
+    cutover = partitioner.partition_start(datetime.datetime.now(datetime.timezone.utc)) + INTERVALS[interval]
+    connection = bind.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", (table,))
+        if cursor.fetchone()[0] == 'p':
+            if logger:
+                logger.log(logging.INFO, f'{table} is already partitioned')
+            return
+        cursor.execute(f'ALTER TABLE {Models.CollectorMessage.__tablename__} '
+                       f'DROP CONSTRAINT IF EXISTS {Models.CollectorMessage.__tablename__}_packet_id_fkey')
+        cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+        cursor.execute(f'CREATE TABLE {table} (LIKE {table}_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+                       f'PARTITION BY RANGE (date)')
+        cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (id, date)')
+        # the equivalent foreign keys of packet_legacy are reused when it's attached
+        for column in Models.Packet.__table__.columns:
+            for foreign_key in column.foreign_keys:
+                cursor.execute(f'ALTER TABLE {table} ADD FOREIGN KEY ({column.name}) '
+                               f'REFERENCES {foreign_key.column.table.name} ({foreign_key.column.name})')
+        # the check lets the attach skip validating the rows a second time
+        cursor.execute(f"ALTER TABLE {table}_legacy ADD CONSTRAINT {table}_legacy_date_check "
+                       f"CHECK (date < '{cutover.isoformat()}')")
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {table}_legacy "
+                       f"FOR VALUES FROM (MINVALUE) TO ('{cutover.isoformat()}')")
+        cursor.close()
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    if logger:
+        logger.log(logging.INFO, f'{table} is now partitioned by {interval}. Previous rows are in {table}_legacy')
+    partitioner.maintain()
+
+
+def backfill_rollups(bind=engine, logger=None):
+    """
+    Fills device_rollup and gateway_rollup from the packets already in the packet table. Devices and gateways that
+    already have a rollup are skipped, so it must be run before enabling PACKET_ROLLUPS in the writers
+    :param bind: engine to run the statements with
+    :param logger: logger instance (logging library) to use
+    :return: nothing
+    """
+    devices = Models.DeviceRollup.__tablename__
+    gateways = Models.GatewayRollup.__tablename__
+    packets = Models.Packet.__tablename__
+    with bind.begin() as connection:
+        result = connection.execute(text(f"""
+            INSERT INTO {devices} (data_collector_id, device_type, device, organization_id, first_seen, last_seen,
+                                   packets, last_f_count, f_count_gaps, rssi_count, rssi_sum, rssi_min, rssi_max,
+                                   lsnr_count, lsnr_sum, lsnr_min, lsnr_max)
+            SELECT data_collector_id, device_type, device, max(organization_id), min(date), max(date), count(*),
+                   (array_agg(f_count ORDER BY date DESC))[1], coalesce(sum(gap), 0), count(rssi),
+                   coalesce(sum(rssi), 0), min(rssi), max(rssi), count(lsnr), coalesce(sum(lsnr), 0), min(lsnr),
+                   max(lsnr)
+            FROM (SELECT data_collector_id, organization_id, date, f_count, rssi, lsnr,
+                         CASE WHEN dev_addr IS NOT NULL THEN 'dev_addr' ELSE 'dev_eui' END AS device_type,
+                         coalesce(dev_addr, dev_eui) AS device,
+                         greatest(f_count - lag(f_count) OVER (PARTITION BY data_collector_id, dev_addr, dev_eui
+                                                               ORDER BY date) - 1, 0) AS gap
+                  FROM {packets} WHERE dev_addr IS NOT NULL OR dev_eui IS NOT NULL) device_packets
+            GROUP BY data_collector_id, device_type, device
+            ON CONFLICT DO NOTHING"""))
+        if logger:
+            logger.log(logging.INFO, f'Added {result.rowcount} rows to {devices}')
+        result = connection.execute(text(f"""
+            INSERT INTO {gateways} (data_collector_id, gateway, organization_id, first_seen, last_seen, packets,
+                                    rssi_count, rssi_sum, rssi_min, rssi_max, lsnr_count, lsnr_sum, lsnr_min, lsnr_max)
+            SELECT data_collector_id, gateway, max(organization_id), min(date), max(date), count(*), count(rssi),
+                   coalesce(sum(rssi), 0), min(rssi), max(rssi), count(lsnr), coalesce(sum(lsnr), 0), min(lsnr),
+                   max(lsnr)
+            FROM {packets} WHERE gateway IS NOT NULL
+            GROUP BY data_collector_id, gateway
+            ON CONFLICT DO NOTHING"""))
+        if logger:
+            logger.log(logging.INFO, f'Added {result.rowcount} rows to {gateways}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Creates the tables used by the packet writer')
+    parser.add_argument('--partition', choices=('day', 'week'),
+                        help='convert the packet table into a table partitioned by date')
+    parser.add_argument('--backfill-rollups', action='store_true',
+                        help='fill the device and gateway rollups from the existing packets')
+    args = parser.parse_args()
+    migrate(logger=logging.getLogger())
+    if args.partition:
+        partition_packet_table(args.partition, logger=logging.getLogger())
+    if args.backfill_rollups:
+        backfill_rollups(logger=logging.getLogger())
@@ -0,0 +1,58 @@
+"""
+Compares the archive encoders on realistic collector messages: throughput (MB/s of uncompressed json)
+and compression ratio, for the json codecs and for parquet (when pyarrow is installed).
+The baseline is the previous json.dumps + bytes concat + GzipFile.write per message.
+Usage: python -m benchmarks.bench_archive_encoder [messages]
+"""
+import gzip
+import io
+import json
+import random
+import sys
+import time
+
+from ArchiveEncoder import ArchiveEncoder, orjson, zstandard
+from ParquetArchiveEncoder import ParquetArchiveEncoder, pyarrow
+from benchmarks.payloads import make_body
+
+
+def baseline(messages):
+    f = io.BytesIO()
+    with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+        for msg in messages:
+            json_str = json.dumps(msg)
+            gz.write(bytes(json_str + '\n', encoding='utf-8'))
+    return f.getvalue()
+
+
+def measure(name, encode, messages, raw_size, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = encode(messages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:>14}: {raw_size / best / 1e6:8.1f} MB/s  ratio {raw_size / len(data):5.2f}')
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rnd = random.Random(42)
+    messages = [dict(msg, packet_id=i, timestamp='2020-02-01T10:00:00+00:00')
+                for i in range(total) for msg in json.loads(make_body(i, rnd=rnd))['messages']]
+    raw_size = sum(len(json.dumps(msg)) + 1 for msg in messages)
+    print(f'{len(messages)} messages, {raw_size / 1e6:.2f} MB of json. orjson: {orjson is not None}')
+
+    measure('baseline', baseline, messages, raw_size)
+    for level in (1, 6, 9):
+        measure(f'gzip-{level}', ArchiveEncoder('gzip', level).encode, messages, raw_size)
+    if zstandard is not None:
+        for level in (1, 3, 9):
+            measure(f'zstd-{level}', ArchiveEncoder('zstd', level).encode, messages, raw_size)
+    if pyarrow is not None:
+        for codec in ('snappy', 'zstd', 'gzip'):
+            measure(f'parquet-{codec}', ParquetArchiveEncoder(codec).encode, messages, raw_size)
+
+
+if __name__ == '__main__':
+    main()
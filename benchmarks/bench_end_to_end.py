@@ -0,0 +1,141 @@
+"""
+End-to-end benchmark of the writer: generated deliveries go through MQWriter.callback (decoding, batching,
+acknowledgements and raw message archiving) with in-process stand-ins for RabbitMQ and S3. Packets are discarded
+unless --database is given, in which case they are written to the packet table of the configured database (the
+data collectors and organizations used must exist).
+Reports the throughput, the end-to-end latency (from when a delivery is due until its packet is written) and the
+peak RSS. With --rate the deliveries follow a fixed schedule, so the latency includes the time they wait.
+Usage: python -m benchmarks.bench_end_to_end --messages 50000 --collectors 20 --rate 2000
+"""
+import argparse
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+from types import SimpleNamespace
+
+import MQWriter
+from ArchiveEncoder import ArchiveEncoder
+from ParquetArchiveEncoder import ParquetArchiveEncoder
+from LogCollectorMessagesManager import LogCollectorMessagesManager
+from Profiler import PROFILER
+from S3CollectorMessagesManager import S3CollectorMessagesManager
+from benchmarks.fakes import FakeBucket, FakeChannel, RecordingPacketWriter
+from benchmarks.payloads import generate_load
+
+
+class BenchS3CollectorMessagesManager(S3CollectorMessagesManager):
+
+    def __init__(self, bucket, **kwargs):
+        self.fake_bucket = bucket
+        super().__init__(aws_access_key=None, aws_secret_key=None, bucket_name=bucket.name, **kwargs)
+
+    def get_bucket(self, aws_access_key, aws_secret_key, bucket_name):
+        return self.fake_bucket
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    rnd = random.Random(args.seed)
+    deliveries = list(generate_load(args.messages, collectors=args.collectors, organizations=args.organizations,
+                                    payload_mean=args.payload_mean, payload_sigma=args.payload_sigma,
+                                    rate=args.rate, rnd=rnd))
+
+    writer = RecordingPacketWriter(MQWriter.packet_writer if args.database else None, latency=args.db_latency)
+    MQWriter.packet_writer = writer
+    bucket = FakeBucket(latency=args.s3_latency)
+    if args.format == 'parquet':
+        encoder = ParquetArchiveEncoder(codec=args.codec)
+    else:
+        encoder = ArchiveEncoder(codec=args.codec)
+    if args.archive == 's3':
+        MQWriter.CollectorMessageManager = BenchS3CollectorMessagesManager(
+            bucket, maximum_msgs_per_collector=args.msgs_per_archive, upload_workers=args.upload_workers,
+            encoder=encoder)
+    elif args.archive == 'log':
+        os.chdir(tempfile.mkdtemp())
+        MQWriter.CollectorMessageManager = LogCollectorMessagesManager(maximum_msgs_per_collector=args.msgs_per_archive,
+                                                                       encoder=encoder)
+    else:
+        MQWriter.CollectorMessageManager = None
+
+    channel = FakeChannel()
+    if args.profile:
+        PROFILER.configure(sample_rate=args.profile, output_dir=tempfile.gettempdir(), logger=logging.getLogger())
+        PROFILER.enable()
+    due = []
+    start = time.perf_counter()
+    for tag, (offset, body) in enumerate(deliveries, 1):
+        if args.rate:
+            wait = start + offset - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            due.append(start + offset)
+        else:
+            due.append(time.perf_counter())
+        MQWriter.callback(channel, SimpleNamespace(delivery_tag=tag, redelivered=False), None, body)
+        # stands in for the timer of the connection
+        MQWriter.scheduler.poll()
+    MQWriter.scheduler.flush()
+    consumed = time.perf_counter() - start
+    if MQWriter.CollectorMessageManager:
+        MQWriter.CollectorMessageManager.flush_all()
+    elapsed = time.perf_counter() - start
+    if args.profile:
+        PROFILER.disable()
+        stacks, _ = PROFILER.dump()
+
+    if args.archive == 'log':
+        archives = sum(len(files) for _, _, files in os.walk('.'))
+    else:
+        archives = len(bucket.objects)
+    latencies = sorted(written - queued for queued, written in zip(due, writer.written_at))
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{args.messages} messages from {args.collectors} collectors, archive: {args.archive}, '
+          f'database: {"yes" if args.database else "no"}')
+    print(f'  throughput: {args.messages / consumed:10.0f} msgs/s ({consumed:.3f} s, {elapsed:.3f} s with the '
+          f'final archive flush)')
+    print(f'  latency:    p50 {percentile(latencies, 0.5) * 1000:8.2f} ms   p99 {percentile(latencies, 0.99) * 1000:8.2f} ms'
+          f'   max {latencies[-1] * 1000 if latencies else float("nan"):8.2f} ms')
+    print(f'  acked:      {channel.acked}, packets written: {len(writer.written_at)}, '
+          f'archives: {archives}')
+    print(f'  peak RSS:   {peak_rss:.1f} MiB')
+    if args.profile:
+        for name, stats in sorted(PROFILER.get_stage_stats().items(), key=lambda item: -item[1]['wall']):
+            print(f'  {name:>16}: {stats["count"]:8} times, mean {stats["mean_wall"] * 1e6:9.1f} us wall '
+                  f'{stats["mean_cpu"] * 1e6:9.1f} us cpu')
+        print(f'  stacks:     {stacks}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the packet writer')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--collectors', type=int, default=10)
+    parser.add_argument('--organizations', type=int, default=1)
+    parser.add_argument('--payload-mean', type=int, default=20, help='median payload size in bytes')
+    parser.add_argument('--payload-sigma', type=float, default=0.5, help='sigma of the log-normal payload sizes')
+    parser.add_argument('--rate', type=float, default=None, help='deliveries per second. Unlimited by default')
+    parser.add_argument('--archive', choices=('s3', 'log', 'none'), default='s3')
+    parser.add_argument('--format', choices=('json', 'parquet'), default='json')
+    parser.add_argument('--codec', choices=('gzip', 'zstd'), default='gzip')
+    parser.add_argument('--msgs-per-archive', type=int, default=500)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--s3-latency', type=float, default=0.02, help='seconds each upload takes')
+    parser.add_argument('--db-latency', type=float, default=0, help='seconds each batch takes without --database')
+    parser.add_argument('--database', action='store_true', help='write the packets to the configured database')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--profile', type=float, default=0,
+                        help='fraction of the messages whose stages are timed. Also dumps the sampled stacks')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Compares the packet decoding of the previous callback (json.loads, dateutil and a dict built with one .get per
+column) against PacketDecoder. The corpus is read from a file with one recorded message per line, or generated.
+Usage: python -m benchmarks.bench_packet_decoder [messages | corpus.jsonl]
+"""
+import json
+import os
+import random
+import sys
+import time
+
+import dateutil.parser as dp
+
+from PacketDecoder import DATA_MAX_LEN, PACKET_COLUMNS, decode_message, decode_packet
+from benchmarks.payloads import make_body
+
+
+def legacy_decode(body):
+    packet = json.loads(body.decode('utf-8')).get('packet')
+    row = {column: packet.get(column, None) for column in PACKET_COLUMNS}
+    row['date'] = dp.parse(packet.get('date', None))
+    row['data'] = packet['data'][0:DATA_MAX_LEN] if 'data' in packet else None
+    row['error'] = packet['error'][0:DATA_MAX_LEN] if 'error' in packet else None
+    return row
+
+
+def fast_decode(body):
+    return decode_packet(decode_message(body).get('packet'))
+
+
+def measure(name, decode, bodies, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            decode(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{name:>8}: {len(bodies) / best:12.0f} packets/s')
+
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else '20000'
+    if os.path.isfile(arg):
+        with open(arg, 'rb') as f:
+            bodies = [line.strip() for line in f if b'"packet"' in line]
+    else:
+        rnd = random.Random(42)
+        bodies = [make_body(i, rnd=rnd) for i in range(int(arg))]
+    print(f'{len(bodies)} packets')
+    measure('legacy', legacy_decode, bodies)
+    measure('decoder', fast_decode, bodies)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Compares the packet write strategies (executemany, multi-row values and COPY).
+Rows are written to a scratch copy of the packet table, which is dropped at the end.
+Usage: python -m benchmarks.bench_packet_writer [rows] [batch_size]
+"""
+import random
+import sys
+import time
+
+from auditing.db import engine
+from benchmarks.payloads import make_row
+from PacketBulkWriter import WRITERS
+
+BENCH_TABLE = 'packet_bench'
+
+
+def run(strategy, rows, batch_size):
+    writer = WRITERS[strategy](engine, table_name=BENCH_TABLE)
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        writer.write(rows[i:i + batch_size])
+    return time.perf_counter() - start
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    rnd = random.Random(42)
+    rows = [make_row(i, rnd=rnd) for i in range(total)]
+
+    engine.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}')
+    engine.execute(f'CREATE TABLE {BENCH_TABLE} (LIKE packet INCLUDING DEFAULTS)')
+    try:
+        print(f'{total} rows, batches of {batch_size}')
+        for strategy in WRITERS:
+            engine.execute(f'TRUNCATE {BENCH_TABLE}')
+            elapsed = run(strategy, rows, batch_size)
+            print(f'{strategy:>12}: {elapsed:8.3f} s {total / elapsed:12.0f} rows/s')
+    finally:
+        engine.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}')
+
+
+if __name__ == '__main__':
+    main()
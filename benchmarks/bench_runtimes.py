@@ -0,0 +1,71 @@
+"""
+A/B benchmark of the blocking (MQWriter) and asyncio (AsyncMQWriter) runtimes.
+Deliveries come from an in-process broker stand-in; packets are written to the packet table of the configured
+database, so the data collector and organization with id 1 must exist.
+Usage: python -m benchmarks.bench_runtimes [messages]
+"""
+import asyncio
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import asyncpg
+
+import MQWriter
+from AsyncMQWriter import AsyncPacketWriter
+from auditing.db import DB_HOST, DB_NAME, DB_PASSWORD, DB_PORT, DB_USERNAME
+from benchmarks.fakes import FakeChannel
+from benchmarks.payloads import make_body
+
+
+class FakeIncomingMessage:
+    """
+    Stand-in for an aio_pika.IncomingMessage
+    """
+
+    def __init__(self, body, delivery_tag):
+        self.body = body
+        self.delivery_tag = delivery_tag
+        self.redelivered = False
+
+    async def ack(self):
+        pass
+
+    async def nack(self, requeue=True):
+        pass
+
+
+def run_blocking(bodies):
+    channel = FakeChannel()
+    start = time.perf_counter()
+    for tag, body in enumerate(bodies, 1):
+        MQWriter.callback(channel, SimpleNamespace(delivery_tag=tag, redelivered=False), None, body)
+    MQWriter.scheduler.flush()
+    return time.perf_counter() - start
+
+
+async def run_async(bodies):
+    pool = await asyncpg.create_pool(host=DB_HOST, port=int(DB_PORT), user=DB_USERNAME, password=DB_PASSWORD,
+                                     database=DB_NAME)
+    writer = AsyncPacketWriter(pool, max_rows=MQWriter.BATCH_LENGHT, max_age=MQWriter.WRITE_TIMEOUT)
+    start = time.perf_counter()
+    for tag, body in enumerate(bodies, 1):
+        await writer.on_message(FakeIncomingMessage(body, tag))
+    await writer.drain()
+    elapsed = time.perf_counter() - start
+    await pool.close()
+    return elapsed
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rnd = random.Random(42)
+    bodies = [make_body(i, rnd=rnd) for i in range(total)]
+    print(f'{total} messages')
+    for name, elapsed in (('blocking', run_blocking(bodies)), ('asyncio', asyncio.run(run_async(bodies)))):
+        print(f'{name:>10}: {elapsed:8.3f} s {total / elapsed:12.0f} msgs/s')
+
+
+if __name__ == '__main__':
+    main()
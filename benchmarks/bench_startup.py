@@ -0,0 +1,72 @@
+"""
+Measures the cold start of the writer: the time from process start until it starts consuming.
+RabbitMQ is replaced by a stand-in connection, so only the imports and the initialization of the writer (metrics,
+collector message manager, spool, database self-check) are measured.
+Usage: python -m benchmarks.bench_startup [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CHILD = '''
+import sys
+import time
+import pika
+
+class FakeChannel:
+    def basic_qos(self, prefetch_count): pass
+    def queue_declare(self, **kwargs): pass
+    def exchange_declare(self, **kwargs): pass
+    def queue_bind(self, **kwargs): pass
+    def basic_consume(self, **kwargs): pass
+    def stop_consuming(self): pass
+    def start_consuming(self):
+        print('consuming', flush=True)
+
+class FakeConnection:
+    is_open = False
+    def __init__(self, *args, **kwargs): pass
+    def channel(self): return FakeChannel()
+    def call_later(self, delay, callback): return None
+    def remove_timeout(self, timer): pass
+    def add_callback_threadsafe(self, callback): pass
+
+pika.BlockingConnection = FakeConnection
+import MQWriter
+MQWriter.consume()
+'''
+
+
+def measure():
+    env = dict(os.environ)
+    env.setdefault('ENVIRONMENT', 'bench')
+    for name in ('DB_HOST', 'RABBITMQ_HOST'):
+        env.setdefault(name, 'localhost')
+    for name in ('DB_NAME', 'DB_USERNAME', 'DB_PASSWORD', 'RABBITMQ_DEFAULT_USER', 'RABBITMQ_DEFAULT_PASS'):
+        env.setdefault(name, 'bench')
+    env.setdefault('DB_PORT', '5432')
+    env.setdefault('RABBITMQ_PORT', '5672')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', CHILD], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               env=env, text=True)
+    try:
+        for line in process.stdout:
+            if line.strip() == 'consuming':
+                return time.perf_counter() - start
+        raise RuntimeError(f'The writer exited with code {process.wait()} before consuming')
+    finally:
+        process.kill()
+        process.wait()
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    times = [measure() for _ in range(runs)]
+    print(f'time to consuming over {runs} runs: median {statistics.median(times) * 1000:.0f} ms, '
+          f'min {min(times) * 1000:.0f} ms, max {max(times) * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
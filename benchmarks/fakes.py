@@ -0,0 +1,84 @@
+"""
+In-process stand-ins for RabbitMQ, S3 and the database, used by the benchmarks
+"""
+import threading
+import time
+from types import SimpleNamespace
+
+
+class FakeChannel:
+    """
+    Stand-in for a pika channel: records the acknowledgements
+    """
+
+    def __init__(self):
+        self.acked = 0
+        self.nacked = 0
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked += 1
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.nacked += 1
+
+    def basic_qos(self, prefetch_count):
+        pass
+
+
+class FakeS3Client:
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def upload_fileobj(self, fileobj, bucket_name, key):
+        data = fileobj.read()
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.objects[key] = len(data)
+
+
+class FakeBucket:
+    """
+    Stand-in for a boto3 Bucket: keeps the size of every uploaded object. Uploads take latency seconds
+    """
+
+    def __init__(self, name='bench', latency=0):
+        self.name = name
+        self.meta = SimpleNamespace(client=FakeS3Client(latency))
+
+    @property
+    def objects(self):
+        return self.meta.client.objects
+
+
+class RecordingPacketWriter:
+    """
+    Wraps a packet writer (or stands in for the database when there is none) and records when each row was written
+    """
+
+    def __init__(self, writer=None, latency=0):
+        """
+        :param writer: PacketBulkWriter to delegate to. None to discard the rows
+        :param latency: seconds each batch takes when there is no writer
+        """
+        self.writer = writer
+        self.latency = latency
+        self.written_at = []
+
+    def write(self, rows):
+        if self.writer is not None:
+            rejected = self.writer.write(rows)
+        else:
+            rejected = []
+            if self.latency and rows:
+                time.sleep(self.latency)
+        now = time.perf_counter()
+        self.written_at.extend([now] * len(rows))
+        return rejected
+
+    def reject(self, payload, error):
+        if self.writer is not None:
+            self.writer.reject(payload, error)
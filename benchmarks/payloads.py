@@ -0,0 +1,105 @@
+import base64
+import datetime
+import json
+import random
+
+GATEWAYS = [f'{i:016x}' for i in range(0xb827ebfffe000000, 0xb827ebfffe000000 + 32)]
+DATR = ['SF7BW125', 'SF8BW125', 'SF9BW125', 'SF10BW125', 'SF11BW125', 'SF12BW125']
+
+
+def make_packet(seq, data_collector_id=1, organization_id=1, rnd=random, payload_size=None):
+    """
+    Builds a packet with the same shape as the ones sent by the data collectors
+    :param seq: sequence number, used as frame counter and to build the date
+    :param data_collector_id: id of the collector sending the packet
+    :param organization_id: id of the organization of the collector
+    :param rnd: random instance, so the corpus can be reproduced
+    :param payload_size: size in bytes of the frame payload. None for a fixed 20 bytes payload
+    :return: dict with the packet fields
+    """
+    date = datetime.datetime(2020, 2, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(milliseconds=250 * seq)
+    dev_addr = f'{rnd.randrange(1 << 32):08x}'
+    if payload_size is None:
+        data, size = 'QNAPASYAAQABaXvJ2nz6s2k8+A==', 23
+    else:
+        data = base64.b64encode(bytes(rnd.getrandbits(8) for _ in range(payload_size))).decode('ascii')
+        size = payload_size + 13
+    return {
+        'date': date.isoformat(),
+        'topic': f'gateway/{rnd.choice(GATEWAYS)}/rx',
+        'data_collector_id': data_collector_id,
+        'organization_id': organization_id,
+        'gateway': rnd.choice(GATEWAYS),
+        'tmst': rnd.randrange(1 << 32),
+        'chan': rnd.randrange(8),
+        'rfch': rnd.randrange(2),
+        'freq': rnd.choice([902.3, 902.5, 902.7, 902.9]),
+        'stat': 1,
+        'modu': 'LORA',
+        'datr': rnd.choice(DATR),
+        'codr': '4/5',
+        'lsnr': round(rnd.uniform(-20, 10), 1),
+        'rssi': rnd.randrange(-120, -30),
+        'size': size,
+        'data': data,
+        'm_type': 'UnconfirmedDataUp',
+        'major': 'LoRaWANR1',
+        'mic': f'{rnd.randrange(1 << 32):08x}',
+        'dev_addr': dev_addr,
+        'adr': True,
+        'ack': False,
+        'adr_ack_req': False,
+        'f_pending': False,
+        'class_b': False,
+        'f_count': seq & 0xffff,
+        'f_opts': '[]',
+        'f_port': 1,
+        'app_name': 'bench',
+        'dev_name': f'device-{dev_addr}',
+        'gw_name': 'bench-gateway',
+    }
+
+
+def make_row(seq, data_collector_id=1, organization_id=1, rnd=random):
+    """
+    Builds a packet row as it is written to the packet table
+    :return: tuple with the values of PacketDecoder.PACKET_COLUMNS
+    """
+    from PacketDecoder import decode_packet
+    return decode_packet(make_packet(seq, data_collector_id, organization_id, rnd))
+
+
+def make_body(seq, data_collector_id=1, organization_id=1, rnd=random, payload_size=None):
+    """
+    Builds a delivery body as published by the data collectors: the parsed packet plus the raw messages
+    :return: bytes with the JSON message
+    """
+    packet = make_packet(seq, data_collector_id, organization_id, rnd, payload_size)
+    message = {
+        'data_collector_id': data_collector_id,
+        'topic': packet['topic'],
+        'message': json.dumps({'rxpk': [{k: packet[k] for k in ('tmst', 'chan', 'rfch', 'freq', 'stat', 'modu',
+                                                                 'datr', 'codr', 'lsnr', 'rssi', 'size', 'data')}]}),
+    }
+    return json.dumps({'packet': packet, 'messages': [message]}).encode('utf-8')
+
+
+def generate_load(total, collectors=10, organizations=1, payload_mean=20, payload_sigma=0.5, rate=None, rnd=random):
+    """
+    Generates the deliveries of a load test: packets of several collectors with log-normally distributed
+    payload sizes (capped to the 242 bytes of a LoRaWAN frame)
+    :param total: number of deliveries
+    :param collectors: number of data collectors sending packets (round robin)
+    :param organizations: number of organizations the collectors belong to
+    :param payload_mean: median payload size in bytes
+    :param payload_sigma: sigma of the log-normal distribution of the payload sizes
+    :param rate: deliveries per second of the schedule. None to deliver as fast as possible
+    :param rnd: random instance, so the load can be reproduced
+    :return: generator of (seconds since the start when the delivery is due, body) tuples. Without rate, the
+    time is 0
+    """
+    for seq in range(total):
+        data_collector_id = seq % collectors + 1
+        payload_size = min(242, max(1, int(rnd.lognormvariate(0, payload_sigma) * payload_mean)))
+        body = make_body(seq, data_collector_id, (data_collector_id - 1) % organizations + 1, rnd, payload_size)
+        yield (seq / rate if rate else 0), body
@@ -0,0 +1,101 @@
+import unittest
+
+from AdaptiveBatchController import AdaptiveBatchController
+from BatchScheduler import BatchScheduler
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAdaptiveBatchController(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.clock = FakeClock()
+        self.scheduler = BatchScheduler(self.batches.append, max_rows=64, max_age=10, clock=self.clock)
+        self.controller = AdaptiveBatchController(self.scheduler, slo=2, min_rows=16, max_rows=5000, min_age=0.1,
+                                                  max_age=10, smoothing=1, max_step=100, clock=self.clock)
+
+    def deliver(self, rows, seconds):
+        for i in range(rows):
+            self.scheduler.add(i)
+        self.clock.now += seconds
+
+    def test_idle_rows_wait_at_most_the_slo(self):
+        self.deliver(5, 5)
+        decision = self.controller.adjust(0)
+        assert decision['reason'] == 'no flushes measured'
+        assert decision['max_rows'] == 16
+        assert decision['max_age'] == 2
+        assert self.scheduler.max_age == 2
+
+    def test_batch_fills_within_the_slo(self):
+        self.controller.record_flush(1000, 0.1)
+        self.deliver(10000, 10)
+        decision = self.controller.adjust(0)
+        # 1000 rows/s at 100 us/row: age + 1000 * age * 0.0001 = 2
+        assert decision['reason'] == 'slo'
+        assert abs(decision['max_age'] - 2 / 1.1) < 1e-9
+        assert decision['max_rows'] == int(1000 * 2 / 1.1)
+        assert decision['expected_latency'] <= 2
+        assert self.scheduler.max_rows == decision['max_rows']
+
+    def test_backlog_writes_the_largest_batch_within_the_slo(self):
+        self.controller.record_flush(1000, 1)
+        self.deliver(100, 10)
+        decision = self.controller.adjust(queue_depth=10000)
+        assert decision['reason'] == 'backlog'
+        assert decision['max_rows'] == 2000
+
+    def test_saturated_database(self):
+        self.controller.record_flush(100, 1)
+        self.deliver(1000, 10)
+        decision = self.controller.adjust()
+        assert decision['reason'] == 'saturated'
+        assert decision['max_rows'] == 200
+        assert decision['max_age'] == 1
+
+    def test_bounds_and_step(self):
+        self.controller.max_step = 2
+        self.controller.record_flush(1000, 0.001)
+        self.deliver(100000, 1)
+        assert self.controller.adjust(0)['max_rows'] == 128
+        assert self.controller.adjust(0)['max_rows'] == 256
+        self.controller.max_rows = 300
+        assert self.controller.adjust(0)['max_rows'] == 300
+
+    def test_age_leaves_time_to_write_the_batch(self):
+        self.controller.max_step = 2
+        self.controller.record_flush(100, 1)
+        self.deliver(10, 10)
+        decision = self.controller.adjust(0)
+        # the batch can't shrink below 32 rows, which take 0.32 s to write
+        assert decision['max_rows'] == 32
+        assert abs(decision['max_age'] - 1.68) < 1e-9
+        assert decision['expected_latency'] <= 2
+
+    def test_flushes_are_averaged(self):
+        self.controller.smoothing = 0.5
+        self.controller.record_flush(100, 0.1)
+        self.controller.record_flush(100, 0.3)
+        self.controller.record_flush(0, 1)
+        assert abs(self.controller.row_seconds - 0.002) < 1e-12
+
+    def test_decisions_are_kept(self):
+        for _ in range(3):
+            self.deliver(10, 1)
+            self.controller.adjust(0)
+        decisions = self.controller.get_decisions()
+        assert len(decisions) == 3
+        assert set(decisions[0]) == {'time', 'rate', 'row_seconds', 'queue_depth', 'max_rows', 'max_age',
+                                     'expected_latency', 'reason'}
+
+
+if __name__ == '__main__':
+    unittest.main()
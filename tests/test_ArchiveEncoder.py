@@ -0,0 +1,36 @@
+import gzip
+import io
+import json
+import unittest
+
+from ArchiveEncoder import ArchiveEncoder
+
+
+class TestArchiveEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [{'data_collector_id': 1, 'topic': f'gateway/{i}/rx', 'message': 'x' * i} for i in range(200)]
+
+    def test_gzip_one_json_per_line(self):
+        encoder = ArchiveEncoder('gzip', level=1, chunk_size=1024)
+        data = encoder.encode(self.messages)
+        lines = gzip.decompress(data).splitlines()
+        assert [json.loads(line) for line in lines] == self.messages
+        assert encoder.extension == '.json.gz'
+
+    def test_encode_to_returns_uncompressed_size(self):
+        f = io.BytesIO()
+        size = ArchiveEncoder().encode_to(self.messages, f)
+        assert size == len(gzip.decompress(f.getvalue()))
+
+    def test_fallback_for_non_string_keys(self):
+        data = ArchiveEncoder().encode([{1: 'one'}])
+        assert json.loads(gzip.decompress(data)) == {'1': 'one'}
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            ArchiveEncoder('lz4')
+
+
+if __name__ == '__main__':
+    unittest.main()
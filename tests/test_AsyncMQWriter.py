@@ -0,0 +1,172 @@
+import asyncio
+import json
+import os
+import signal
+import unittest
+from unittest import mock
+
+import asyncpg
+
+import AsyncMQWriter
+import MQWriter
+from AsyncMQWriter import AsyncPacketWriter
+from PacketDecoder import COLUMN_INDEX
+
+
+class FakeTransaction:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        self.written = len(self.connection.rows)
+        self.dead_letters = len(self.connection.dead_letters)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # rolled back, as the transaction or savepoint would be
+            del self.connection.rows[self.written:]
+            del self.connection.dead_letters[self.dead_letters:]
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.rows = []
+        self.dead_letters = []
+        self.dead_letter_error = None
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    async def copy_records_to_table(self, table_name, records, columns):
+        for record in records:
+            if record[COLUMN_INDEX['data_collector_id']] == 'bad':
+                raise ValueError('invalid input for query argument')
+            self.rows.append(record)
+
+    async def executemany(self, sql, records):
+        if self.dead_letter_error is not None:
+            raise self.dead_letter_error
+        self.dead_letters.extend(records)
+
+
+class FakePool:
+
+    def __init__(self):
+        self.connection = FakeConnection()
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                return pool.connection
+
+            async def __aexit__(self, exc_type, exc, tb):
+                pass
+
+        return Acquire()
+
+    async def close(self):
+        pass
+
+
+class FakeMessage:
+
+    def __init__(self, body):
+        self.body = body
+        self.redelivered = False
+        self.settled = None
+
+    async def ack(self):
+        self.settled = 'ack'
+
+    async def nack(self, requeue=True):
+        self.settled = 'requeue' if requeue else 'nack'
+
+
+def row(collector_id):
+    values = [None] * len(COLUMN_INDEX)
+    values[COLUMN_INDEX['data_collector_id']] = collector_id
+    return tuple(values)
+
+
+class TestAsyncPacketWriter(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.pool = FakePool()
+        self.writer = AsyncPacketWriter(self.pool, max_rows=100, ack_mode='batch')
+
+    async def test_failing_rows_are_isolated(self):
+        messages = [FakeMessage(b'') for _ in range(5)]
+        await self.writer.write([(row(collector_id), message)
+                                 for collector_id, message in zip((1, 'bad', 3, 4, 'bad'), messages)])
+        assert [r[COLUMN_INDEX['data_collector_id']] for r in self.pool.connection.rows] == [1, 3, 4]
+        assert [(collector_id, error) for collector_id, error, _ in self.pool.connection.dead_letters] == \
+            [(None, 'invalid input for query argument')] * 2
+        assert [message.settled for message in messages] == ['ack'] * 5
+
+    async def test_failing_batches_without_isolation(self):
+        self.writer.isolate_failures = False
+        messages = [FakeMessage(b''), FakeMessage(b'')]
+        await self.writer.write([(row(1), messages[0]), (row('bad'), messages[1])])
+        assert self.pool.connection.rows == []
+        assert [message.settled for message in messages] == ['requeue'] * 2
+
+    async def test_dead_letters_that_fail_are_dropped(self):
+        self.pool.connection.dead_letter_error = asyncpg.exceptions.UndefinedTableError('missing table')
+        message = FakeMessage(b'')
+        await self.writer.write([(row(1), message), (row('bad'), None)])
+        assert len(self.pool.connection.rows) == 1
+        assert message.settled == 'ack'
+
+    async def test_packets_that_cant_be_decoded(self):
+        body = json.dumps({'packet': {'data_collector_id': 7, 'date': 'not a date'},
+                           'messages': [{'data_collector_id': 7, 'message': 'raw'}]}).encode()
+        message = FakeMessage(body)
+        with mock.patch.object(MQWriter, 'save_messages') as save_messages:
+            await self.writer.on_message(message)
+            await self.writer.drain()
+        assert message.settled == 'ack'
+        save_messages.assert_called_once_with([{'data_collector_id': 7, 'message': 'raw'}], 7, None, None)
+        [(collector_id, error, payload)] = self.pool.connection.dead_letters
+        assert collector_id == 7
+        assert json.loads(payload) == {'data_collector_id': 7, 'date': 'not a date'}
+        assert self.writer.rejected == []
+
+    async def test_run_with_default_settings(self):
+        pool = FakePool()
+        queue = mock.MagicMock()
+        queue.name = 'collectors_queue'
+        queue.bind = mock.AsyncMock()
+        queue.cancel = mock.AsyncMock()
+
+        async def consume(callback):
+            # stops the writer once it's consuming
+            asyncio.get_running_loop().call_soon(os.kill, os.getpid(), signal.SIGTERM)
+            return 'consumer'
+
+        queue.consume = consume
+        channel = mock.MagicMock()
+        channel.set_qos = mock.AsyncMock()
+        channel.declare_exchange = mock.AsyncMock()
+        channel.declare_queue = mock.AsyncMock(return_value=queue)
+        connection = mock.MagicMock()
+        connection.channel = mock.AsyncMock(return_value=channel)
+        connection.close = mock.AsyncMock()
+        environment = {'ENVIRONMENT': 'PROD', 'RABBITMQ_HOST': 'localhost', 'RABBITMQ_PORT': '5672',
+                       'RABBITMQ_DEFAULT_USER': 'guest', 'RABBITMQ_DEFAULT_PASS': 'guest'}
+        with mock.patch.dict(os.environ, environment), \
+                mock.patch.object(MQWriter, 'CollectorMessageManager', None), \
+                mock.patch.object(MQWriter, 'init_collector_message_manager'), \
+                mock.patch.object(AsyncMQWriter.asyncpg, 'create_pool', mock.AsyncMock(return_value=pool)), \
+                mock.patch.object(AsyncMQWriter.aio_pika, 'connect_robust',
+                                  mock.AsyncMock(return_value=connection)):
+            await asyncio.wait_for(AsyncMQWriter.run(), 5)
+        queue.cancel.assert_awaited_once_with('consumer')
+        connection.close.assert_awaited_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
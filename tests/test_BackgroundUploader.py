@@ -0,0 +1,45 @@
+import threading
+import unittest
+
+from BackgroundUploader import BackgroundUploader
+
+
+class TestBackgroundUploader(unittest.TestCase):
+
+    def test_synchronous_without_workers(self):
+        done = []
+        uploader = BackgroundUploader(workers=0)
+        uploader.submit(done.append, 1)
+        assert done == [1]
+
+    def test_submit_blocks_when_queue_is_full(self):
+        release = threading.Event()
+        uploader = BackgroundUploader(workers=1, queue_depth=1)
+        uploader.submit(release.wait)
+        uploader.submit(release.wait)
+        blocked = threading.Thread(target=uploader.submit, args=(release.wait,))
+        blocked.start()
+        blocked.join(timeout=0.2)
+        assert blocked.is_alive()
+        release.set()
+        blocked.join(timeout=2)
+        assert not blocked.is_alive()
+        uploader.shutdown()
+        assert uploader.in_flight() == 0
+
+    def test_gives_up_after_retries(self):
+        attempts = []
+
+        def fail():
+            attempts.append(1)
+            raise IOError('unavailable')
+
+        uploader = BackgroundUploader(workers=1, max_retries=2, backoff=0.001)
+        uploader.submit(fail)
+        uploader.shutdown()
+        assert len(attempts) == 3
+        assert uploader.failed == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from types import SimpleNamespace
+
+from BatchAcknowledger import BatchAcknowledger, is_transient_error
+
+
+class OperationalError(Exception):
+    pass
+
+
+class FakeChannel:
+
+    def __init__(self):
+        self.calls = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.calls.append(('ack', delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.calls.append(('nack', delivery_tag, multiple, requeue))
+
+    def basic_qos(self, prefetch_count):
+        self.calls.append(('qos', prefetch_count))
+
+
+def delivery(tag, redelivered=False):
+    return SimpleNamespace(delivery_tag=tag, redelivered=redelivered)
+
+
+class TestBatchAcknowledger(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = FakeChannel()
+        self.sleeps = []
+        self.acknowledger = BatchAcknowledger(sleep=self.sleeps.append)
+        self.acknowledger.attach(self.channel, prefetch_count=256)
+
+    def test_attach_sets_prefetch(self):
+        assert self.channel.calls == [('qos', 256)]
+
+    def test_settle_acks_last_tag_with_multiple(self):
+        for tag in range(1, 5):
+            self.acknowledger.track(delivery(tag))
+        self.acknowledger.settle(success=True)
+        assert self.channel.calls[-1] == ('ack', 4, True)
+        assert not self.acknowledger.has_pending()
+
+    def test_settle_without_pending_does_nothing(self):
+        self.acknowledger.settle(success=True)
+        assert self.channel.calls == [('qos', 256)]
+
+    def test_failed_batch_is_requeued(self):
+        self.acknowledger.track(delivery(1, redelivered=True))
+        self.acknowledger.track(delivery(2))
+        self.acknowledger.settle(success=False)
+        assert self.channel.calls[-1] == ('nack', 2, True, True)
+
+    def test_failed_redelivered_batch_is_not_requeued(self):
+        self.acknowledger.track(delivery(1, redelivered=True))
+        self.acknowledger.track(delivery(2, redelivered=True))
+        self.acknowledger.settle(success=False)
+        assert self.channel.calls[-1] == ('nack', 2, True, False)
+
+    def test_transient_failures_are_requeued_with_backoff(self):
+        for _ in range(3):
+            self.acknowledger.track(delivery(1, redelivered=True))
+            self.acknowledger.settle(success=False, error=OperationalError('server closed the connection'))
+            assert self.channel.calls[-1] == ('nack', 1, True, True)
+        assert self.sleeps == [1, 2, 4]
+        self.acknowledger.track(delivery(2))
+        self.acknowledger.settle(success=True)
+        self.acknowledger.track(delivery(3, redelivered=True))
+        self.acknowledger.settle(success=False, error=ConnectionRefusedError())
+        assert self.sleeps == [1, 2, 4, 1]
+
+    def test_content_errors_are_not_transient(self):
+        self.acknowledger.track(delivery(1, redelivered=True))
+        self.acknowledger.settle(success=False, error=ValueError('bad row'))
+        assert self.channel.calls[-1] == ('nack', 1, True, False)
+        assert self.sleeps == []
+        assert not is_transient_error(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
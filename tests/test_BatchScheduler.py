@@ -0,0 +1,109 @@
+import unittest
+
+from BatchScheduler import BatchScheduler
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.timers = {}
+        self.next_id = 0
+
+    def call_later(self, delay, callback):
+        self.next_id += 1
+        self.timers[self.next_id] = (delay, callback)
+        return self.next_id
+
+    def remove_timeout(self, timer_id):
+        self.timers.pop(timer_id, None)
+
+    def fire(self):
+        timers, self.timers = self.timers, {}
+        for delay, callback in timers.values():
+            callback()
+
+
+class TestBatchScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.clock = FakeClock()
+        self.connection = FakeConnection()
+        self.scheduler = BatchScheduler(self.batches.append, max_rows=3, max_age=10, max_bytes=100, clock=self.clock)
+        self.scheduler.attach(self.connection)
+
+    def test_flush_on_max_rows(self):
+        for i in range(7):
+            self.scheduler.add(i)
+        assert self.batches == [[0, 1, 2], [3, 4, 5]]
+        assert len(self.scheduler) == 1
+
+    def test_flush_on_max_bytes(self):
+        self.scheduler.add('a', size=60)
+        self.scheduler.add('b', size=60)
+        assert self.batches == [['a', 'b']]
+
+    def test_deadline_does_not_slide(self):
+        self.scheduler.add(1)
+        assert len(self.connection.timers) == 1
+        self.clock.now = 6
+        self.scheduler.add(2)
+        # the timer is armed once per batch, for the oldest row
+        assert len(self.connection.timers) == 1
+        self.clock.now = 10
+        self.connection.fire()
+        assert self.batches == [[1, 2]]
+        assert len(self.connection.timers) == 0
+
+    def test_early_timer_reschedules(self):
+        self.scheduler.add(1)
+        self.clock.now = 4
+        self.connection.fire()
+        assert self.batches == []
+        delay, _ = list(self.connection.timers.values())[0]
+        assert delay == 6
+
+    def test_timer_error_is_logged_not_raised(self):
+        def fail(rows):
+            raise RuntimeError('db down')
+        scheduler = BatchScheduler(fail, max_rows=3, max_age=10, clock=self.clock)
+        connection = FakeConnection()
+        scheduler.attach(connection)
+        scheduler.add(1)
+        self.clock.now = 10
+        connection.fire()
+        assert len(scheduler) == 0
+
+    def test_resize(self):
+        self.scheduler.add(1)
+        self.scheduler.add(2)
+        self.clock.now = 2
+        self.scheduler.resize(10, 5)
+        assert self.batches == []
+        delay, _ = list(self.connection.timers.values())[0]
+        assert delay == 3
+        self.scheduler.resize(2, 5)
+        assert self.batches == [[1, 2]]
+        assert self.scheduler.added == 2
+
+    def test_poll_without_connection(self):
+        scheduler = BatchScheduler(self.batches.append, max_rows=3, max_age=10, clock=self.clock)
+        scheduler.add(1)
+        scheduler.poll()
+        assert self.batches == []
+        self.clock.now = 11
+        scheduler.poll()
+        assert self.batches == [[1]]
+
+
+if __name__ == '__main__':
+    unittest.main()
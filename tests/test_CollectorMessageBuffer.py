@@ -0,0 +1,74 @@
+import unittest
+
+from CollectorMessageBuffer import CollectorMessageBuffer, approximate_size
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCollectorMessageBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_tracks_sizes(self):
+        buffer = CollectorMessageBuffer(clock=self.clock)
+        buffer.add(1, [{'message': 'a' * 100}])
+        buffer.add(2, [{'message': 'b' * 10}, {'message': 'c' * 10}])
+        usage = buffer.get_usage()
+        assert usage['collectors'] == 2
+        assert usage['messages'] == 3
+        assert usage['bytes'] == buffer.sizes[1] + buffer.sizes[2]
+        assert buffer.sizes[1] > buffer.sizes[2]
+        buffer.clear(1)
+        assert buffer.get_usage()['bytes'] == buffer.sizes[2]
+        assert buffer.messages[1] == []
+
+    def test_expired_in_age_order(self):
+        buffer = CollectorMessageBuffer(max_age=10, clock=self.clock)
+        buffer.add(1, [{}])
+        self.clock.now = 5
+        buffer.add(2, [{}])
+        buffer.add(1, [{}])
+        self.clock.now = 12
+        assert buffer.expired() == [1]
+        self.clock.now = 15
+        assert buffer.expired() == [1, 2]
+
+    def test_over_budget_largest_first(self):
+        buffer = CollectorMessageBuffer(memory_budget=1000, clock=self.clock)
+        buffer.add(1, [{'message': 'a' * 300}])
+        buffer.add(2, [{'message': 'b' * 600}])
+        assert buffer.over_budget() == []
+        buffer.add(3, [{'message': 'c' * 150}])
+        assert buffer.over_budget() == [2]
+
+    def test_over_budget_oldest_first(self):
+        buffer = CollectorMessageBuffer(memory_budget=1000, eviction_policy='oldest', clock=self.clock)
+        buffer.add(1, [{'message': 'a' * 300}])
+        buffer.add(2, [{'message': 'b' * 600}])
+        buffer.add(3, [{'message': 'c' * 150}])
+        assert buffer.over_budget() == [1]
+
+    def test_approximate_size(self):
+        assert approximate_size({'topic': 'abc', 'id': 1, 'list': [1, 2]}) > len('{"topic": "abc"}')
+
+    def test_remove(self):
+        buffer = CollectorMessageBuffer(max_age=10, clock=self.clock)
+        buffer.add((1, 'window'), [{'message': 'a'}])
+        buffer.remove((1, 'window'))
+        assert (1, 'window') not in buffer.messages
+        usage = buffer.get_usage()
+        assert usage['collectors'] == 0
+        assert usage['messages'] == 0
+        assert usage['bytes'] == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import MQWriter
+
+
+class TestOrphanedSpoolDirs(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        for name in ('worker-0', 'worker-1', 'worker-2', 'worker-x'):
+            os.mkdir(os.path.join(self.directory, name))
+        patcher = mock.patch.object(MQWriter, 'SPOOL_DIR', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_first_worker_adopts_the_dirs_of_removed_workers(self):
+        with mock.patch.object(MQWriter, 'processes', 2):
+            assert MQWriter.orphaned_spool_dirs(0) == [self.directory, self.path('worker-2')]
+            assert MQWriter.orphaned_spool_dirs(1) == []
+
+    def test_single_process_adopts_every_worker_dir(self):
+        assert MQWriter.orphaned_spool_dirs() == [self.path('worker-0'), self.path('worker-1'), self.path('worker-2')]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import urllib.request
+
+from Metrics import Registry, start_metrics_server, MetricsHandler
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('packets_total', 'Packets')
+        counter.inc()
+        counter.inc(4)
+        assert '# TYPE packets_total counter\npackets_total 5' in self.registry.expose()
+
+    def test_histogram_is_cumulative(self):
+        histogram = self.registry.histogram('batch_size', 'Batch size', (1, 10, 100))
+        for value in (1, 5, 50, 500):
+            histogram.observe(value)
+        exposed = self.registry.expose()
+        assert 'batch_size_bucket{le="1"} 1' in exposed
+        assert 'batch_size_bucket{le="10"} 2' in exposed
+        assert 'batch_size_bucket{le="100"} 3' in exposed
+        assert 'batch_size_bucket{le="+Inf"} 4' in exposed
+        assert 'batch_size_sum 556' in exposed
+        assert 'batch_size_count 4' in exposed
+
+    def test_labelled_gauge_function(self):
+        gauge = self.registry.gauge('buffered', 'Buffered messages', label='collector')
+        gauge.set_function(lambda: {7: 3, 9: 1})
+        exposed = self.registry.expose()
+        assert 'buffered{collector="7"} 3' in exposed
+        assert 'buffered{collector="9"} 1' in exposed
+
+    def test_http_endpoint(self):
+        self.registry.counter('up_total', 'Up').inc()
+        handler = type('Handler', (MetricsHandler,), {'registry': self.registry})
+        server = start_metrics_server(0, host='127.0.0.1')
+        server.RequestHandlerClass = handler
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                assert b'up_total 1' in response.read()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
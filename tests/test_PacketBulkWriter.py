@@ -0,0 +1,175 @@
+import datetime
+import unittest
+from unittest import mock
+
+import psycopg2
+
+from PacketBulkWriter import MESSAGES_COLUMN, CopyPacketWriter, ExecutemanyPacketWriter, copy_value
+
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql, params=None):
+        if params is None:
+            self.connection.statements.append(sql)
+            return
+        self.executemany(sql, [params])
+        self.last_id = len(self.connection.pending)
+
+    def fetchone(self):
+        return self.last_id,
+
+    def executemany(self, sql, rows):
+        self.connection.tables.append(sql.split()[2])
+        if sql.split()[2] == 'missing_table':
+            raise psycopg2.ProgrammingError('relation "missing_table" does not exist')
+        if any(row[0] == 'bad' for row in rows):
+            raise psycopg2.DataError('value too long')
+        self.connection.pending.extend(rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self, committed, tables):
+        self.committed = committed
+        self.tables = tables
+        self.pending = []
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.committed.extend(self.pending)
+
+    def rollback(self):
+        self.pending = []
+
+    def close(self):
+        pass
+
+
+class FakeEngine:
+
+    def __init__(self):
+        self.committed = []
+        self.tables = []
+
+    def raw_connection(self):
+        return FakeConnection(self.committed, self.tables)
+
+
+class TestPacketBulkWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeEngine()
+        self.writer = ExecutemanyPacketWriter(self.engine, columns=('data',), dead_letter_table=None)
+
+    def test_clean_batch(self):
+        rows = [(str(i),) for i in range(10)]
+        assert self.writer.write(rows) == []
+        assert self.engine.committed == rows
+
+    def test_failing_rows_are_isolated(self):
+        rows = [(str(i),) for i in range(10)]
+        rows[3] = ('bad',)
+        rows[8] = ('bad',)
+        rejected = self.writer.write(rows)
+        assert [row for row, error in rejected] == [('bad',), ('bad',)]
+        assert 'value too long' in rejected[0][1]
+        assert sorted(self.engine.committed) == sorted(row for row in rows if row != ('bad',))
+
+    def test_without_isolation_the_batch_fails(self):
+        self.writer.isolate_failures = False
+        with self.assertRaises(psycopg2.DataError):
+            self.writer.write([('1',), ('bad',)])
+        assert self.engine.committed == []
+
+    def test_rows_are_written_to_their_partition(self):
+        class FakePartitioner:
+            def group(self, rows):
+                return [('packet_p1', [row for row in rows if row[0] < '5']),
+                        ('packet_p2', [row for row in rows if row[0] >= '5'])]
+
+        self.writer.partitioner = FakePartitioner()
+        rows = [(str(i),) for i in range(10)]
+        assert self.writer.write(rows) == []
+        assert self.engine.tables == ['packet_p1', 'packet_p2']
+        assert sorted(self.engine.committed) == rows
+
+    def test_messages_are_linked_to_the_packet_ids(self):
+        messages = []
+        writer = ExecutemanyPacketWriter(self.engine, columns=('data', MESSAGES_COLUMN), dead_letter_table=None)
+        writer.write_messages = lambda cursor, rows: messages.extend(rows)
+        rows = [('1', [(7, 'gateway/1/rx', 'one'), (7, 'gateway/2/rx', {'two': 2})]), ('2', []), ('3', None)]
+        assert writer.write(rows) == []
+        assert self.engine.committed == [('1',), ('2',), ('3',)]
+        assert messages == [(7, 1, 'gateway/1/rx', 'one'), (7, 1, 'gateway/2/rx', '{"two": 2}')]
+        assert writer.column_list() == 'data'
+
+    def test_rollups_skip_the_rejected_rows(self):
+        class FakeRollups:
+            def __init__(self):
+                self.written = []
+                self.committed = []
+
+            def write(self, cursor, rows):
+                self.written = rows
+
+            def commit(self):
+                self.committed.extend(self.written)
+
+        self.writer.rollups = FakeRollups()
+        rows = [('1',), ('bad',), ('3',)]
+        self.writer.write(rows)
+        assert self.writer.rollups.committed == [('1',), ('3',)]
+
+    def test_dead_letters_with_invalid_collector_ids(self):
+        self.writer.dead_letter_table = 'packet_dead_letter'
+        self.writer.reject({'data_collector_id': 'abc'}, 'could not decode')
+        self.writer.reject({'data_collector_id': '7'}, 'could not decode')
+        assert self.writer.write([('1',)]) == []
+        assert [row[0] for row in self.engine.committed[1:]] == [None, 7]
+        assert self.writer.rejected == []
+
+    def test_dead_letters_that_fail_are_dropped(self):
+        self.writer.dead_letter_table = 'missing_table'
+        self.writer.reject({'data_collector_id': 1}, 'could not decode')
+        self.writer.reject({'data_collector_id': 2}, 'could not decode')
+        assert self.writer.write([('1',)]) == []
+        assert self.engine.committed[0] == ('1',)
+        assert self.writer.rejected == []
+        assert self.engine.tables.count('missing_table') == 3
+
+    def test_copy_falls_back_to_values_without_copy_expert(self):
+        writer = CopyPacketWriter(self.engine, columns=('data',), dead_letter_table=None)
+        def execute_values(cursor, sql, rows, **kwargs):
+            cursor.executemany(sql, rows)
+
+        with mock.patch('PacketBulkWriter.execute_values', execute_values):
+            assert writer.write([('1',), ('2',)]) == []
+        assert not writer.copy_supported
+        assert self.engine.committed == [('1',), ('2',)]
+
+    def test_copy_does_not_hide_other_errors(self):
+        writer = CopyPacketWriter(self.engine, columns=('data',), dead_letter_table=None)
+        writer.copy_rows = mock.Mock(side_effect=psycopg2.ProgrammingError('relation "packet" does not exist'))
+        with self.assertRaises(psycopg2.ProgrammingError):
+            writer.write([('1',)])
+        assert writer.copy_supported
+
+    def test_copy_value(self):
+        assert copy_value(None) == '\\N'
+        assert copy_value(True) == 't'
+        assert copy_value('a\tb\\c\n') == 'a\\tb\\\\c\\n'
+        assert copy_value(datetime.datetime(2020, 2, 1, 10, 15)) == '2020-02-01T10:15:00'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import datetime
+import unittest
+
+from PacketDecoder import COLUMN_INDEX, DATA_MAX_LEN, PACKET_COLUMNS, decode_message, decode_packet, parse_date
+
+
+class TestPacketDecoder(unittest.TestCase):
+
+    def test_columns(self):
+        assert 'id' not in PACKET_COLUMNS
+        assert 'date' in PACKET_COLUMNS
+        assert 'gw_name' in PACKET_COLUMNS
+
+    def test_decode_packet(self):
+        row = decode_packet({'date': '2020-02-01T10:15:00.123456Z', 'data_collector_id': 3, 'data': 'x' * 500,
+                             'rssi': -80})
+        assert len(row) == len(PACKET_COLUMNS)
+        assert row[COLUMN_INDEX['date']] == datetime.datetime(2020, 2, 1, 10, 15, 0, 123456, datetime.timezone.utc)
+        assert row[COLUMN_INDEX['data_collector_id']] == 3
+        assert row[COLUMN_INDEX['data']] == 'x' * DATA_MAX_LEN
+        assert row[COLUMN_INDEX['error']] is None
+        assert row[COLUMN_INDEX['rssi']] == -80
+        assert row[COLUMN_INDEX['gateway']] is None
+
+    def test_parse_date_fallback(self):
+        assert parse_date('Sat Feb 1 10:15:00 2020') == datetime.datetime(2020, 2, 1, 10, 15)
+
+    def test_missing_date(self):
+        with self.assertRaises(ValueError):
+            decode_packet({'data_collector_id': 3})
+
+    def test_decode_message(self):
+        assert decode_message(b'{"packet": {"rssi": -80}}') == {'packet': {'rssi': -80}}
+
+
+if __name__ == '__main__':
+    unittest.main()
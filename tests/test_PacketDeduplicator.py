@@ -0,0 +1,79 @@
+import json
+import unittest
+
+from PacketDeduplicator import PacketDeduplicator
+
+COLUMNS = ('gateway', 'rssi', 'lsnr', 'dev_addr', 'dev_eui', 'f_count', 'mic', 'data')
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_row(gateway, f_count=1, mic='aabbccdd', rssi=-100, lsnr=5.0):
+    return gateway, rssi, lsnr, '26011bda', None, f_count, mic, 'QAEBAgM='
+
+
+class TestPacketDeduplicator(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_drops_copies_in_the_batch(self):
+        deduplicator = PacketDeduplicator('drop', columns=COLUMNS, clock=self.clock)
+        rows = [make_row('gw1'), make_row('gw2'), make_row('gw1', f_count=2)]
+        assert deduplicator.process(rows) == [rows[0], rows[2]]
+        assert deduplicator.duplicates == 1
+
+    def test_drops_copies_within_the_window(self):
+        deduplicator = PacketDeduplicator('drop', window=5, columns=COLUMNS, clock=self.clock)
+        assert len(deduplicator.process([make_row('gw1')])) == 1
+        deduplicator.commit()
+        self.clock.now = 4
+        assert deduplicator.process([make_row('gw2')]) == []
+        self.clock.now = 10
+        assert len(deduplicator.process([make_row('gw1')])) == 1
+
+    def test_packets_of_failed_batches_are_not_remembered(self):
+        deduplicator = PacketDeduplicator('drop', window=5, columns=COLUMNS, clock=self.clock)
+        assert len(deduplicator.process([make_row('gw1')])) == 1
+        # the batch failed and its deliveries are redelivered
+        assert len(deduplicator.process([make_row('gw1')])) == 1
+        pending = deduplicator.pending
+        assert deduplicator.process([make_row('gw1', f_count=2)]) != []
+        deduplicator.commit(pending)
+        assert deduplicator.process([make_row('gw2')]) == []
+
+    def test_packets_without_mic_are_kept(self):
+        deduplicator = PacketDeduplicator('drop', columns=COLUMNS, clock=self.clock)
+        rows = [make_row('gw1', mic=None), make_row('gw1', mic=None)]
+        assert deduplicator.process(rows) == rows
+
+    def test_collapse_saves_the_receptions(self):
+        deduplicator = PacketDeduplicator('collapse', columns=COLUMNS, clock=self.clock)
+        rows = [make_row('gw1', rssi=-90), make_row('gw2', rssi=-110, lsnr=-3.5), make_row('gw1', f_count=2)]
+        written = deduplicator.process(rows)
+        assert deduplicator.columns == COLUMNS + ('receptions',)
+        assert written[0][:-1] == rows[0]
+        assert json.loads(written[0][-1]) == [['gw1', -90, 5.0], ['gw2', -110, -3.5]]
+        assert written[1] == rows[2] + (None,)
+
+    def test_max_entries(self):
+        deduplicator = PacketDeduplicator('drop', max_entries=2, columns=COLUMNS, clock=self.clock)
+        deduplicator.process([make_row('gw1', f_count=i) for i in range(3)])
+        deduplicator.commit()
+        assert len(deduplicator.seen) == 2
+        assert len(deduplicator.process([make_row('gw1', f_count=0)])) == 1
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            PacketDeduplicator('merge', columns=COLUMNS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import datetime
+import unittest
+
+from PacketPartitions import PacketPartitioner
+
+UTC = datetime.timezone.utc
+
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = []
+
+    def execute(self, sql, params=None):
+        self.connection.statements.append(sql)
+        if 'pg_inherits' in sql:
+            self.result = [(name,) for name in self.connection.children]
+        elif sql.startswith('CREATE TABLE IF NOT EXISTS'):
+            name = sql.split()[5]
+            if name not in self.connection.children:
+                self.connection.children.append(name)
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self, children):
+        self.children = children
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeEngine:
+
+    def __init__(self, children):
+        self.connection = FakeConnection(children)
+
+    def raw_connection(self):
+        return self.connection
+
+
+class TestPacketPartitioner(unittest.TestCase):
+
+    def test_partition_start(self):
+        partitioner = PacketPartitioner(None, interval='day')
+        date = datetime.datetime(2021, 3, 10, 23, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=-3)))
+        assert partitioner.partition_start(date) == datetime.datetime(2021, 3, 11, tzinfo=UTC)
+        weekly = PacketPartitioner(None, interval='week')
+        assert weekly.partition_start(datetime.datetime(2021, 3, 11, 5)) == datetime.datetime(2021, 3, 8, tzinfo=UTC)
+
+    def test_invalid_interval(self):
+        with self.assertRaises(ValueError):
+            PacketPartitioner(None, interval='month')
+
+    def test_maintain_creates_ahead_and_drops_old_partitions(self):
+        engine = FakeEngine(['packet_legacy', 'packet_p20210301', 'packet_p20210308'])
+        partitioner = PacketPartitioner(engine, interval='day', premake=2, retention=3)
+        partitioner.maintain(now=datetime.datetime(2021, 3, 10, 12, tzinfo=UTC))
+        created = [sql.split()[5] for sql in engine.connection.statements if sql.startswith('CREATE')]
+        assert created == ['packet_p20210310', 'packet_p20210311', 'packet_p20210312']
+        assert 'DROP TABLE packet_p20210301' in engine.connection.statements
+        assert 'DROP TABLE packet_p20210308' not in engine.connection.statements
+        assert sorted(partitioner.partitions.values()) == ['packet_p20210308', 'packet_p20210310',
+                                                            'packet_p20210311', 'packet_p20210312']
+
+    def test_group_routes_rows_to_their_partition(self):
+        partitioner = PacketPartitioner(None, interval='day', date_index=0)
+        partitioner.partitions = {datetime.datetime(2021, 3, 10, tzinfo=UTC): 'packet_p20210310'}
+        rows = [(datetime.datetime(2021, 3, 10, 1, tzinfo=UTC), 1),
+                (datetime.datetime(2021, 3, 9, 1, tzinfo=UTC), 2),
+                (datetime.datetime(2021, 3, 10, 2, tzinfo=UTC), 3)]
+        assert partitioner.group(rows) == [('packet_p20210310', [rows[0], rows[2]]), ('packet', [rows[1]])]
+
+    def test_group_takes_naive_dates_as_utc(self):
+        partitioner = PacketPartitioner(None, interval='day', date_index=0)
+        partitioner.partitions = {datetime.datetime(2021, 1, 1, tzinfo=UTC): 'packet_p20210101'}
+        rows = [(datetime.datetime(2021, 1, 1, 9, tzinfo=UTC), 1),
+                (datetime.datetime(2021, 1, 1, 10), 2),
+                (datetime.datetime(2020, 12, 31, 23), 3)]
+        assert partitioner.group(rows) == [('packet_p20210101', [rows[0], rows[1]]), ('packet', [rows[2]])]
+
+
+if __name__ == '__main__':
+    unittest.main()
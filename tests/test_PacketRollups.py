@@ -0,0 +1,90 @@
+import json
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from PacketRollups import PacketRollups
+
+COLUMNS = ('data_collector_id', 'organization_id', 'date', 'dev_addr', 'dev_eui', 'f_count', 'gateway', 'rssi',
+           'lsnr', 'receptions')
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+
+def packet(second, dev_addr=None, f_count=None, gateway='gw1', rssi=-100, lsnr=5.0, dev_eui=None, receptions=None):
+    return (1, 10, START + timedelta(seconds=second), dev_addr, dev_eui, f_count, gateway, rssi, lsnr, receptions)
+
+
+class TestPacketRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.rollups = PacketRollups(columns=COLUMNS, max_devices=2)
+        # (statement, rows) of every execute_values call
+        self.statements = []
+        patcher = mock.patch('PacketRollups.execute_values',
+                             lambda cursor, sql, rows: self.statements.append((sql, list(rows))))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_device_aggregates(self):
+        devices, gateways, f_counts = self.rollups.aggregate([
+            packet(2, 'a', 11, rssi=-90, lsnr=7.5),
+            packet(1, 'a', 10, rssi=-110, lsnr=None),
+            packet(3, 'a', 15, rssi=None, lsnr=-2.0),
+            packet(4, dev_eui='e1', gateway=None),
+        ])
+        assert devices[(1, 'dev_addr', 'a')] == [10, START + timedelta(seconds=1), START + timedelta(seconds=3), 3,
+                                                 15, 4, 2, -200, -110, -90, 2, 5.5, -2.0, 7.5]
+        assert devices[(1, 'dev_eui', 'e1')][3] == 1
+        assert f_counts == {(1, 'dev_addr', 'a'): 15}
+        assert gateways[(1, 'gw1')][3] == 3
+
+    def test_naive_dates_are_utc(self):
+        naive = (1, 10, datetime(2021, 1, 1, 0, 0, 5), 'a', None, 2, 'gw1', -100, 5.0, None)
+        devices, gateways, _ = self.rollups.aggregate([packet(1, 'a', 1), naive, packet(3, 'a', 3)])
+        assert devices[(1, 'dev_addr', 'a')][1:5] == [START + timedelta(seconds=1), START + timedelta(seconds=5), 3, 2]
+        assert gateways[(1, 'gw1')][1:3] == [START + timedelta(seconds=1), START + timedelta(seconds=5)]
+
+    def test_counter_reset_is_not_a_gap(self):
+        devices, _, _ = self.rollups.aggregate([packet(1, 'a', 100), packet(2, 'a', 0), packet(3, 'a', 2)])
+        assert devices[(1, 'dev_addr', 'a')][5] == 1
+
+    def test_gaps_between_committed_batches(self):
+        self.rollups.write(None, [packet(1, 'a', 10)])
+        self.rollups.commit()
+        devices, _, _ = self.rollups.aggregate([packet(2, 'a', 13)])
+        assert devices[(1, 'dev_addr', 'a')][5] == 2
+
+    def test_uncommitted_batches_are_forgotten(self):
+        self.rollups.write(None, [packet(1, 'a', 10)])
+        devices, _, _ = self.rollups.aggregate([packet(2, 'a', 13)])
+        assert devices[(1, 'dev_addr', 'a')][5] == 0
+
+    def test_least_recently_seen_devices_are_forgotten(self):
+        for second, device in enumerate(('a', 'b', 'a', 'c')):
+            self.rollups.write(None, [packet(second, device, second)])
+            self.rollups.commit()
+        assert list(self.rollups.last_f_counts) == [(1, 'dev_addr', 'a'), (1, 'dev_addr', 'c')]
+
+    def test_receptions_count_every_gateway(self):
+        receptions = json.dumps([['gw1', -100, 5.0], ['gw2', -80, 9.0]])
+        _, gateways, _ = self.rollups.aggregate([packet(1, 'a', 1, receptions=receptions)])
+        assert sorted(gateways) == [(1, 'gw1'), (1, 'gw2')]
+        assert gateways[(1, 'gw2')][4:] == [1, -80, -80, -80, 1, 9.0, 9.0, 9.0]
+
+    def test_upserts_in_key_order(self):
+        self.rollups.write(None, [packet(1, 'b', 1), packet(2, 'a', 1, gateway='gw2'), packet(3, 'b', 2)])
+        (devices_sql, devices), (gateways_sql, gateways) = self.statements
+        assert [row[:3] for row in devices] == [(1, 'dev_addr', 'a'), (1, 'dev_addr', 'b')]
+        assert [row[3:8] for row in devices][1] == (10, START + timedelta(seconds=1), START + timedelta(seconds=3),
+                                                     2, 2)
+        assert [row[:2] for row in gateways] == [(1, 'gw1'), (1, 'gw2')]
+        assert devices_sql.startswith('INSERT INTO device_rollup (data_collector_id, device_type, device, ')
+        assert 'ON CONFLICT (data_collector_id, device_type, device) DO UPDATE SET' in devices_sql
+        assert 'packets = device_rollup.packets + EXCLUDED.packets' in devices_sql
+        assert 'last_seen = GREATEST(device_rollup.last_seen, EXCLUDED.last_seen)' in devices_sql
+        assert 'rssi_min = LEAST(device_rollup.rssi_min, EXCLUDED.rssi_min)' in devices_sql
+        assert 'ON CONFLICT (data_collector_id, gateway) DO UPDATE SET' in gateways_sql
+
+
+if __name__ == '__main__':
+    unittest.main()
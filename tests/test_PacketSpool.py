@@ -0,0 +1,139 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from PacketSpool import QUARANTINE_NAME, PacketSpool
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPacketSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.written = []
+        self.fail = False
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, rows):
+        if self.fail:
+            raise ConnectionError('database is down')
+        self.written.extend(rows)
+
+    def make_spool(self, **kwargs):
+        return PacketSpool(self.directory, self.write, fsync=False, **kwargs)
+
+    def test_replays_closed_segments_and_deletes_them(self):
+        spool = self.make_spool(segment_bytes=1)
+        spool.append([(1, 'a'), (2, 'b')])
+        spool.append([(3, None)])
+        assert len(spool.closed_segments()) == 2
+        assert spool.drain()
+        assert self.written == [(1, 'a'), (2, 'b'), (3, None)]
+        assert spool.pending_segments() == 0
+
+    def test_current_segment_is_not_replayed(self):
+        clock = FakeClock()
+        spool = self.make_spool(segment_age=5, clock=clock)
+        spool.append([(1,)])
+        assert spool.drain()
+        assert self.written == []
+        clock.now = 5
+        spool.rotate_if_old()
+        assert spool.drain()
+        assert self.written == [(1,)]
+
+    def test_keeps_segments_when_the_write_fails(self):
+        spool = self.make_spool(segment_bytes=1)
+        spool.append([(1,)])
+        self.fail = True
+        assert not spool.drain()
+        assert spool.pending_segments() == 1
+        self.fail = False
+        assert spool.drain()
+        assert self.written == [(1,)]
+
+    def test_replays_segments_of_a_previous_run(self):
+        spool = self.make_spool()
+        spool.append([(1,), (2,)])
+        # the process dies without closing the segment
+        restarted = self.make_spool()
+        restarted.append([(3,)])
+        assert restarted.drain()
+        assert self.written == [(1,), (2,)]
+        restarted.segment_age = 0
+        restarted.rotate_if_old()
+        assert restarted.drain()
+        assert self.written == [(1,), (2,), (3,)]
+
+    def test_resumes_from_the_committed_offset(self):
+        spool = self.make_spool(segment_bytes=1, drain_batch=2)
+        spool.append([(1,), (2,), (3,)])
+        calls = []
+
+        def fail_second_batch(rows):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise ConnectionError('database is down')
+            self.written.extend(rows)
+
+        spool.write_callback = fail_second_batch
+        assert not spool.drain()
+        assert spool.drain()
+        assert self.written == [(1,), (2,), (3,)]
+
+    def test_discards_incomplete_records(self):
+        spool = self.make_spool(segment_bytes=1)
+        spool.append([(1,)])
+        with open(spool.closed_segments()[0], 'ab') as f:
+            f.write(b'[2, "trunc')
+        assert spool.drain()
+        assert self.written == [(1,)]
+
+    def test_restores_rows(self):
+        date = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+        spool = self.make_spool(segment_bytes=1,
+                                decode_row=lambda values: (datetime.datetime.fromisoformat(values[0]), values[1]))
+        spool.append([(date, True)])
+        assert spool.drain()
+        assert self.written == [(date, True)]
+        assert os.listdir(self.directory) == []
+
+
+    def test_quarantines_records_that_cant_be_decoded(self):
+        spool = self.make_spool(segment_bytes=1)
+        spool.append([(1,)])
+        with open(spool.closed_segments()[0], 'ab') as f:
+            f.write(b'[2, "trunc\n')
+        spool.append([(3,)])
+        assert spool.drain()
+        assert self.written == [(1,), (3,)]
+        assert spool.pending_segments() == 0
+        with open(os.path.join(self.directory, QUARANTINE_NAME), 'rb') as f:
+            assert f.read() == b'[2, "trunc\n'
+
+    def test_replays_adopted_directories(self):
+        orphaned = os.path.join(self.directory, 'worker-3')
+        PacketSpool(orphaned, self.write, fsync=False, segment_bytes=1).append([(1,), (2,)])
+        spool = PacketSpool(os.path.join(self.directory, 'worker-0'), self.write, fsync=False, segment_bytes=1,
+                            adopt=[orphaned, os.path.join(self.directory, 'worker-4')])
+        spool.append([(3,)])
+        assert spool.pending_segments() == 2
+        assert spool.drain()
+        assert self.written == [(1,), (2,), (3,)]
+        assert spool.pending_segments() == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
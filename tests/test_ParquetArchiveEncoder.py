@@ -0,0 +1,68 @@
+import datetime
+import io
+import json
+import unittest
+
+from ParquetArchiveEncoder import ParquetArchiveEncoder, pyarrow
+
+
+@unittest.skipIf(pyarrow is None, 'requires pyarrow')
+class TestParquetArchiveEncoder(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [{'data_collector_id': 1, 'packet_id': i, 'topic': f'gateway/{i}/rx', 'message': 'x' * i,
+                          'timestamp': '2020-02-01T10:00:00+00:00'} for i in range(200)]
+
+    def read(self, data):
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(io.BytesIO(data))
+
+    def test_declared_schema(self):
+        encoder = ParquetArchiveEncoder('zstd', row_group_size=50)
+        data = encoder.encode(self.messages + [{'data_collector_id': 2, 'message': {'rxpk': []}, 'gateway': 'ab'}])
+        table = self.read(data)
+        assert table.column_names == ['data_collector_id', 'packet_id', 'topic', 'message', 'timestamp', 'extra']
+        rows = table.to_pylist()
+        assert rows[3]['packet_id'] == 3
+        assert rows[3]['message'] == 'xxx'
+        assert rows[3]['timestamp'] == datetime.datetime(2020, 2, 1, 10, tzinfo=datetime.timezone.utc)
+        assert rows[3]['extra'] is None
+        assert json.loads(rows[-1]['message']) == {'rxpk': []}
+        assert json.loads(rows[-1]['extra']) == {'gateway': 'ab'}
+        assert rows[-1]['packet_id'] is None
+        assert encoder.extension == '.parquet'
+
+    def test_row_groups(self):
+        import pyarrow.parquet
+        data = ParquetArchiveEncoder('snappy', row_group_size=50).encode(self.messages)
+        assert pyarrow.parquet.ParquetFile(io.BytesIO(data)).num_row_groups == 4
+
+    def test_inferred_schema(self):
+        table = self.read(ParquetArchiveEncoder(schema='inferred').encode([{'a': 1, 'b': 'one'}, {'a': 2}]))
+        assert table.to_pylist() == [{'a': 1, 'b': 'one'}, {'a': 2, 'b': None}]
+
+    def test_inferred_schema_falls_back(self):
+        table = self.read(ParquetArchiveEncoder(schema='inferred').encode([{'rssi': 1}, {'rssi': 'x'}]))
+        assert [json.loads(extra) for extra in table.column('extra').to_pylist()] == [{'rssi': 1}, {'rssi': 'x'}]
+
+    def test_timestamps(self):
+        messages = [{'timestamp': '2020-02-01T10:00:00Z'}, {'timestamp': 1580551200}, {'timestamp': 1580551200.5},
+                    {'timestamp': 'yesterday'}, {'timestamp': [1]}, {}]
+        timestamps = self.read(ParquetArchiveEncoder().encode(messages)).column('timestamp').to_pylist()
+        date = datetime.datetime(2020, 2, 1, 10, tzinfo=datetime.timezone.utc)
+        assert timestamps == [date, date, date + datetime.timedelta(seconds=0.5), None, None, None]
+
+    def test_values_of_other_types(self):
+        messages = [{'data_collector_id': '12', 'packet_id': 'abc', 'topic': 7},
+                    {'data_collector_id': 2 ** 70, 'packet_id': [1], 'topic': None}]
+        rows = self.read(ParquetArchiveEncoder().encode(messages)).to_pylist()
+        assert [(row['data_collector_id'], row['packet_id'], row['topic']) for row in rows] == \
+            [(12, None, '7'), (None, None, None)]
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            ParquetArchiveEncoder('lz4')
+
+
+if __name__ == '__main__':
+    unittest.main()
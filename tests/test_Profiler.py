@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from Profiler import NULL_STAGE, Profiler, collapse
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = Profiler(sample_rate=0.25, interval=0.001, output_dir=self.directory)
+
+    def tearDown(self):
+        self.profiler.disable()
+
+    def test_disabled_does_nothing(self):
+        assert self.profiler.trace() is None
+        assert self.profiler.stage('write_batch') is NULL_STAGE
+        with self.profiler.stage('write_batch'):
+            pass
+        assert self.profiler.get_stage_stats() == {}
+
+    def test_stages_of_sampled_messages(self):
+        self.profiler.enable()
+        for _ in range(8):
+            trace = self.profiler.trace()
+            time.sleep(0.001)
+            if trace:
+                trace.lap('decode_message')
+                trace.lap('decode_packet')
+        with self.profiler.stage('write_batch'):
+            pass
+        stats = self.profiler.get_stage_stats()
+        assert stats['decode_message']['count'] == 2
+        assert stats['decode_message']['mean_wall'] >= 0.001
+        assert stats['decode_message']['cpu'] < stats['decode_message']['wall']
+        assert stats['decode_packet']['mean_wall'] < 0.001
+        assert stats['write_batch']['count'] == 1
+
+    def test_dump_collapsed_stacks(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(stop,), name='busy')
+        thread.start()
+        self.profiler.enable()
+        time.sleep(0.05)
+        self.profiler.disable()
+        stop.set()
+        thread.join()
+        with self.profiler.stage('write_batch'):
+            pass
+        stacks_path, stages_path = self.profiler.dump()
+        assert os.path.dirname(stacks_path) == self.directory
+        with open(stacks_path) as f:
+            lines = f.read().splitlines()
+        busy = [line for line in lines if line.startswith('busy;')]
+        assert busy and all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+        assert any('test_Profiler.py:busy_loop' in line for line in busy)
+        with open(stages_path) as f:
+            assert json.load(f)['stages'] == {}
+
+    def test_toggle(self):
+        self.profiler.toggle()
+        assert self.profiler.enabled
+        self.profiler.toggle()
+        assert not self.profiler.enabled
+        assert len(os.listdir(self.directory)) == 2
+
+    def test_collapse(self):
+        def inner():
+            import sys
+            return collapse(sys._getframe())
+        assert collapse_tail(inner()) == 'test_Profiler.py:test_collapse;test_Profiler.py:inner'
+
+
+def collapse_tail(stack):
+    return ';'.join(stack.split(';')[-2:])
+
+
+if __name__ == '__main__':
+    unittest.main()
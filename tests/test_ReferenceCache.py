@@ -0,0 +1,83 @@
+import unittest
+
+from ReferenceCache import ReferenceCache
+
+COLUMNS = ('data_collector_id', 'organization_id', 'data')
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeReferenceCache(ReferenceCache):
+
+    def __init__(self, collectors, **kwargs):
+        super().__init__(None, columns=COLUMNS, **kwargs)
+        self.collectors = collectors
+        self.queries = []
+
+    def load(self, ids=None):
+        self.queries.append(None if ids is None else sorted(ids))
+        return {id: org for id, org in self.collectors.items() if ids is None or id in ids}
+
+
+class TestReferenceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = FakeReferenceCache({1: 10, 2: 20, 3: None}, ttl=60, clock=self.clock)
+
+    def test_rows_are_checked_and_filled(self):
+        self.cache.warm()
+        rows = [(1, None, 'a'), (2, 20, 'b'), (9, 10, 'c'), (3, None, 'd'), (3, 30, 'e'), (1, 11, 'f')]
+        checked, rejected = self.cache.check(rows)
+        assert checked == [(1, 10, 'a'), (2, 20, 'b'), (3, 30, 'e'), (1, 10, 'f')]
+        assert [(row[2], error) for row, error in rejected] == [('c', 'Unknown data collector 9'),
+                                                              ('d', 'Data collector 3 has no organization')]
+        # 9 was unknown: loaded once and cached as unknown
+        assert self.cache.queries == [None, [9]]
+        self.cache.check([(9, 10, 'g')])
+        assert self.cache.queries == [None, [9]]
+
+    def test_expired_entries_are_reloaded(self):
+        self.cache.warm()
+        self.cache.collectors[1] = 11
+        assert self.cache.check([(1, None, 'a')])[0] == [(1, 10, 'a')]
+        self.clock.now = 61
+        assert self.cache.check([(1, None, 'a'), (2, None, 'b')])[0] == [(1, 11, 'a'), (2, 20, 'b')]
+        assert self.cache.queries == [None, [1, 2]]
+
+    def test_stats(self):
+        self.cache.check([(1, None, 'a')])
+        self.cache.check([(1, None, 'a'), (2, None, 'b')])
+        stats = self.cache.get_stats()
+        assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 2)
+        assert stats['hit_rate'] == 1 / 3
+
+    def test_max_entries(self):
+        cache = FakeReferenceCache({1: 10, 2: 20, 3: 30}, max_entries=2, clock=self.clock)
+        cache.warm()
+        assert list(cache.entries) == [2, 3]
+
+    def test_load_failures_let_the_rows_through(self):
+        def failing_load(ids=None):
+            raise ConnectionError('connection refused')
+
+        self.cache.load = failing_load
+        assert self.cache.check([(1, None, 'a')]) == ([(1, None, 'a')], [])
+
+    def test_string_ids(self):
+        checked, rejected = self.cache.check([('1', None, 'a'), ('abc', None, 'b'), (None, None, 'c')])
+        assert checked == [(1, 10, 'a')]
+        assert [(row[2], error) for row, error in rejected] == [('b', 'Unknown data collector abc'),
+                                                              ('c', 'Unknown data collector None')]
+        assert self.cache.queries == [[1]]
+
+
+if __name__ == '__main__':
+    unittest.main()
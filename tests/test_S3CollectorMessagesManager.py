@@ -2,7 +2,9 @@ import datetime
 import gzip
 import json
 import os
+import threading
 import boto3
+from moto import mock_aws
 
 from S3CollectorMessagesManager import S3CollectorMessagesManager
 import unittest
@@ -77,5 +79,171 @@ class TestS3CollectorMessagesManager(unittest.TestCase):
         assert len(self.manager.messages_per_collector[self.TEST_COLLECTOR_ID]) == 0
 
 
+@mock_aws
+class TestS3CollectorMessagesManagerBackgroundUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.TEST_COLLECTOR_ID = 999
+        self.bucket_name = 'collector-messages'
+        session = boto3.Session(aws_access_key_id='testing', aws_secret_access_key='testing', region_name='us-east-1')
+        self.bucket = session.resource('s3').create_bucket(Bucket=self.bucket_name)
+        self.manager = S3CollectorMessagesManager('testing', 'testing', self.bucket_name, maximum_msgs_per_collector=2,
+                                                  upload_workers=2, upload_queue_depth=1)
+
+    def tearDown(self):
+        self.manager.uploader.shutdown()
+
+    def test_threshold_uploads_in_background(self):
+        self.manager.save_collector_messages(self.TEST_COLLECTOR_ID, [{'one': 1}, {'two': 2}])
+        self.manager.save_collector_messages(self.TEST_COLLECTOR_ID, [{'three': 3}])
+        # the buffer is released right away, before the upload finishes
+        assert len(self.manager.get_messages_for_collector(self.TEST_COLLECTOR_ID)) == 1
+        self.manager.uploader.wait()
+        objs = list(self.bucket.objects.all())
+        assert len(objs) == 1
+        with gzip.GzipFile(fileobj=objs[0].get()['Body'], mode='r') as gz:
+            lines = gz.readlines()
+        assert [json.loads(line) for line in lines] == [{'one': 1}, {'two': 2}]
+
+    def test_flush_all_waits_for_uploads(self):
+        for collector_id in range(10):
+            self.manager.save_collector_messages(collector_id, [{'id': collector_id}])
+        self.manager.flush_all()
+        assert self.manager.uploader.in_flight() == 0
+        assert len(list(self.bucket.objects.all())) == 10
+
+    def test_failed_upload_is_retried(self):
+        calls = []
+        upload = self.manager.bucket_messages.meta.client.upload_fileobj
+
+        def flaky_upload(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise ConnectionError('connection reset')
+            return upload(*args)
+
+        self.manager.bucket_messages.meta.client.upload_fileobj = flaky_upload
+        self.manager.uploader.backoff = 0.01
+        self.manager.save_collector_messages(self.TEST_COLLECTOR_ID, [{'one': 1}])
+        self.manager.flush_all()
+        assert len(calls) == 2
+        assert self.manager.uploader.failed == 0
+        assert len(list(self.bucket.objects.all())) == 1
+
+
+@mock_aws
+class TestS3CollectorMessagesManagerWindows(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket_name = 'collector-messages'
+        session = boto3.Session(aws_access_key_id='testing', aws_secret_access_key='testing', region_name='us-east-1')
+        self.bucket = session.resource('s3').create_bucket(Bucket=self.bucket_name)
+        self.manager = S3CollectorMessagesManager('testing', 'testing', self.bucket_name, maximum_msgs_per_collector=2,
+                                                  window='hour', window_grace=60)
+        # windows are only closed by the tests, not by the periodic check
+        self.manager.last_window_check = float('inf')
+        self.start = datetime.datetime(2020, 2, 1, 10, tzinfo=datetime.timezone.utc)
+
+    def read_json(self, key):
+        return json.loads(self.bucket.Object(key).get()['Body'].read())
+
+    def manifests(self):
+        # manifest names end with the time they were written
+        return sorted((obj.key for obj in self.bucket.objects.all() if '_manifest_' in obj.key),
+                      key=lambda key: key.rsplit('_', 2)[1])
+
+    def archives(self):
+        return sorted(obj.key for obj in self.bucket.objects.all() if '_manifest_' not in obj.key)
+
+    def test_messages_are_grouped_by_window(self):
+        self.manager.save_collector_messages(1, [{'id': 1}], datetime.datetime(2020, 2, 1, 10, 5))
+        self.manager.save_collector_messages(1, [{'id': 2}], datetime.datetime(2020, 2, 1, 11, 5))
+        self.manager.save_collector_messages(1, [{'id': 3}], datetime.datetime(2020, 2, 1, 10, 55))
+        assert self.manager.messages_per_collector[(1, self.start)] == [{'id': 1}, {'id': 3}]
+        assert self.manager.get_buffered_counts() == {1: 3}
+
+    def test_closed_window_is_uploaded_with_manifest(self):
+        for i in range(3):
+            self.manager.save_collector_messages(1, [{'id': i}], self.start + datetime.timedelta(minutes=i))
+        self.manager.save_collector_messages(2, [{'id': 9}], self.start)
+        # still within the grace period
+        self.manager.close_windows(self.start + datetime.timedelta(hours=1, seconds=30))
+        assert len(list(self.bucket.objects.all())) == 1
+        self.manager.close_windows(self.start + datetime.timedelta(hours=1, minutes=2))
+        assert (1, self.start) not in self.manager.messages_per_collector
+        manifest = self.read_json(self.manifests()[-1])
+        assert manifest['window_start'] == '2020-02-01T10:00:00+00:00'
+        assert manifest['window_end'] == '2020-02-01T11:00:00+00:00'
+        assert manifest['messages'] == 4
+        keys = sorted(entry['key'] for entry in manifest['objects'])
+        assert keys == self.archives()
+        assert any(key.startswith('year=2020/month=202002/day=20200201/collector=1/'
+                                  'messages_collector_1_2020-02-01 10:00:00_part0002_') and key.endswith('.json.gz')
+                   for key in keys)
+
+    def test_late_messages_rewrite_the_manifest(self):
+        self.manager.save_collector_messages(1, [{'id': 1}], self.start)
+        self.manager.close_windows(self.start + datetime.timedelta(hours=2))
+        self.manager.save_collector_messages(1, [{'id': 2}], self.start)
+        self.manager.close_windows(self.start + datetime.timedelta(hours=2))
+        manifest = self.read_json(self.manifests()[-1])
+        assert manifest['messages'] == 2
+        assert len(manifest['objects']) == 2
+        assert len(self.manifests()) == 2
+
+    def test_restarted_manager_does_not_overwrite(self):
+        self.manager.save_collector_messages(1, [{'id': 1}, {'id': 2}], self.start)
+        self.manager.close_windows(self.start + datetime.timedelta(hours=2))
+        first_archives, first_manifests = self.archives(), self.manifests()
+        manager = S3CollectorMessagesManager('testing', 'testing', self.bucket_name, window='hour', window_grace=60)
+        manager.last_window_check = float('inf')
+        manager.save_collector_messages(1, [{'id': 3}], self.start)
+        manager.close_windows(self.start + datetime.timedelta(hours=2))
+        assert len(self.archives()) == 2 and set(first_archives) < set(self.archives())
+        assert len(self.manifests()) == 2 and set(first_manifests) < set(self.manifests())
+        objects = [entry['key'] for key in self.manifests() for entry in self.read_json(key)['objects']]
+        assert sorted(objects) == self.archives()
+
+    def test_closing_a_window_does_not_wait_for_the_uploads(self):
+        manager = S3CollectorMessagesManager('testing', 'testing', self.bucket_name, window='hour', window_grace=60,
+                                             upload_workers=2)
+        manager.last_window_check = float('inf')
+        release = threading.Event()
+        upload_messages = manager.upload_messages
+
+        def slow_upload(*args):
+            release.wait(5)
+            upload_messages(*args)
+
+        manager.upload_messages = slow_upload
+        manager.save_collector_messages(1, [{'id': 1}], self.start)
+        manager.save_collector_messages(2, [{'id': 2}], self.start)
+        manager.close_windows(self.start + datetime.timedelta(hours=2))
+        assert manager.uploader.in_flight() == 2
+        release.set()
+        manager.uploader.wait()
+        manager.uploader.shutdown()
+        assert len(self.manifests()) == 1
+        assert self.read_json(self.manifests()[0])['messages'] == 2
+
+    def test_flush_all_only_writes_the_manifests_of_flushed_windows(self):
+        later = self.start + datetime.timedelta(hours=1)
+        self.manager.save_collector_messages(1, [{'id': 1}], self.start)
+        self.manager.save_collector_messages(1, [{'id': 2}], later)
+        self.manager.flush_all()
+        assert len(self.manifests()) == 2
+        self.manager.save_collector_messages(1, [{'id': 3}], later)
+        self.manager.flush_all()
+        manifests = self.manifests()
+        assert len(manifests) == 3
+        assert self.read_json(manifests[-1])['window_start'] == later.isoformat()
+        self.manager.flush_all()
+        assert len(self.manifests()) == 3
+
+    def test_unknown_window(self):
+        with self.assertRaises(ValueError):
+            S3CollectorMessagesManager('testing', 'testing', self.bucket_name, window='week')
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,33 @@
+import unittest
+
+from Sharding import owned_shards, parse_shard_indexes, shard_for, shard_queue_name
+
+
+class TestSharding(unittest.TestCase):
+
+    def test_shard_for_is_stable(self):
+        assert shard_for(1234, 8) == shard_for('1234', 8)
+        assert all(0 <= shard_for(key, 8) < 8 for key in range(100))
+        assert len({shard_for(key, 8) for key in range(100)}) == 8
+
+    def test_shard_queue_name(self):
+        assert shard_queue_name(3) == 'collectors_queue.3'
+
+    def test_owned_shards(self):
+        assert owned_shards(4) == [0, 1, 2, 3]
+        assert owned_shards(8, [4, 5, 6, 7]) == [4, 5, 6, 7]
+        assert owned_shards(8, [4, 5, 6, 7], worker_id=1, processes=2) == [5, 7]
+        with self.assertRaises(ValueError):
+            owned_shards(4, [4])
+
+    def test_every_shard_has_one_worker(self):
+        workers = [owned_shards(10, worker_id=worker_id, processes=3) for worker_id in range(3)]
+        assert sorted(shard for shards in workers for shard in shards) == list(range(10))
+
+    def test_parse_shard_indexes(self):
+        assert parse_shard_indexes('') is None
+        assert parse_shard_indexes('0,2,4-6') == [0, 2, 4, 5, 6]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import signal
+import time
+import unittest
+
+from WorkerPool import FORWARDED_SIGNALS, WorkerPool
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def exit_at_once(worker_id, counters):
+    pass
+
+
+class CountingWorkerPool(WorkerPool):
+    """
+    Records when each worker is started, and stops after max_starts
+    """
+
+    def __init__(self, max_starts, **kwargs):
+        super().__init__(exit_at_once, **kwargs)
+        self.max_starts = max_starts
+        self.starts = []
+
+    def start_worker(self, worker_id):
+        self.starts.append(time.monotonic())
+        if len(self.starts) > self.max_starts:
+            self.stop()
+            return
+        super().start_worker(worker_id)
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        # run installs its handlers in this process
+        for signum in (signal.SIGTERM, signal.SIGINT) + FORWARDED_SIGNALS:
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def test_restart_backoff(self):
+        clock = FakeClock()
+        pool = WorkerPool(exit_at_once, processes=1, restart_backoff=1, max_restart_backoff=4, stable_after=60,
+                          clock=clock)
+        pool.started_at[0] = 0
+        assert [pool.schedule_restart(0) for _ in range(4)] == [1, 2, 4, 4]
+        # a worker that stayed up is restarted at once, and its backoff starts over
+        clock.now = 100
+        assert pool.schedule_restart(0) == 0
+        pool.started_at[0] = 100
+        assert pool.schedule_restart(0) == 1
+
+    def test_workers_that_exit_at_once_are_restarted_with_backoff(self):
+        pool = CountingWorkerPool(4, processes=1, restart_backoff=0.05, max_restart_backoff=0.2)
+        pool.run()
+        gaps = [later - earlier for earlier, later in zip(pool.starts, pool.starts[1:])]
+        assert len(gaps) == 4
+        for gap, delay in zip(gaps, (0.05, 0.1, 0.2, 0.2)):
+            assert delay <= gap < delay + 1
+        assert pool.failures == [4]
+
+
+if __name__ == '__main__':
+    unittest.main()